@@ -0,0 +1,804 @@
+"""
+Headless batch fitting over a directory of OCP sweep folders
+Finds every folder containing a nyquist.txt file, fits it without opening
+any plotting windows or asking for input, and writes one results table
+Spectra can be spread across a pool of worker processes
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from curve_fitting.Curve_fitting import fit_leastsq, read_param_settings, read_constant_mask
+from curve_fitting.Guesser import param_guesser
+from curve_fitting.Global_fitting import fit_global
+from curve_fitting.Fit_cache import DEFAULT_CACHE_FOLDER, cache_key, load_fit, save_fit
+from curve_fitting.Uncertainty import linear_stderr
+from curve_fitting.Loss import LOSSES
+from curve_fitting.Weighting import WEIGHTINGS
+from curve_fitting.Model_registry import get_model
+from curve_fitting.Instrumentation import enable, is_enabled, profiling, record, count, timer, aggregate, print_report
+from data_io.Spectrum_store import SpectrumStore, is_store
+from data_io.Nova_reader import read_ocp_value
+
+#spectrum stores already opened by this process
+_open_stores = {}
+
+def read_bias_voltage(OCPfile):
+    """
+    Reads the bias voltage from a Nova OCP file
+    Args:
+        OCPfile (string): name of file containing OCP data
+    Returns:
+        OCP value (float) of the first row
+    """
+    return read_ocp_value(OCPfile)
+
+def get_store(store_folder):
+    """
+    Opens a spectrum store once per process
+    Args:
+        store_folder (string): folder containing the store
+    Returns:
+        SpectrumStore
+    """
+    if store_folder not in _open_stores:
+        _open_stores[store_folder] = SpectrumStore(store_folder)
+    return _open_stores[store_folder]
+
+def find_datasets(root):
+    """
+    Finds every folder under root which contains impedance data
+    Args:
+        root (string): top level folder, e.g. test_data/008Pixel7, or a spectrum store written by data_io/Spectrum_store.py
+    Returns:
+        datasets (list): list of dictionaries with keys 'pixel', 'folder', 'datafile', 'IVfile', 'OCPfile'
+        IVfile and OCPfile are None if the folder does not contain them.
+        Datasets from a store also have the keys 'store' and 'entry', and are read from the store instead of the files
+    """
+    if is_store(root):
+        return find_store_datasets(root)
+
+    datasets = []
+    for folder, subfolders, filenames in os.walk(root):
+        subfolders.sort()
+        if "nyquist.txt" not in filenames:
+            continue
+
+        datasets.append({
+            "pixel": os.path.basename(os.path.dirname(folder)),
+            "folder": folder,
+            "datafile": os.path.join(folder, "nyquist.txt"),
+            "IVfile": os.path.join(folder, "CVafter.txt") if "CVafter.txt" in filenames else None,
+            "OCPfile": os.path.join(folder, "OCP.txt") if "OCP.txt" in filenames else None,
+        })
+    return datasets
+
+def find_store_datasets(store_folder):
+    """
+    Lists the datasets of a spectrum store in the same form as find_datasets
+    Args:
+        store_folder (string): folder containing the store
+    Returns:
+        datasets (list): dataset dictionaries, see find_datasets
+    """
+    store = get_store(store_folder)
+    datasets = []
+    for i, entry in enumerate(store.entries):
+        rows = entry["rows"]
+        datasets.append({
+            "pixel": entry["pixel"],
+            "folder": entry["folder"],
+            "datafile": os.path.join(entry["folder"], "nyquist.txt"),
+            "IVfile": os.path.join(entry["folder"], "CVafter.txt") if "CVafter" in rows else None,
+            "OCPfile": os.path.join(entry["folder"], "OCP.txt") if entry["OCP_value"] is not None else None,
+            "store": store_folder,
+            "entry": i,
+        })
+    return datasets
+
+def load_spectrum(dataset):
+    """
+    Loads the impedance data of a dataset, from its store if it has one
+    Args:
+        dataset (dict): dataset dictionary from find_datasets
+    Returns:
+        data (array): Impedance data
+    """
+    if dataset.get("store") is not None:
+        return get_store(dataset["store"]).get(dataset["entry"], "nyquist")
+    return np.loadtxt(dataset["datafile"], skiprows=1)
+
+def dataset_bias_voltage(dataset):
+    """
+    Bias voltage of a dataset, from its store if it has one
+    Args:
+        dataset (dict): dataset dictionary from find_datasets
+    Returns:
+        OCP value (float), None if the dataset has no OCP data
+    """
+    if dataset["OCPfile"] is None:
+        return None
+    if dataset.get("store") is not None:
+        return get_store(dataset["store"]).entries[dataset["entry"]]["OCP_value"]
+    return read_bias_voltage(dataset["OCPfile"])
+
+def load_dataset(dataset):
+    """
+    Loads the data files of a dataset found by find_datasets
+    Args:
+        dataset (dict): dataset dictionary from find_datasets
+    Returns:
+        data (array): Impedance data
+        IVdata (array or None): Current-Voltage data
+        biasvoltage (float or None): Bias voltage from the OCP file
+    """
+    data = load_spectrum(dataset)
+
+    IVdata = None
+    if dataset.get("store") is not None:
+        IVdata = get_store(dataset["store"]).get(dataset["entry"], "CVafter")
+    elif dataset["IVfile"] is not None:
+        IVdata = np.loadtxt(dataset["IVfile"], skiprows=1)
+
+    return data, IVdata, dataset_bias_voltage(dataset)
+
+def fit_dataset(imp_model_folder, dataset, nobias_dataset, logspace=False, p0=None, cache_folder=None, multistart=0,
+                loss="linear", weighting="unit"):
+    """
+    Fits a single dataset without any user interaction
+    The dataset is fitted as no bias data if it is the pixel's 0V reference, otherwise
+    as bias data with the bias voltage fixed
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model
+        dataset (dict): dataset to fit
+        nobias_dataset (dict): 0V reference dataset of the same pixel
+        logspace (boolean): Whether to fit the logarithmic parameters in log space, see fit_leastsq
+        p0 (list or None): Starting parameters, if None they are guessed from the data
+        cache_folder (string or None): folder of the fit cache to reuse identical previous fits from, None disables the cache
+        multistart (int): number of starts of a multi-start fit, 0 fits from the single starting point, see fit_leastsq
+        loss (string): 'linear' least squares or a robust loss, see fit_leastsq
+        weighting (string): weights of the residuals, see fit_leastsq
+    Returns:
+        row (dict): results row containing the fitted parameters under 'params', their uncertainties under 'stderr',
+        'correlation' and 'log_params' (see fit_leastsq), and the fit's record from
+        curve_fitting/Instrumentation.py under 'profile' (None unless instrumentation is enabled).
+        'status' is 'ok' for converged fits, 'bound' for converged fits with parameters on a bound (listed under
+        'at_bound', see fit_leastsq) and 'guess' if the fit did not converge and 'params' holds its starting point.
+        If the fit fails 'status' is 'error' and 'params' is None
+    """
+    model = get_model(imp_model_folder)
+    row = failed_row(dataset, nobias_dataset)
+    bias = row["bias"]
+
+    row["start"] = "guess" if p0 is None else "warm"
+
+    start = time.perf_counter()
+    with record() as profile:
+        try:
+            with timer("file_io"):
+                data, IVdata, biasvoltage = load_dataset(dataset)
+                nobias_data = load_spectrum(nobias_dataset)
+            row["bias_voltage"] = biasvoltage
+
+            if biasvoltage is None:
+                raise ValueError("No OCP file found, cannot prompt for a bias voltage in batch mode")
+
+            if bias:
+                fixed_params_indices = [7]
+                fixed_params_values = [biasvoltage]
+            else:
+                fixed_params_indices = []
+                fixed_params_values = []
+
+            cached = None
+            if cache_folder is not None:
+                key = cache_key([data, nobias_data, IVdata], model.folder,
+                                {"bias": bias, "bias_voltage": biasvoltage, "fixed_params_indices": fixed_params_indices,
+                                                   "fixed_params_values": fixed_params_values, "dZ": model.dZ is not None,
+                                                   "logspace": logspace, "p0": None if p0 is None else list(p0),
+                                                   "multistart": multistart, "loss": loss, "weighting": weighting})
+                cached = load_fit(key, cache_folder)
+
+            if cached is not None:
+                plist_fitted, fit_info = cached
+                row["cached"] = True
+                count("cache_hits")
+            else:
+                plist_fitted, fit_info = fit_leastsq(model.Z, data, nobias_data, biasvoltage, IVdata, bias=bias, nanoparticles=model.nano,
+                                                     run_checker=False, fixed_params_indices=fixed_params_indices,
+                                                     fixed_params_values=fixed_params_values, full_output=True, dZ=model.dZ,
+                                                     logspace=logspace, init_paramfilename=model.init_paramfilename, p0=p0,
+                                                     multistart=multistart, loss=loss, weighting=weighting,
+                                                     vectorized=model.vectorized, bound_Z=model.bound_Z)
+                if cache_folder is not None:
+                    save_fit(key, plist_fitted, fit_info, cache_folder)
+
+            row["params"] = plist_fitted
+            row["nfev"] = fit_info["nfev"]
+            row["njev"] = fit_info["njev"]
+            row["cost"] = fit_info["cost"]
+            #converged fits ending on a bound are reported, their parameters are probably limited by the bound
+            at_bound = np.asarray(fit_info["at_bound"], dtype=bool)
+            row["at_bound"] = ";".join(np.array(model.param_names)[at_bound])
+            row["status"] = ("bound" if np.any(at_bound) else "ok") if fit_info["success"] else "guess"
+            #cached fit_info holds lists
+            row["stderr"] = np.asarray(fit_info["stderr"], dtype=float)
+            row["correlation"] = np.asarray(fit_info["correlation"], dtype=float)
+            row["log_params"] = np.asarray(fit_info["log_params"], dtype=bool)
+        except Exception as error:
+            print(f"Unable to fit {dataset['folder']}: {error}")
+
+    row["profile"] = profile
+    row["time_s"] = time.perf_counter() - start
+    return row
+
+def reference_datasets(datasets):
+    """
+    Picks the 0V reference dataset for every pixel
+    The reference is the dataset with the lowest OCP value in the pixel folder
+    Args:
+        datasets (list): datasets from find_datasets
+    Returns:
+        references (dict): pixel name -> reference dataset
+    """
+    references = {}
+    lowest = {}
+    for dataset in datasets:
+        biasvoltage = dataset_bias_voltage(dataset)
+        if biasvoltage is None:
+            biasvoltage = np.inf
+
+        pixel = dataset["pixel"]
+        if pixel not in references or biasvoltage < lowest[pixel]:
+            references[pixel] = dataset
+            lowest[pixel] = biasvoltage
+    return references
+
+def failed_row(dataset, nobias_dataset):
+    """
+    Results row for a dataset which could not be fitted
+    Also used as the starting row of fit_dataset
+    Args:
+        dataset (dict): dataset which was being fitted
+        nobias_dataset (dict): 0V reference dataset of the same pixel
+    Returns:
+        row (dict): results row with 'status' set to 'error'
+    """
+    return {"pixel": dataset["pixel"], "folder": dataset["folder"], "bias_voltage": None,
+            "bias": dataset["folder"] != nobias_dataset["folder"], "status": "error", "start": None, "cached": False,
+            "nfev": None, "njev": None, "cost": None, "time_s": None, "params": None, "stderr": None,
+            "correlation": None, "log_params": None, "profile": None, "at_bound": None}
+
+def fit_failed(row):
+    """
+    Whether a fit failed: it did not converge, or ended with a non-finite cost or parameters
+    Args:
+        row (dict): results row from fit_dataset
+    Returns:
+        failed (boolean)
+    """
+    if row["status"] not in ("ok", "bound") or row["cost"] is None or not np.isfinite(row["cost"]):
+        return True
+    return not np.all(np.isfinite(np.asarray(row["params"], dtype=float)))
+
+def fit_sweep(imp_model_folder, datasets, nobias_dataset, logspace=False, cache_folder=None, multistart=0, loss="linear",
+              weighting="unit"):
+    """
+    Fits the datasets of one pixel in order of increasing OCP voltage, starting each fit
+    from the previous converged parameters since neighbouring biases share most parameters.
+    Falls back to guessing the starting parameters if the warm started fit fails, see fit_failed
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model
+        datasets (list): datasets of a single pixel
+        nobias_dataset (dict): 0V reference dataset of the pixel
+        logspace (boolean): Whether to fit the logarithmic parameters in log space, see fit_leastsq
+        cache_folder (string or None): folder of the fit cache, see fit_dataset
+        multistart (int): number of starts of a multi-start fit, see fit_leastsq
+        loss (string): 'linear' least squares or a robust loss, see fit_leastsq
+        weighting (string): weights of the residuals, see fit_leastsq
+    Returns:
+        rows (list): results rows from fit_dataset, in order of increasing OCP voltage
+    """
+    def ocp(dataset):
+        biasvoltage = dataset_bias_voltage(dataset)
+        return biasvoltage if biasvoltage is not None else np.inf
+
+    rows = []
+    p0 = None
+    for dataset in sorted(datasets, key=ocp):
+        row = fit_dataset(imp_model_folder, dataset, nobias_dataset, logspace=logspace, p0=p0, cache_folder=cache_folder,
+                          multistart=multistart, loss=loss, weighting=weighting)
+
+        if p0 is not None and fit_failed(row):
+            print(f"Warm start failed for {dataset['folder']}, guessing parameters instead")
+            warm_row = row
+            row = fit_dataset(imp_model_folder, dataset, nobias_dataset, logspace=logspace, cache_folder=cache_folder,
+                              multistart=multistart, loss=loss, weighting=weighting)
+            if row["status"] == "error" and warm_row["params"] is not None and np.all(np.isfinite(warm_row["params"])):
+                #the parameters cannot be guessed, keep the failed warm started fit
+                row = warm_row
+                row["status"] = "guess"
+            else:
+                row["time_s"] += warm_row["time_s"]
+
+        if not fit_failed(row):
+            p0 = row["params"]
+        rows.append(row)
+    return rows
+
+def fit_pixel_global(imp_model_folder, datasets, nobias_dataset, cache_folder=None):
+    """
+    Fits every dataset of one pixel in a single joint fit, with C_g, C_ion, R_ion, R_s and R_sh
+    shared between the bias voltages and the bias voltage of each biased dataset fixed to its OCP value
+    Starting parameters are guessed for each dataset, datasets which cannot be guessed (or whose guess
+    gives a non-finite impedance) start from the guess of the nearest dataset in OCP voltage.
+    The bias voltage of the 0V reference dataset is fitted, as in fit_dataset
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model
+        datasets (list): datasets of a single pixel
+        nobias_dataset (dict): 0V reference dataset of the pixel
+        cache_folder (string or None): folder of the fit cache, the whole joint fit is one entry. None disables the cache
+    Returns:
+        rows (list): results rows, datasets which could not be loaded first, then in order of increasing OCP voltage.
+        Every row reports the joint fit's nfev and njev, and an equal share of its time.
+        If the joint fit does not converge every row has status 'guess' and holds its starting parameters and their cost
+    """
+    model = get_model(imp_model_folder)
+    start = time.perf_counter()
+
+    failed_rows = []
+    entries = []
+    nobias_data = load_spectrum(nobias_dataset)
+    for dataset in datasets:
+        row = failed_row(dataset, nobias_dataset)
+        try:
+            data, IVdata, biasvoltage = load_dataset(dataset)
+            if biasvoltage is None:
+                raise ValueError("No OCP file found, cannot prompt for a bias voltage in batch mode")
+        except Exception as error:
+            print(f"Unable to fit {dataset['folder']}: {error}")
+            failed_rows.append(row)
+            continue
+        row["bias_voltage"] = biasvoltage
+
+        try:
+            p0 = list(param_guesser(data, nobias_data, IVdata, biasvoltage, run_checker=False,
+                                    bias=row["bias"], nanoparticles=model.nano))
+            if row["bias"]:
+                p0[7] = biasvoltage
+            if not np.all(np.isfinite(model.Z(data[:,1], *np.abs(p0)))):
+                raise ValueError("Guessed parameters give a non-finite impedance")
+            row["start"] = "guess"
+        except Exception:
+            p0 = None
+        entries.append((row, data, p0))
+    entries.sort(key=lambda entry: entry[0]["bias_voltage"])
+
+    guessed = [i for i, (row, data, p0) in enumerate(entries) if p0 is not None]
+    if len(guessed) == 0:
+        print(f"Unable to guess parameters for any dataset of {nobias_dataset['pixel']}")
+        return failed_rows + [row for row, data, p0 in entries]
+
+    p0_list = []
+    for i, (row, data, p0) in enumerate(entries):
+        if p0 is None:
+            nearest = min(guessed, key=lambda j: abs(j - i))
+            p0 = entries[nearest][2]
+            row["start"] = "neighbour"
+        p0_list.append(p0)
+
+    rows = [row for row, data, p0 in entries]
+    try:
+        #bias voltages are fixed, and the constants at their Initial_params.csv values as in fit_leastsq
+        constant_indices = [int(i) for i in np.flatnonzero(read_constant_mask(model.init_paramfilename))]
+        constant_values = list(read_param_settings(model.init_paramfilename)[1][constant_indices])
+        spectra = [data for row, data, p0 in entries]
+        #as in fit_dataset, the bias voltage is fitted for the pixel's 0V reference (nan, see fit_global)
+        fixed_params_values = [[row["bias_voltage"] if row["bias"] else np.nan] + constant_values for row in rows]
+
+        cached = None
+        if cache_folder is not None:
+            #the guesses carry the IV and reference data's part in the fit
+            key = cache_key(spectra, model.folder, {"joint": True, "p0_list": [list(p0) for p0 in p0_list],
+                                                    "fixed_params_values": fixed_params_values,
+                                                    "dZ": model.dZ is not None})
+            cached = load_fit(key, cache_folder)
+
+        if cached is not None:
+            #the cache stores the K parameter sets flattened
+            fitted_params_list = [tuple(params) for params in np.reshape(cached[0], (len(rows), -1))]
+            fit_info = cached[1]
+            for row in rows:
+                row["cached"] = True
+            count("cache_hits")
+        else:
+            fitted_params_list, fit_info = fit_global(model.Z, spectra, p0_list,
+                                                      fixed_params_indices=[7] + constant_indices,
+                                                      fixed_params_values=fixed_params_values,
+                                                      dZ=model.dZ, full_output=True, vectorized=model.vectorized)
+            if cache_folder is not None:
+                save_fit(key, np.ravel(fitted_params_list), fit_info, cache_folder)
+
+        if not fit_info["success"]:
+            #as in fit_dataset, unconverged fits report their starting point
+            fitted_params_list = [tuple(params) for params in fit_info["start_params"]]
+            costs = fit_info["start_costs"]
+        else:
+            costs = fit_info["costs"]
+        for row, params, cost, at_bound in zip(rows, fitted_params_list, costs, fit_info["at_bound"]):
+            row["params"] = params
+            #as in fit_dataset, converged fits with parameters on a bound are reported
+            at_bound = np.asarray(at_bound, dtype=bool) & fit_info["success"]
+            row["at_bound"] = ";".join(np.array(model.param_names)[at_bound])
+            row["status"] = ("bound" if np.any(at_bound) else "ok") if fit_info["success"] else "guess"
+            row["nfev"] = fit_info["nfev"]
+            row["njev"] = fit_info["njev"]
+            row["cost"] = cost
+    except Exception as error:
+        print(f"Unable to jointly fit {nobias_dataset['pixel']}: {error}")
+
+    elapsed = time.perf_counter() - start
+    for row in rows:
+        row["time_s"] = elapsed / len(rows)
+    return failed_rows + rows
+
+def group_by_pixel(datasets):
+    """
+    Splits datasets into one list per pixel
+    Args:
+        datasets (list): datasets from find_datasets
+    Returns:
+        pixels (dict): pixel name -> list of datasets, in the order they were found
+    """
+    pixels = {}
+    for dataset in datasets:
+        pixels.setdefault(dataset["pixel"], []).append(dataset)
+    return pixels
+
+def fit_pixel(imp_model_folder, datasets, nobias_dataset, logspace=False, joint=False, cache_folder=None, multistart=0,
+              loss="linear", weighting="unit"):
+    """
+    Fits every dataset of one pixel, either jointly or as a warm started sweep
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model
+        datasets (list): datasets of a single pixel
+        nobias_dataset (dict): 0V reference dataset of the pixel
+        logspace (boolean): Whether to fit the logarithmic parameters in log space, see fit_leastsq (sweep only)
+        joint (boolean): Whether to fit with fit_pixel_global, else with fit_sweep
+        cache_folder (string or None): folder of the fit cache, see fit_dataset
+        multistart (int): number of starts of a multi-start fit, see fit_leastsq (sweep only)
+        loss (string): 'linear' least squares or a robust loss, see fit_leastsq (sweep only)
+        weighting (string): weights of the residuals, see fit_leastsq (sweep only)
+    Returns:
+        rows (list): results rows, one per dataset
+    """
+    if joint:
+        return fit_pixel_global(imp_model_folder, datasets, nobias_dataset, cache_folder=cache_folder)
+    return fit_sweep(imp_model_folder, datasets, nobias_dataset, logspace=logspace, cache_folder=cache_folder,
+                     multistart=multistart, loss=loss, weighting=weighting)
+
+def fit_datasets_parallel(imp_model_folder, datasets, references, workers, logspace=False, sweep=False, joint=False,
+                          cache_folder=None, multistart=0, loss="linear", weighting="unit"):
+    """
+    Fits datasets across a pool of worker processes
+    Results are returned in the same order as datasets, whichever worker finishes first
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model
+        datasets (list): datasets to fit
+        references (dict): pixel name -> 0V reference dataset
+        workers (int): number of worker processes
+        logspace (boolean): Whether to fit the logarithmic parameters in log space, see fit_leastsq
+        sweep (boolean): Whether to warm start each pixel's fits along its bias sweep, see fit_sweep.
+                         Each pixel is then fitted by one worker and rows are in order of pixel, then OCP voltage
+        joint (boolean): Whether to fit each pixel's datasets jointly, see fit_pixel_global.
+                         Pixels are distributed across workers as with sweep
+        cache_folder (string or None): folder of the fit cache, see fit_dataset
+        multistart (int): number of starts of a multi-start fit, see fit_leastsq
+        loss (string): 'linear' least squares or a robust loss, see fit_leastsq
+        weighting (string): weights of the residuals, see fit_leastsq
+    Returns:
+        rows (list): results rows from fit_dataset, one per dataset
+    """
+    per_pixel = sweep or joint
+    if per_pixel:
+        pixels = group_by_pixel(datasets)
+        jobs = [(fit_pixel, (imp_model_folder, pixel_datasets, references[pixel], logspace, joint, cache_folder,
+                             multistart, loss, weighting))
+                for pixel, pixel_datasets in pixels.items()]
+        job_datasets = list(pixels.values())
+    else:
+        jobs = [(fit_dataset, (imp_model_folder, dataset, references[dataset["pixel"]], logspace, None, cache_folder,
+                               multistart, loss, weighting))
+                for dataset in datasets]
+        job_datasets = [[dataset] for dataset in datasets]
+
+    def failed_job(i, error):
+        for dataset in job_datasets[i]:
+            print(f"Worker failed on {dataset['folder']}: {error}")
+        return [failed_row(dataset, references[dataset["pixel"]]) for dataset in job_datasets[i]]
+
+    job_rows = [None] * len(jobs)
+    pending = list(range(len(jobs)))
+    isolate = False
+    while pending:
+        #a worker which dies (e.g. killed for memory) takes the pool down and every unfinished job raises
+        #BrokenProcessPool. The unfinished jobs are then run again one at a time, so the job killing its worker
+        #is the first unfinished one and only it fails, then the rest go back to the full pool
+        broken = []
+        #workers profile their fits if this process does
+        with ProcessPoolExecutor(max_workers=1 if isolate else workers, initializer=enable,
+                                 initargs=(is_enabled(),)) as executor:
+            futures = [executor.submit(jobs[i][0], *jobs[i][1]) for i in pending]
+            #fit_dataset catches fitting errors itself, this catches workers which crash outright
+            for i, future in zip(pending, futures):
+                try:
+                    result = future.result()
+                    job_rows[i] = result if per_pixel else [result]
+                except BrokenProcessPool as error:
+                    broken.append((i, error))
+                except Exception as error:
+                    job_rows[i] = failed_job(i, error)
+        if broken and isolate:
+            job_rows[broken[0][0]] = failed_job(*broken[0])
+        isolate = bool(broken) and not isolate
+        pending = [i for i in pending if job_rows[i] is None]
+        if pending:
+            print(f"Worker process died, fitting the {len(pending)} unfinished jobs again")
+    return [row for rows in job_rows for row in rows]
+
+def results_table(rows, param_names):
+    """
+    Converts result rows to a single table
+    Args:
+        rows (list): rows from fit_dataset
+        param_names (list): parameter names from Initial_params.csv
+    Returns:
+        pandas DataFrame with one row per dataset and one column per parameter, followed by a
+        <parameter>_stderr column per parameter, in the parameter's units (see Uncertainty.linear_stderr)
+    """
+    import pandas as pd
+
+    array_keys = ["params", "stderr", "correlation", "log_params", "profile"]
+    table = []
+    for row in rows:
+        entry = {key: value for key, value in row.items() if key not in array_keys}
+        for i, param_name in enumerate(param_names):
+            entry[param_name] = row["params"][i] if row["params"] is not None else np.nan
+        stderr = np.full(len(param_names), np.nan)
+        if row.get("stderr") is not None:
+            stderr = linear_stderr(row["params"], row["stderr"], row["log_params"])
+        for i, param_name in enumerate(param_names):
+            entry[param_name + "_stderr"] = stderr[i]
+        table.append(entry)
+    return pd.DataFrame(table)
+
+def uncertainty_arrays(rows, n_params):
+    """
+    Stacks the fitted parameters and their uncertainties of every row into arrays, for np.savez
+    Args:
+        rows (list): rows from fit_dataset
+        n_params (int): number of model parameters
+    Returns:
+        arrays (dict): 'folder' (S,), 'params' (S, P), 'stderr' (S, P), 'log_params' (S, P) and
+        'correlation' (S, P, P, float32). Rows without a fit or uncertainties (e.g. joint fits) are nan
+    """
+    S = len(rows)
+    arrays = {
+        "folder": np.array([row["folder"] for row in rows]),
+        "params": np.full((S, n_params), np.nan),
+        "stderr": np.full((S, n_params), np.nan),
+        "log_params": np.zeros((S, n_params), dtype=bool),
+        "correlation": np.full((S, n_params, n_params), np.nan, dtype=np.float32),
+    }
+    for i, row in enumerate(rows):
+        if row["params"] is not None:
+            arrays["params"][i] = row["params"]
+        if row.get("stderr") is not None:
+            arrays["stderr"][i] = row["stderr"]
+            arrays["log_params"][i] = row["log_params"]
+            arrays["correlation"][i] = row["correlation"]
+    return arrays
+
+def figure_filename(dataset, figures_folder, file_format="png"):
+    """
+    Image file of a dataset's figure, figures_folder/<pixel>/<measurement folder>.<file_format>
+    """
+    return os.path.join(figures_folder, dataset["pixel"], os.path.basename(dataset["folder"]) + "." + file_format)
+
+def render_dataset(imp_model_folder, dataset, row, figures_folder, file_format="png"):
+    """
+    Renders a fitted dataset to an image file without opening any windows
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model
+        dataset (dict): dataset which was fitted
+        row (dict): results row of the dataset from fit_dataset, failed fits are drawn without a model curve
+        figures_folder (string): folder to write figures to
+        file_format (string): image format, e.g. png or svg
+    Returns:
+        filename (string or None): file written, None if the dataset could not be rendered
+    """
+    #matplotlib is only loaded when figures are rendered
+    from graphics.Batch_render import render_fit
+
+    model = get_model(imp_model_folder)
+    filename = figure_filename(dataset, figures_folder, file_format)
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        bias_voltage = "" if row["bias_voltage"] is None else f", OCP {row['bias_voltage']:.3f} V"
+        cost = "" if row["cost"] is None else f", cost {row['cost']:.3g}"
+        render_fit(filename, model.Z, load_spectrum(dataset), row["params"],
+                   f"{dataset['pixel']} {os.path.basename(dataset['folder'])}{bias_voltage}{cost}")
+    except Exception as error:
+        print(f"Unable to render {dataset['folder']}: {error}")
+        return None
+    return filename
+
+def render_figures(imp_model_folder, datasets, rows, figures_folder, file_format="png", workers=1):
+    """
+    Renders every fitted dataset, optionally across a pool of worker processes
+    Each worker draws into one reused figure, datasets are handed out in chunks so the figure is reused
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model
+        datasets (list): datasets which were fitted
+        rows (list): results rows, matched to datasets by folder
+        figures_folder (string): folder to write figures to
+        file_format (string): image format, e.g. png or svg
+        workers (int): number of worker processes, 1 renders in this process
+    Returns:
+        filenames (list): files written
+    """
+    rows_by_folder = {row["folder"]: row for row in rows}
+    jobs = [(dataset, rows_by_folder[dataset["folder"]]) for dataset in datasets if dataset["folder"] in rows_by_folder]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            filenames = list(executor.map(render_dataset, [imp_model_folder] * len(jobs), [job[0] for job in jobs],
+                                          [job[1] for job in jobs], [figures_folder] * len(jobs),
+                                          [file_format] * len(jobs), chunksize=max(1, len(jobs) // (4 * workers))))
+    else:
+        filenames = [render_dataset(imp_model_folder, dataset, row, figures_folder, file_format) for dataset, row in jobs]
+    return [filename for filename in filenames if filename is not None]
+
+def batch_fitting(imp_model_folder, root, outfile="batch_results.csv", workers=1, logspace=False, sweep=False,
+                  joint=False, cache_folder=DEFAULT_CACHE_FOLDER, figures_folder=None, figure_format="png", multistart=0,
+                  profile=False, loss="linear", weighting="unit"):
+    """
+    Fits every dataset under root and writes one consolidated results table
+    Args:
+        imp_model_folder (string): name of folder containing a built-in impedance model
+        root (string): folder to search for datasets, or a spectrum store
+        outfile (string): name of csv file to write the results to. The parameter uncertainties and correlation
+                          matrices are also written to <outfile>_uncertainty.npz, see uncertainty_arrays
+        workers (int): number of worker processes, 1 fits in this process, 0 uses every cpu core
+        logspace (boolean): Whether to fit the logarithmic parameters in log space, see fit_leastsq
+        sweep (boolean): Whether to warm start each pixel's fits along its bias sweep, see fit_sweep
+        joint (boolean): Whether to fit each pixel's datasets in one joint fit with shared parameters, see fit_pixel_global
+        cache_folder (string or None): folder of the fit cache, None disables the cache
+        figures_folder (string or None): folder to render a figure of every fit to, None renders no figures
+        figure_format (string): image format of the figures, e.g. png or svg
+        multistart (int): number of starts of a multi-start fit for each dataset, 0 fits from the single
+                          guessed (or warm) starting point, see fit_leastsq. Not supported by joint fits
+        profile (boolean): Whether to record counters and timers of every fit, see curve_fitting/Instrumentation.py.
+                           The aggregated report is printed and written next to outfile as <outfile>_profile.json.
+                           Joint fits are not profiled
+        loss (string): 'linear' least squares, or a robust loss down-weighting outlying points, see fit_leastsq.
+                       Not supported by joint fits
+        weighting (string): weights of the residuals, e.g. 'modulus' so every decade of frequency counts rather than
+                            only the high impedance points, see fit_leastsq. Not supported by joint fits
+    Returns:
+        pandas DataFrame of results, also written to outfile, or None if nothing could be fitted
+        or joint is combined with options joint fits do not support (logspace, multistart, loss, weighting)
+    """
+    if joint:
+        unsupported = [name for name, used in [("logspace", logspace), ("multistart", multistart),
+                                               ("loss", loss != "linear"), ("weighting", weighting != "unit")] if used]
+        if len(unsupported) != 0:
+            print(f"Joint fits do not support: {', '.join(unsupported)}")
+            return None
+
+    #instrumentation is turned off again when batch fitting returns or raises
+    with profiling(profile):
+        return run_batch_fitting(imp_model_folder, root, outfile, workers, logspace, sweep, joint, cache_folder,
+                                 figures_folder, figure_format, multistart, loss, weighting)
+
+def run_batch_fitting(imp_model_folder, root, outfile, workers, logspace, sweep, joint, cache_folder, figures_folder,
+                      figure_format, multistart, loss, weighting):
+    """
+    Body of batch_fitting, see it for the arguments and return value. Profiles the fits if instrumentation is enabled
+    """
+    model = get_model(imp_model_folder)
+    if model is None:
+        return None
+    if not model.supported:
+        print(f"Unsupported model: {imp_model_folder}, batch fitting only works for models with a guesser, see Model_registry.py")
+        return None
+    param_names = model.param_names
+
+    datasets = find_datasets(root)
+    if len(datasets) == 0:
+        print(f"No impedance data found under: {root}")
+        return None
+    references = reference_datasets(datasets)
+
+    if workers == 0:
+        workers = os.cpu_count()
+
+    start = time.perf_counter()
+    if workers > 1:
+        rows = fit_datasets_parallel(imp_model_folder, datasets, references, workers, logspace=logspace, sweep=sweep,
+                                     joint=joint, cache_folder=cache_folder, multistart=multistart,
+                                     loss=loss, weighting=weighting)
+    elif sweep or joint:
+        rows = []
+        for pixel, pixel_datasets in group_by_pixel(datasets).items():
+            rows.extend(fit_pixel(imp_model_folder, pixel_datasets, references[pixel], logspace=logspace, joint=joint,
+                                  cache_folder=cache_folder, multistart=multistart, loss=loss, weighting=weighting))
+    else:
+        rows = [fit_dataset(imp_model_folder, dataset, references[dataset["pixel"]], logspace=logspace,
+                            cache_folder=cache_folder, multistart=multistart, loss=loss, weighting=weighting)
+                for dataset in datasets]
+    elapsed = time.perf_counter() - start
+
+    results = results_table(rows, param_names)
+    results.to_csv(outfile, index=False)
+    #full correlation matrices don't fit in the table
+    uncertainty_filename = os.path.splitext(outfile)[0] + "_uncertainty.npz"
+    np.savez_compressed(uncertainty_filename, param_names=np.array(param_names),
+                        **uncertainty_arrays(rows, len(param_names)))
+
+    n_failed = sum(row["status"] == "error" for row in rows)
+    n_bound = sum(row["status"] == "bound" for row in rows)
+    print(f"Fitted {len(rows)} spectra ({n_failed} failed, {n_bound} on a bound) in {elapsed:.2f}s: "
+          f"{len(rows)/elapsed:.1f} spectra/s")
+    print(f"Results written to {outfile} and {uncertainty_filename}")
+
+    if is_enabled():
+        report = aggregate([row["profile"] for row in rows])
+        print_report(report)
+        profile_filename = os.path.splitext(outfile)[0] + "_profile.json"
+        with open(profile_filename, "w") as file:
+            json.dump(report, file, indent=1)
+        print(f"Profile written to {profile_filename}")
+
+    if figures_folder is not None:
+        start = time.perf_counter()
+        filenames = render_figures(imp_model_folder, datasets, rows, figures_folder, figure_format, workers)
+        elapsed = time.perf_counter() - start
+        print(f"Rendered {len(filenames)} figures to {figures_folder} in {elapsed:.2f}s")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit every impedance dataset under a folder without user interaction")
+    parser.add_argument("model", help="folder containing the impedance model, e.g. builtin_models/nanoparticles_model")
+    parser.add_argument("root", help="folder to search for datasets, e.g. test_data/008Pixel7, or a spectrum store")
+    parser.add_argument("-o", "--output", default="batch_results.csv", help="csv file to write the results to")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="number of worker processes, 0 uses every cpu core")
+    parser.add_argument("--log", action="store_true", help="fit the parameters marked 'log' in Initial_params.csv in log space")
+    parser.add_argument("--sweep", action="store_true", help="start each fit from the previous bias voltage's fitted parameters")
+    parser.add_argument("--joint", action="store_true", help="fit each pixel's datasets together, sharing C_g, C_ion, R_ion, R_s and R_sh")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_FOLDER, help="folder of the fit cache")
+    parser.add_argument("--no-cache", action="store_true", help="refit every dataset instead of reusing cached fits")
+    parser.add_argument("--figures", default=None, help="folder to render a figure of every fit to")
+    parser.add_argument("--format", default="png", help="image format of the figures, e.g. png or svg")
+    parser.add_argument("--profile", action="store_true", help="count model evaluations and time each stage of every fit")
+    parser.add_argument("--multistart", type=int, default=0, help="fit each dataset from this many starts around the guess and keep the best")
+    parser.add_argument("--loss", default="linear", choices=LOSSES, help="loss of the fits, robust losses down-weight outlying points")
+    #the data files have no variance columns, so variance weighting is only available through fit_leastsq
+    parser.add_argument("--weighting", default="unit", choices=[weighting for weighting in WEIGHTINGS if weighting != "variance"],
+                        help="weights of the residuals, modulus weights every point by 1/|Z|")
+    args = parser.parse_args()
+
+    batch_fitting(args.model, args.root, args.output, workers=args.workers, logspace=args.log, sweep=args.sweep,
+                  joint=args.joint, cache_folder=None if args.no_cache else args.cache, figures_folder=args.figures,
+                  figure_format=args.format, multistart=args.multistart,
+                  profile=args.profile, loss=args.loss, weighting=args.weighting)
@@ -0,0 +1,323 @@
+"""
+Benchmarks model evaluation, feature finding, guessing and fitting
+on the bundled test data and on synthetic large spectra
+Results are written as json and compared against a stored baseline
+
+Run from the repository folder:
+    python -m benchmarks.Benchmark
+    python -m benchmarks.Benchmark --save-baseline
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from curve_fitting.Model_registry import get_model
+from curve_fitting.Curve_fitting import fit_leastsq
+from curve_fitting.Guesser import param_guesser, param_guesser_batch
+from curve_fitting.Batch_finder import stack_spectra
+from curve_fitting.FinderInterface import Interface
+from curve_fitting.Param_sweep import evaluate_Z_grid
+from curve_fitting.Compiled_model import compile_model
+from curve_fitting import Instrumentation
+from benchmarks.Import_budget import import_results
+
+BASELINE_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+#bundled spectra known to work with the Finder heuristics
+DATASETS = {
+    "single_transistor_model": {
+        "datafile": "test_data/nyquist.txt",
+        "nobias_datafile": "test_data/nyquist_dark.txt",
+        "IVfile": "test_data/Pixel5ControlLightForwardsweep/CVafter.txt",
+        "bias_voltage": 1.023,
+    },
+    "nanoparticles_model": {
+        "datafile": "test_data/nyquist2.txt",
+        "nobias_datafile": "test_data/nyquist2_dark.txt",
+        "IVfile": "test_data/Pixel1NanoparticlesLightForwardsweep/CVafter.txt",
+        "bias_voltage": 1.023,
+    },
+}
+
+#built-in initial parameters, used for the synthetic spectra
+INIT_PARAMS = [4.2, 1.14e-7, 0.00543, 8925, 4.1302114835e-21, 1, 2.31e-16, 1.023, 13.4, 1e4, 2.3, 3.3e-5]
+
+def time_function(function, repeats, min_time=0.0):
+    """
+    Times repeated calls of a function
+    Args:
+        function (function): function with no arguments to time
+        repeats (int): minimum number of timed calls
+        min_time (float): keep calling until at least this many seconds have passed
+    Returns:
+        times (array): duration of every call in seconds
+    """
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeats or time.perf_counter() - start < min_time:
+        call_start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - call_start)
+    return np.array(times)
+
+def peak_memory(function):
+    """
+    Peak memory allocated by python objects during one call of function
+    Measured separately from the timings since tracemalloc slows everything down
+    Args:
+        function (function): function with no arguments
+    Returns:
+        Peak allocated memory in bytes
+    """
+    tracemalloc.start()
+    try:
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def count_evaluations(function):
+    """
+    Z evaluations of one call, counted by the fits' instrumentation (see curve_fitting/Instrumentation.py)
+    rather than by wrapping Z, so the fit still sees the model's BoundZ
+    Args:
+        function (function): function with no arguments
+    Returns:
+        evaluations (int): the 'Z_evaluations' count of the call
+    """
+    with Instrumentation.profiling(), Instrumentation.record() as profile:
+        function()
+    return profile["counts"].get("Z_evaluations", 0)
+
+def run_benchmark(name, function, repeats, min_time=0.0, count=False):
+    """
+    Times a function and measures its peak memory
+    Args:
+        name (string): name of benchmark
+        function (function): function with no arguments to benchmark
+        repeats (int): minimum number of timed calls
+        min_time (float): keep calling until at least this many seconds have passed
+        count (boolean): whether to report the Z evaluations of a call, see count_evaluations
+    Returns:
+        result (dict): 'name', 'median_s', 'p95_s', 'calls', 'peak_memory_bytes' and 'evaluations'
+    """
+    function() #warm up, e.g. compiled kernels
+    evaluations = count_evaluations(function) if count else None
+
+    times = time_function(function, repeats, min_time)
+    result = {
+        "name": name,
+        "median_s": float(np.median(times)),
+        "p95_s": float(np.percentile(times, 95)),
+        "calls": len(times),
+        "peak_memory_bytes": peak_memory(function),
+        "evaluations": evaluations,
+    }
+    print(f"{name:<45} median {result['median_s']*1e3:9.3f} ms  p95 {result['p95_s']*1e3:9.3f} ms"
+          + (f"  {evaluations} Z evaluations" if evaluations is not None else ""))
+    return result
+
+def load_benchmark_data(dataset):
+    """
+    Loads one of the bundled datasets
+    Args:
+        dataset (dict): entry of DATASETS
+    Returns:
+        bias_data, nobias_data, IV_data (arrays)
+    """
+    bias_data = np.loadtxt(dataset["datafile"], skiprows=1)
+    nobias_data = np.loadtxt(dataset["nobias_datafile"], skiprows=1)
+    IV_data = np.loadtxt(dataset["IVfile"], skiprows=1)
+    return bias_data, nobias_data, IV_data
+
+def resample_spectrum(data, N):
+    """
+    Interpolates a measured spectrum onto N log-spaced frequencies,
+    keeping the features the Finder looks for
+    Args:
+        data (array): Impedance data, columns index, frequency, Z', -Z''
+        N (int): number of frequencies
+    Returns:
+        Resampled impedance data with the same columns
+    """
+    order = np.argsort(data[:,1])
+    log_freq = np.log10(data[order,1])
+    log_freq_new = np.linspace(log_freq[0], log_freq[-1], N)[::-1] #measured data runs from high to low frequency
+    return np.column_stack([np.arange(N), 10**log_freq_new,
+                            np.interp(log_freq_new, log_freq, data[order,2]),
+                            np.interp(log_freq_new, log_freq, data[order,3])])
+
+def run_all(quick=False):
+    """
+    Runs every benchmark
+    Args:
+        quick (boolean): Fewer repeats, for a fast check
+    Returns:
+        results (list): list of result dictionaries from run_benchmark
+        backends (dict): model name -> impedance function backend, 'numpy' or 'numba'
+        backend_checks (dict): model name -> whether the model's compiled kernel and BoundZ agree with its numpy Z,
+                               and the largest relative error of each, see curve_fitting/Numba_kernels.py
+    """
+    repeats = 5 if quick else 20
+    min_time = 0.0 if quick else 0.5
+    results = []
+    backends = {}
+    backend_checks = {}
+
+    for model_name, dataset in DATASETS.items():
+        model_folder = os.path.join("builtin_models", model_name)
+        impedance_model = get_model(model_folder)
+        Z, dZ, nano = impedance_model.Z, impedance_model.dZ, impedance_model.nano
+        passed, errors = impedance_model.module.check_backends()
+        backend_checks[model_name] = {"passed": passed, **errors}
+        if not passed:
+            print(f"{model_name}: backends disagree with Z_numpy, relative errors {errors}")
+        backends[model_name] = impedance_model.module.kernel_backend.backend
+        bias_data, nobias_data, IV_data = load_benchmark_data(dataset)
+        bias_voltage = dataset["bias_voltage"]
+        params = INIT_PARAMS[:12 if nano else 10]
+
+        #model evaluation on measured and synthetic frequencies
+        w_data = bias_data[:,1]
+        results.append(run_benchmark(f"{model_name}/Z/data_N{len(w_data)}",
+                                     lambda: Z(w_data, *params), repeats, min_time))
+        #the same evaluation bound to the frequencies and fixed V, as fit_leastsq uses it
+        model = compile_model(Z, w_data, len(params), [7], [bias_voltage], dZ=dZ, bound_Z=impedance_model.bound_Z)
+        free_params = np.take(params, model.free_indices)
+        results.append(run_benchmark(f"{model_name}/Z/compiled_N{len(w_data)}",
+                                     lambda: model.evaluate(free_params), repeats, min_time))
+        for N in [1000, 100000]:
+            w_synthetic = np.logspace(-2, 6, N)
+            results.append(run_benchmark(f"{model_name}/Z/synthetic_N{N}",
+                                         lambda: Z(w_synthetic, *params), repeats, min_time))
+        param_sets = np.array(params) * 10 ** np.random.default_rng(0).uniform(-1, 1, size=(10000, len(params)))
+        results.append(run_benchmark(f"{model_name}/Z/grid_M10000_N{len(w_data)}",
+                                     lambda: evaluate_Z_grid(Z, w_data, param_sets, vectorized=impedance_model.vectorized),
+                                     repeats, min_time))
+
+        #feature extraction and guessing, no checker windows
+        results.append(run_benchmark(f"{model_name}/Finder",
+                                     lambda: Interface(bias_data, nobias_data, IV_data, nanoparticle=nano, run_checker=False),
+                                     repeats, min_time))
+        results.append(run_benchmark(f"{model_name}/param_guesser",
+                                     lambda: param_guesser(bias_data, nobias_data, IV_data, bias_voltage, run_checker=False,
+                                                           bias=True, nanoparticles=nano),
+                                     repeats, min_time))
+        bias_stack = stack_spectra([bias_data] * 1000)
+        results.append(run_benchmark(f"{model_name}/param_guesser_batch/S1000",
+                                     lambda: param_guesser_batch(bias_stack, nobias_data, IV_data, bias_voltage, bias=True,
+                                                                 nanoparticles=nano),
+                                     repeats, min_time))
+
+        #full fits, on the measured spectrum and on the measured spectrum resampled to 1000 frequencies
+        bound_Z = impedance_model.bound_Z
+        fit = lambda data: fit_leastsq(Z, data, nobias_data, bias_voltage, IV_data, bias=True, nanoparticles=nano,
+                                       fixed_params_indices=[7], fixed_params_values=[bias_voltage], dZ=dZ,
+                                       bound_Z=bound_Z)
+        results.append(run_benchmark(f"{model_name}/fit_leastsq/data", lambda: fit(bias_data),
+                                     max(2, repeats // 4), count=True))
+
+        #the same fit with instrumentation on, the difference is the cost of profiling.
+        #Its own record hides the count from count_evaluations, the evaluations are those of the fit above
+        def profiled_fit():
+            with Instrumentation.record():
+                fit(bias_data)
+        with Instrumentation.profiling():
+            results.append(run_benchmark(f"{model_name}/fit_leastsq/data_profiled", profiled_fit,
+                                         max(2, repeats // 4)))
+
+        results.append(run_benchmark(f"{model_name}/fit_leastsq/multistart_64",
+                                     lambda: fit_leastsq(Z, bias_data, nobias_data, bias_voltage, IV_data, bias=True,
+                                                         nanoparticles=nano, fixed_params_indices=[7],
+                                                         fixed_params_values=[bias_voltage], dZ=dZ, multistart=64,
+                                                         init_paramfilename=os.path.join(model_folder, "Initial_params.csv"),
+                                                         vectorized=impedance_model.vectorized, bound_Z=bound_Z),
+                                     max(2, repeats // 4), count=True))
+
+        synthetic_data = resample_spectrum(bias_data, 1000)
+        results.append(run_benchmark(f"{model_name}/fit_leastsq/resampled_N1000", lambda: fit(synthetic_data),
+                                     max(2, repeats // 4), count=True))
+
+    #start up cost of the headless fitting modules, each imported in a fresh interpreter
+    results.extend(import_results(repeats=1 if quick else 3))
+    return results, backends, backend_checks
+
+def compare_to_baseline(results, baseline, tolerance=1.25, min_difference=5e-4):
+    """
+    Compares median times to a baseline
+    Args:
+        results (list): results from run_all
+        baseline (dict): baseline json with a 'results' list
+        tolerance (float): ratio of median times above which a benchmark counts as a regression
+        min_difference (float): slowdowns smaller than this many seconds are timer noise, not regressions
+    Returns:
+        regressions (list): (name, ratio) of every benchmark slower than tolerance times the baseline
+    """
+    baseline_medians = {result["name"]: result["median_s"] for result in baseline["results"]}
+    regressions = []
+
+    print(f"\n{'benchmark':<45} {'ratio to baseline':>18}")
+    for result in results:
+        if result["name"] not in baseline_medians:
+            continue
+        ratio = result["median_s"] / baseline_medians[result["name"]]
+        regression = ratio > tolerance and result["median_s"] - baseline_medians[result["name"]] > min_difference
+        flag = "  REGRESSION" if regression else ""
+        print(f"{result['name']:<45} {ratio:18.2f}{flag}")
+        if regression:
+            regressions.append((result["name"], ratio))
+    return regressions
+
+def environment():
+    """
+    Machine and library description stored with the results
+    """
+    import scipy
+    return {"python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__,
+            "machine": platform.machine(), "processor": platform.processor(), "cpu_count": os.cpu_count()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark model evaluation, guessing and fitting")
+    parser.add_argument("-o", "--output", default=None, help="json file to write the results to")
+    parser.add_argument("--baseline", default=BASELINE_FILENAME, help="baseline json file to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    parser.add_argument("--quick", action="store_true", help="fewer repeats")
+    args = parser.parse_args()
+
+    results, backends, backend_checks = run_all(quick=args.quick)
+    output = {"environment": environment(), "backends": backends, "backend_checks": backend_checks,
+              "results": results}
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(output, file, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(output, file, indent=2)
+        print(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(output["results"], json.load(file), args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) found")
+            sys.exit(1)
+    else:
+        print(f"No baseline found at {args.baseline}, run with --save-baseline to create one")
+
+    if not all(check["passed"] for check in backend_checks.values()):
+        print("Impedance function backends disagree, see backend_checks")
+        sys.exit(1)
@@ -0,0 +1,106 @@
+"""
+Checks that the headless fitting modules import quickly and without plotting or table libraries
+Every module is imported in a fresh interpreter with python -X importtime, so results do not
+depend on what this process has already loaded. Exits with status 1 if a module loads one of
+FORBIDDEN_MODULES or takes longer than the budget
+
+Run from the repository folder:
+    python -m benchmarks.Import_budget
+    python -m benchmarks.Import_budget --budget 0.5
+
+Timothy Chew
+18/10/26
+"""
+
+import sys
+import json
+import argparse
+import subprocess
+
+import numpy as np
+
+#modules on the headless fitting path
+MODULES = ["batch_main", "software_main", "curve_fitting.Curve_fitting", "curve_fitting.Global_fitting",
+           "curve_fitting.Fit_cache", "data_io.Spectrum_store"]
+
+#libraries only needed for interactive plotting, figures or printing tables
+FORBIDDEN_MODULES = ["matplotlib", "pandas", "tkinter", "tabulate"]
+
+#seconds, generous enough for slow machines, scipy.optimize alone takes ~0.4s
+DEFAULT_BUDGET = 1.5
+
+def import_once(module):
+    """
+    Imports a module in a fresh interpreter
+    Args:
+        module (string): dotted module name
+    Returns:
+        seconds (float): cumulative import time of the module reported by -X importtime
+        forbidden (list): entries of FORBIDDEN_MODULES which were loaded
+    """
+    code = (f"import sys, json, {module}; "
+            f"print(json.dumps([name for name in {FORBIDDEN_MODULES!r} if name in sys.modules]))")
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+
+    #lines are "import time: self [us] | cumulative | imported package", the module itself is not indented
+    seconds = None
+    for line in process.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].rstrip() == " " + module:
+            seconds = int(fields[1]) * 1e-6
+    return seconds, json.loads(process.stdout.strip().splitlines()[-1])
+
+def import_results(modules=MODULES, repeats=3):
+    """
+    Import time of every module, in the format of benchmarks.Benchmark results
+    Args:
+        modules (list): dotted module names
+        repeats (int): number of fresh interpreters per module, the median is reported
+    Returns:
+        results (list): dictionaries with 'name', 'median_s', 'p95_s', 'calls', 'forbidden'
+    """
+    results = []
+    for module in modules:
+        runs = [import_once(module) for i in range(repeats)]
+        times = np.array([seconds for seconds, forbidden in runs])
+        results.append({
+            "name": f"import/{module}",
+            "median_s": float(np.median(times)),
+            "p95_s": float(np.percentile(times, 95)),
+            "calls": repeats,
+            "forbidden": runs[-1][1],
+        })
+    return results
+
+def check_imports(results, budget=DEFAULT_BUDGET):
+    """
+    Prints import times and finds modules over budget or loading forbidden modules
+    Args:
+        results (list): results from import_results
+        budget (float): allowed median import time in seconds
+    Returns:
+        failures (list): (name, reason) of every failing module
+    """
+    failures = []
+    print(f"{'module':<45} {'median':>10}  forbidden modules loaded")
+    for result in results:
+        print(f"{result['name']:<45} {result['median_s']*1e3:7.1f} ms  {', '.join(result['forbidden'])}")
+        if result["forbidden"]:
+            failures.append((result["name"], f"loads {', '.join(result['forbidden'])}"))
+        if result["median_s"] > budget:
+            failures.append((result["name"], f"takes {result['median_s']:.2f}s, budget {budget:.2f}s"))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check import times of the headless fitting modules")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="allowed median import time in seconds")
+    parser.add_argument("--repeats", type=int, default=3, help="fresh interpreters per module")
+    args = parser.parse_args()
+
+    failures = check_imports(import_results(repeats=args.repeats), args.budget)
+    for name, reason in failures:
+        print(f"FAIL {name}: {reason}")
+    sys.exit(1 if failures else 0)
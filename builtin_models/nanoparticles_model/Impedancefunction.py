@@ -1,17 +1,25 @@
 """
 Function for impedance spectra when nanoparticles are added
+If numba is installed Z uses a compiled kernel, otherwise the numpy version
 
 Timothy Chew
 6/8/24
 """
 
 import numpy as np
-import scipy.special as sps
 import cmath
 import scipy.constants as spc
 
+#vectorized lambertw for the diode term
+from curve_fitting.Lambert_w import lambertw
+from curve_fitting.Numba_kernels import KernelBackend, build_cdiv, build_lambertw, check_backends as check_kernels
+
+#what the model supports, see curve_fitting/Model_registry.py
+CAPABILITIES = {"guesser": "nanoparticles", "jacobian": True, "vectorized": True}
+
+
 #impedance function
-def Z(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_nano):
+def Z_numpy(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_nano):
     """
     n: electron ideality factor (1-2)
     V: diode DC input
@@ -29,6 +37,181 @@ def Z(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_na
 
     rec_current = Js * np.exp( q/n_AB/kbt * ( 1 - C_ion/C_A ) * V)
 
-    Z_elec = 1 / ( rec_current * q/n_AB/kbt * (1 - Z_A/Z_ion) / ( 1 + sps.lambertw(rec_current * Z_nano * q/n_AB/kbt) ) )
+    Z_elec = 1 / ( rec_current * q/n_AB/kbt * (1 - Z_A/Z_ion) / ( 1 + lambertw(rec_current * Z_nano * q/n_AB/kbt) ) )
+
+    return 1 / (1/Z_elec + 1/Z_ion + 1/R_sh) + R_s
+
+def _build_kernel():
+    """
+    Compiles the numba kernel, the same formula as Z_numpy evaluated one frequency at a time
+    so no temporary arrays are made, lambertw is solved in the kernel using the same method as scipy
+    Returns:
+        Vectorized kernel with the same arguments as Z_numpy, raises if it can't be compiled
+    """
+    import numba
+
+    q = spc.elementary_charge
+    cdiv = build_cdiv()
+    lambertw = build_lambertw(cdiv)
+
+    @numba.vectorize([numba.complex128(*[numba.float64] * 13)])
+    def kernel(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_nano):
+        C_A = C_A_ratio * C_ion
+        a = q/n_AB/kbt
+        Z_nano = cdiv(1, 1/R_nano + 1j * w * C_nano)
+
+        Z_ion = cdiv(1, 1j * w * C_ion) + cdiv(1, 1j * w * C_g + 1/R_ion)
+        Z_A = cdiv(1, 1j * w * C_A)
+
+        rec_current = Js * np.exp( a * ( 1 - C_ion/C_A ) * V)
+
+        Y_elec = cdiv(rec_current * a * (1 - cdiv(Z_A, Z_ion)), 1 + lambertw(rec_current * Z_nano * a))
+        return cdiv(1, Y_elec + cdiv(1, Z_ion) + 1/R_sh) + R_s
+    return kernel
+
+#compiled on the first call to Z, set kernel_backend.backend = "numpy" to force the numpy version
+kernel_backend = KernelBackend(_build_kernel)
+
+def Z(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_nano):
+    """
+    Impedance function, uses the compiled kernel if numba is installed
+    Same arguments and return value as Z_numpy
+    """
+    kernel = kernel_backend.get_kernel()
+    if kernel is not None:
+        return kernel(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_nano)
+    return Z_numpy(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_nano)
+
+class BoundZ:
+    """
+    Z bound to a fixed frequency array, for fits which evaluate Z many times on the same frequencies
+    The frequency terms are computed once and Z is evaluated into preallocated buffers,
+    only lambertw makes arrays. See curve_fitting/Compiled_model.py
+    """
+    def __init__(self, w):
+        """
+        Args:
+            w (np array): angular frequencies, 1D
+        """
+        self.w = np.array(w, dtype=float)
+        self.jw = 1j * self.w
+        #1/(jw*C) = inv_jw / C
+        with np.errstate(divide="ignore"):
+            self.inv_jw = 1 / self.jw
+        self.Y_ion = np.empty_like(self.jw)
+        self.Y_elec = np.empty_like(self.jw)
+
+    def __call__(self, params, out):
+        """
+        Evaluates Z into out
+        Args:
+            params (list): the 12 parameters of Z
+            out (complex array): same shape as w, overwritten with Z(w, *params)
+        """
+        kernel = kernel_backend.get_kernel()
+        if kernel is not None:
+            kernel(self.w, *params, out=out)
+            return
+        C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_nano = params
+        q = spc.elementary_charge
+        C_A = C_A_ratio * C_ion
+        a = q/n_AB/kbt
+        rec_current = Js * np.exp( a * ( 1 - C_ion/C_A ) * V)
+
+        Y_ion = self.Y_ion
+        #Z_ion = 1/(jw*C_ion) + 1/(jw*C_g + 1/R_ion)
+        np.multiply(self.jw, C_g, out=Y_ion)
+        Y_ion += 1/R_ion
+        np.reciprocal(Y_ion, out=Y_ion)
+        np.multiply(self.inv_jw, 1/C_ion, out=out)
+        Y_ion += out
+        np.reciprocal(Y_ion, out=Y_ion)
+
+        #lambertw argument rec_current * a * Z_nano, Z_nano = 1/(1/R_nano + jw*C_nano)
+        np.multiply(self.jw, C_nano, out=out)
+        out += 1/R_nano
+        np.reciprocal(out, out=out)
+        out *= rec_current * a
+        W = lambertw(out)
+
+        #Y_elec = rec_current * a * (1 - Z_A/Z_ion) / (1 + W)
+        Y_elec = self.Y_elec
+        np.multiply(self.inv_jw, Y_ion, out=Y_elec)
+        Y_elec *= -rec_current * a / C_A
+        Y_elec += rec_current * a
+        W += 1
+        Y_elec /= W
+
+        np.add(Y_elec, Y_ion, out=out)
+        out += 1/R_sh
+        np.reciprocal(out, out=out)
+        out += R_s
+
+def check_backends(rtol=1e-12, n_samples=1000):
+    """
+    Checks the compiled kernel and BoundZ against Z_numpy over random parameter sets
+    within a decade of the built-in initial parameters, see curve_fitting/Numba_kernels.py
+    Args:
+        rtol (float): Maximum allowed relative error
+        n_samples (int): Number of random parameter sets
+    Returns:
+        True if the checked backends agree, and the largest relative error of each ('numba' is None if not checked)
+    """
+    init_params = np.array([4.2, 1.14e-7, 0.00543, 8925, 4.1302114835e-21, 1, 2.31e-16, 1.023, 13.4, 1e4, 2.3, 3.3e-5])
+    return check_kernels(Z_numpy, kernel_backend, BoundZ, init_params, rtol, n_samples)
+
+def dZ(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh, R_nano, C_nano):
+    """
+    Analytic derivatives of Z with respect to every parameter
+    Uses dZ/dp = -(Z - R_s)^2 * dY/dp where Y is the total admittance of the parallel branches
+    and dW/dx = W / (x * (1 + W)) for the lambert W function
+    Returns a complex array of shape (len(w), 12), column i is the derivative with respect to parameter i
+    """
+    C_A = C_A_ratio * C_ion
+
+    q = spc.elementary_charge
+    a = q/n_AB/kbt
+    jw = 1j * w
+    Z_nano = 1 / (1/R_nano + jw * C_nano)
+
+    B = jw * C_g + 1/R_ion
+    Z_ion = 1 / (jw * C_ion) + 1 / B
+    Y_ion = 1 / Z_ion
+    Z_A = 1 / (jw * C_A)
+    u = Z_A * Y_ion
+
+    rec_current = Js * np.exp( a * ( 1 - C_ion/C_A ) * V)
+    W = lambertw(rec_current * Z_nano * a)
+
+    P = a * rec_current * (1 - u)
+    Y_elec = P / (1 + W)
+    Z_par = 1 / (Y_elec + Y_ion + 1/R_sh)
+
+    #derivatives of the ionic admittance
+    dY_ion_dC_g = Y_ion**2 * jw / B**2
+    dY_ion_dC_ion = Y_ion**2 / (jw * C_ion**2)
+    dY_ion_dR_ion = -Y_ion**2 / (B**2 * R_ion**2)
+
+    #derivatives of the electronic admittance, given relative changes of a, rec_current and Z_nano
+    def dY_elec(da_a, drec_rec, dZnano_Znano, du):
+        dP = P * (da_a + drec_rec) - a * rec_current * du
+        dW = W / (1 + W) * (drec_rec + dZnano_Znano + da_a)
+        return dP / (1 + W) - Y_elec * dW / (1 + W)
+
+    dY_dC_A_ratio = dY_elec(0, a * V / C_A_ratio**2, 0, -u / C_A_ratio)
+    dY_dC_g = dY_elec(0, 0, 0, Z_A * dY_ion_dC_g) + dY_ion_dC_g
+    dY_dC_ion = dY_elec(0, 0, 0, -u / C_ion + Z_A * dY_ion_dC_ion) + dY_ion_dC_ion
+    dY_dR_ion = dY_elec(0, 0, 0, Z_A * dY_ion_dR_ion) + dY_ion_dR_ion
+    dY_dkbt = dY_elec(-1/kbt, -a/kbt * (1 - 1/C_A_ratio) * V, 0, 0)
+    dY_dn_AB = dY_elec(-1/n_AB, -a/n_AB * (1 - 1/C_A_ratio) * V, 0, 0)
+    dY_dJs = dY_elec(0, 1/Js, 0, 0)
+    dY_dV = dY_elec(0, a * (1 - 1/C_A_ratio), 0, 0)
+    dY_dR_sh = -1/R_sh**2 * np.ones_like(Z_par)
+    dY_dR_nano = dY_elec(0, 0, Z_nano / R_nano**2, 0)
+    dY_dC_nano = dY_elec(0, 0, -jw * Z_nano, 0)
 
-    return 1 / (1/Z_elec + 1/Z_ion + 1/R_sh) + R_s
\ No newline at end of file
+    dY = np.stack(np.broadcast_arrays(dY_dC_A_ratio, dY_dC_g, dY_dC_ion, dY_dR_ion, dY_dkbt, dY_dn_AB,
+                                      dY_dJs, dY_dV, np.zeros_like(Z_par), dY_dR_sh, dY_dR_nano, dY_dC_nano), axis=-1)
+    jacobian = -Z_par[..., np.newaxis]**2 * dY
+    jacobian[..., 8] = 1
+    return jacobian
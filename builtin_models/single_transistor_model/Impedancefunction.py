@@ -1,5 +1,6 @@
 """
 Function for simple 1 transistor model impedance spectra for a perovskite solar cell
+If numba is installed Z uses a compiled kernel, otherwise the numpy version
 
 Timothy Chew
 6/8/2024
@@ -9,7 +10,12 @@ import numpy as np
 import cmath
 import scipy.constants as spc
 
-def Z(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh):
+from curve_fitting.Numba_kernels import KernelBackend, build_cdiv, check_backends as check_kernels
+
+#what the model supports, see curve_fitting/Model_registry.py
+CAPABILITIES = {"guesser": "single_transistor", "jacobian": True, "vectorized": True}
+
+def Z_numpy(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh):
     """
     Impedance response function to a voltage steady state and small perturbation
     with frequency w
@@ -39,3 +45,169 @@ def Z(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh):
     Z_elec = 1 / (rec_current * q/n_AB/kbt * (1 - Z_A/Z_ion) + gen_current * q/n_AB/kbt * Z_A/Z_ion)
 
     return 1 / (1/Z_elec + 1/Z_ion + 1/R_sh) + R_s
+
+def _build_kernel():
+    """
+    Compiles the numba kernel, the same formula as Z_numpy evaluated one frequency at a time
+    so no temporary arrays are made
+    Returns:
+        Vectorized kernel with the same arguments as Z_numpy, raises if it can't be compiled
+    """
+    import numba
+
+    q = spc.elementary_charge
+    cdiv = build_cdiv()
+
+    @numba.vectorize([numba.complex128(*[numba.float64] * 11)])
+    def kernel(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh):
+        C_A = C_A_ratio * C_ion
+        a = q/n_AB/kbt
+        Z_ion = cdiv(1, 1j * w * C_ion) + cdiv(1, 1j * w * C_g + 1/R_ion)
+        Z_A = cdiv(1, 1j * w * C_A)
+
+        rec_current = Js * np.exp( a * ( 1 - C_ion/C_A ) * V)
+        gen_current = Js * np.exp( -a * C_ion/C_A * V)
+
+        ratio = cdiv(Z_A, Z_ion)
+        Y_elec = rec_current * a * (1 - ratio) + gen_current * a * ratio
+        return cdiv(1, Y_elec + cdiv(1, Z_ion) + 1/R_sh) + R_s
+    return kernel
+
+#compiled on the first call to Z, set kernel_backend.backend = "numpy" to force the numpy version
+kernel_backend = KernelBackend(_build_kernel)
+
+def Z(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh):
+    """
+    Impedance response function, uses the compiled kernel if numba is installed
+    Same arguments and return value as Z_numpy
+    """
+    kernel = kernel_backend.get_kernel()
+    if kernel is not None:
+        return kernel(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh)
+    return Z_numpy(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh)
+
+class BoundZ:
+    """
+    Z bound to a fixed frequency array, for fits which evaluate Z many times on the same frequencies
+    The frequency terms are computed once and Z is evaluated into preallocated buffers, so a call
+    makes no arrays. See curve_fitting/Compiled_model.py
+    """
+    def __init__(self, w):
+        """
+        Args:
+            w (np array): angular frequencies, 1D
+        """
+        self.w = np.array(w, dtype=float)
+        self.jw = 1j * self.w
+        #1/(jw*C) = inv_jw / C
+        with np.errstate(divide="ignore"):
+            self.inv_jw = 1 / self.jw
+        self.buffer = np.empty_like(self.jw)
+
+    def __call__(self, params, out):
+        """
+        Evaluates Z into out
+        Args:
+            params (list): the 10 parameters of Z
+            out (complex array): same shape as w, overwritten with Z(w, *params)
+        """
+        kernel = kernel_backend.get_kernel()
+        if kernel is not None:
+            kernel(self.w, *params, out=out)
+            return
+        C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh = params
+        q = spc.elementary_charge
+        C_A = C_A_ratio * C_ion
+        a = q/n_AB/kbt
+        rec_current = Js * np.exp( a * ( 1 - C_ion/C_A ) * V)
+        gen_current = Js * np.exp( -a * C_ion/C_A * V)
+
+        Y_ion = self.buffer
+        #Z_ion = 1/(jw*C_ion) + 1/(jw*C_g + 1/R_ion)
+        np.multiply(self.jw, C_g, out=Y_ion)
+        Y_ion += 1/R_ion
+        np.reciprocal(Y_ion, out=Y_ion)
+        np.multiply(self.inv_jw, 1/C_ion, out=out)
+        Y_ion += out
+        np.reciprocal(Y_ion, out=Y_ion)
+
+        #Y_elec = a * (rec_current + (gen_current - rec_current) * Z_A/Z_ion), built up in out
+        np.multiply(self.inv_jw, Y_ion, out=out)
+        out *= a * (gen_current - rec_current) / C_A
+        out += a * rec_current
+
+        out += Y_ion
+        out += 1/R_sh
+        np.reciprocal(out, out=out)
+        out += R_s
+
+def check_backends(rtol=1e-12, n_samples=1000):
+    """
+    Checks the compiled kernel and BoundZ against Z_numpy over random parameter sets
+    within a decade of the built-in initial parameters, see curve_fitting/Numba_kernels.py
+    Args:
+        rtol (float): Maximum allowed relative error
+        n_samples (int): Number of random parameter sets
+    Returns:
+        True if the checked backends agree, and the largest relative error of each ('numba' is None if not checked)
+    """
+    init_params = np.array([4.2, 1.14e-7, 0.00543, 8925, 4.1302114835e-21, 1, 2.31e-16, 1.023, 13.4, 1e4])
+    return check_kernels(Z_numpy, kernel_backend, BoundZ, init_params, rtol, n_samples)
+
+def dZ(w, C_A_ratio, C_g, C_ion, R_ion, kbt, n_AB, Js, V, R_s, R_sh):
+    """
+    Analytic derivatives of Z with respect to every parameter
+    Uses dZ/dp = -(Z - R_s)^2 * dY/dp where Y is the total admittance of the parallel branches
+
+    Args:
+        w(np array): angular frequency of voltage perturbation
+        Same parameters as Z
+    
+    Returns:
+        Complex array of shape (len(w), 10), column i is the derivative of Z with respect to parameter i
+    """
+    q = spc.elementary_charge
+    a = q/n_AB/kbt
+    C_A = C_A_ratio * C_ion
+    jw = 1j * w
+
+    B = jw * C_g + 1/R_ion
+    Z_ion = 1 / (jw * C_ion) + 1 / B
+    Y_ion = 1 / Z_ion
+    Z_A = 1 / (jw * C_A)
+    u = Z_A * Y_ion
+
+    rec_current = Js * np.exp( a * ( 1 - C_ion/C_A ) * V)
+    gen_current = Js * np.exp( -a * C_ion/C_A * V)
+
+    Y_elec = a * (rec_current + (gen_current - rec_current) * u)
+    Z_par = 1 / (Y_elec + Y_ion + 1/R_sh)
+
+    #derivatives of the ionic admittance
+    dY_ion_dC_g = Y_ion**2 * jw / B**2
+    dY_ion_dC_ion = Y_ion**2 / (jw * C_ion**2)
+    dY_ion_dR_ion = -Y_ion**2 / (B**2 * R_ion**2)
+
+    #derivatives of the electronic admittance
+    def dY_elec(da, drec, dgen, du):
+        return da/a * Y_elec + a * (drec + (dgen - drec) * u + (gen_current - rec_current) * du)
+
+    dY_dC_A_ratio = dY_elec(0, rec_current * a * V / C_A_ratio**2, gen_current * a * V / C_A_ratio**2, -u / C_A_ratio)
+    dY_dC_g = dY_elec(0, 0, 0, Z_A * dY_ion_dC_g) + dY_ion_dC_g
+    dY_dC_ion = dY_elec(0, 0, 0, -u / C_ion + Z_A * dY_ion_dC_ion) + dY_ion_dC_ion
+    dY_dR_ion = dY_elec(0, 0, 0, Z_A * dY_ion_dR_ion) + dY_ion_dR_ion
+
+    def dY_da(da):
+        return dY_elec(da, rec_current * (1 - 1/C_A_ratio) * V * da, -gen_current * V / C_A_ratio * da, 0)
+
+    dY_dkbt = dY_da(-a/kbt)
+    dY_dn_AB = dY_da(-a/n_AB)
+    dY_dJs = dY_elec(0, rec_current/Js, gen_current/Js, 0)
+    dY_dV = dY_elec(0, rec_current * a * (1 - 1/C_A_ratio), -gen_current * a / C_A_ratio, 0)
+    dY_dR_sh = -1/R_sh**2 * np.ones_like(Z_par)
+
+    dY = np.stack(np.broadcast_arrays(dY_dC_A_ratio, dY_dC_g, dY_dC_ion, dY_dR_ion, dY_dkbt,
+                                      dY_dn_AB, dY_dJs, dY_dV, np.zeros_like(Z_par), dY_dR_sh), axis=-1)
+    jacobian = -Z_par[..., np.newaxis]**2 * dY
+    jacobian[..., 8] = 1
+    return jacobian
@@ -0,0 +1,177 @@
+"""
+Vectorized version of the Finder features over a stack of spectra
+Spectra are stacked into arrays of shape (S spectra, N frequencies, columns) in the data file layout
+(index, frequency, Z', -Z''), all features of every spectrum are found at once and returned as arrays.
+Time constants are found as indices into the frequency axis rather than by comparing frequencies,
+and spectra whose features cannot be found get nan instead of raising
+
+Gives the same features as FinderInterface.Interface with run_checker=False
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+from curve_fitting.Finder import peak_mask
+
+#Rsh used when there is no IV data, same as FinderInterface
+DEFAULT_RSH = 1e6
+
+def stack_spectra(spectra):
+    """
+    Stacks spectra of equal length into one array
+    Args:
+        spectra (list): impedance data arrays of shape (N, columns)
+    Returns:
+        stack (array): shape (S, N, columns)
+    """
+    lengths = {len(data) for data in spectra}
+    if len(lengths) > 1:
+        raise ValueError(f"Spectra have different numbers of frequencies: {sorted(lengths)}, stack each length separately")
+    return np.stack([np.asarray(data, dtype=float) for data in spectra])
+
+def nth_peak(mask, n):
+    """
+    Index of the nth (from 0) peak of every row
+    Args:
+        mask (array): shape (S, N), from peak_mask
+        n (int): which peak
+    Returns:
+        index (array): shape (S,), 0 where the row has too few peaks
+        found (array): shape (S,), whether the row has an nth peak
+    """
+    hit = mask & (np.cumsum(mask, axis=-1) == n + 1)
+    return hit.argmax(axis=-1), hit.any(axis=-1)
+
+def take(x, index):
+    """
+    x[s, index[s]] for every row s
+    """
+    return np.take_along_axis(x, index[:, np.newaxis], axis=-1)[:, 0]
+
+def get_Rsh_IV(IV_stack, scan_range=150):
+    """
+    Shunt resistance of every IV curve, inverse gradient of the first scan_range points as in Finder.get_Rsh_IV
+    Args:
+        IV_stack (array): shape (S, K, columns), current in column 3 and voltage in column 4
+        scan_range (int): Initial "flat" portion of data where I = generated photocurrent
+    Returns:
+        Rsh (array): shape (S,)
+    """
+    I = IV_stack[:, :scan_range, 3]
+    V = IV_stack[:, :scan_range, 4]
+    I_centred = I - I.mean(axis=1, keepdims=True)
+    V_centred = V - V.mean(axis=1, keepdims=True)
+    return np.sum(I_centred * V_centred, axis=1) / np.sum(I_centred**2, axis=1)
+
+def get_tconstant_indices(Zreal, Zimag, bias=False):
+    """
+    Indices of the wg and wion time constants of every spectrum, see Finder.get_tconstants
+    Args:
+        Zreal, Zimag (array): shape (S, N)
+        bias (boolean): Whether the spectra were taken under bias
+    Returns:
+        wg_index, wion_index (array): shape (S,)
+        found (array): shape (S,), whether the time constants were found
+    """
+    phase_peaks = peak_mask(-np.arctan2(-Zimag, Zreal))
+    wg_index, found = nth_peak(phase_peaks, 0)
+    if bias:
+        wion_index, wion_found = nth_peak(phase_peaks, 1)
+        found &= wion_found
+    else:
+        wion_index = np.argmax(Zimag, axis=-1)
+    return wg_index, wion_index, found
+
+def get_Rs_alt(Zreal, Zimag):
+    """
+    Series resistance of every spectrum under bias, same expression as Finder.get_Rs_alt
+    """
+    grad = Zimag[:,1] - Zimag[:,0] / (Zreal[:,1] - Zreal[:,0])
+    return - Zimag[:,0] / grad + Zreal[:,0]
+
+def get_Rn(Zreal, Zimag, Rs):
+    """
+    Rn0 and Rninf of every spectrum under bias, same indices as Finder.get_Rn
+    Args:
+        Zreal, Zimag (array): shape (S, N)
+        Rs (array): shape (S,)
+    Returns:
+        Rn0, Rninf (array): shape (S,)
+        found (array): shape (S,), whether the features were found
+    """
+    S, N = Zreal.shape
+    index = np.arange(N)
+
+    #lowest point after the first loop's peak
+    peak_index, found = nth_peak(peak_mask(Zimag), 0)
+    after_peak = index > peak_index[:, np.newaxis]
+    found &= after_peak.any(axis=1)
+    #Finder.get_Rn offsets the minimum by -1 from the start of its search window, i.e. by -2 here
+    Rn0_index = np.argmin(np.where(after_peak, Zimag, np.inf), axis=1) - 2
+    Rn0 = take(Zreal, Rn0_index) - Rs
+
+    #first peak of Zreal between the first loop's peak and Rn0_index, values outside the window
+    #are set to inf so the window's ends cannot be peaks, as when searching the window on its own
+    window = after_peak & (index < Rn0_index[:, np.newaxis])
+    window_peak, window_found = nth_peak(peak_mask(np.where(window, Zreal, np.inf)), 0)
+    found &= window_found
+    #Finder.get_Rn indexes Zreal with the position of the peak within the window
+    Rninf = take(Zreal, window_peak - (peak_index + 1)) - Rs
+    return Rn0, Rninf, found
+
+def find_features(bias_stack, nobias_stack, IV_stack=None, nanoparticle=False):
+    """
+    Finds the graphical features of every spectrum in a stack, batch version of FinderInterface.Interface
+    Args:
+        bias_stack (array): shape (S, N, columns), impedance data taken under bias
+        nobias_stack (array): shape (S, M, columns), or (M, columns) if every spectrum shares one 0V reference
+        IV_stack (array or None): shape (S, K, columns) or (K, columns), Current-Voltage data.
+                                  If None Rsh starts at DEFAULT_RSH
+        nanoparticle (boolean): Whether to find the nanoparticle time constant
+    Returns:
+        features (dict): arrays of shape (S,) under 'Rion', 'Rsh', 'Rs', 'Rn0', 'Rninf', 'wg_bias', 'wg_nobias',
+        'wion_bias', 'wion_nobias' and 'wnano' (None if not nanoparticle), the frequency indices of the time
+        constants under 'wg_bias_index', 'wion_bias_index' and 'wnano_index', and 'found', False for spectra
+        whose features could not be found. Features of those spectra are nan
+    """
+    S = len(bias_stack)
+    nobias_stack = np.broadcast_to(nobias_stack, (S,) + np.shape(nobias_stack)[-2:])
+    bias_w, bias_real, bias_imag = bias_stack[:,:,1], bias_stack[:,:,2], bias_stack[:,:,3]
+    nobias_w, nobias_real, nobias_imag = nobias_stack[:,:,1], nobias_stack[:,:,2], nobias_stack[:,:,3]
+
+    if IV_stack is not None:
+        Rsh = get_Rsh_IV(np.broadcast_to(IV_stack, (S,) + np.shape(IV_stack)[-2:]))
+    else:
+        Rsh = np.full(S, DEFAULT_RSH)
+
+    wg_bias_index, wion_bias_index, found = get_tconstant_indices(bias_real, bias_imag, bias=True)
+    wg_nobias_index, wion_nobias_index, nobias_found = get_tconstant_indices(nobias_real, nobias_imag, bias=False)
+    found &= nobias_found
+
+    Rs = get_Rs_alt(bias_real, bias_imag)
+    Rn0, Rninf, Rn_found = get_Rn(bias_real, bias_imag, Rs)
+    found &= Rn_found
+
+    #low shunt: the semicircle is wider than the IV shunt, which is then taken as Rion (see Interface)
+    width = np.max(nobias_real, axis=1)
+    low_shunt = width > Rsh
+    Rion = np.where(low_shunt, Rsh, width)
+    Rsh = np.where(low_shunt, width, Rsh)
+
+    features = {
+        "Rion": Rion, "Rsh": Rsh, "Rs": Rs, "Rn0": Rn0, "Rninf": Rninf,
+        "wg_bias": take(bias_w, wg_bias_index), "wg_nobias": take(nobias_w, wg_nobias_index),
+        "wion_bias": take(bias_w, wion_bias_index), "wion_nobias": take(nobias_w, wion_nobias_index),
+        "wnano": None, "wg_bias_index": wg_bias_index, "wion_bias_index": wion_bias_index, "wnano_index": None,
+    }
+    if nanoparticle:
+        features["wnano_index"] = (wg_bias_index + wion_bias_index) // 2
+        features["wnano"] = take(bias_w, features["wnano_index"])
+
+    for name in ["Rion", "Rsh", "Rs", "Rn0", "Rninf", "wg_bias", "wg_nobias", "wion_bias", "wion_nobias", "wnano"]:
+        if features[name] is not None:
+            features[name] = np.where(found, features[name], np.nan)
+    features["found"] = found
+    return features
@@ -0,0 +1,134 @@
+"""
+Impedance models bound to the frequencies and fixed parameters of one fit
+During a fit w never changes and some parameters (e.g. V, index 7) are fixed, so the model is bound to them once:
+the parameter vector, the stacked real and imaginary output and the Jacobian are preallocated, and
+evaluate(free_params) only fills them in. Residual weights (see Weighting.py) are applied in place.
+Models can provide a BoundZ class next to Z (see the built-in models, ImpedanceModel.bound_Z), which precomputes
+the frequency terms and evaluates Z into a buffer. It is passed explicitly, without one Z is called and copied
+
+    model = compile_model(Z, w, len(params), fixed_indices=[7], fixed_values=[bias_voltage], dZ=dZ, bound_Z=BoundZ)
+    residuals = model.evaluate(free_params) - ydata
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+class CompiledModel:
+    """
+    Impedance model bound to a frequency array and a set of fixed parameters
+    Parameters are used as given, fits keep them >0 with bounds (see Curve_fitting.fit_free_params)
+    The arrays returned by evaluate and jacobian are overwritten by the next call, copy them to keep them
+    """
+    def __init__(self, Z, w, n_params, fixed_indices=(), fixed_values=(), dZ=None, bound_Z=None):
+        """
+        Args:
+            Z (function): Complex impedance function Z(w, *params)
+            w (array): Angular frequencies, 1D
+            n_params (int): Number of parameters of Z
+            fixed_indices (list): Indices of the fixed parameters
+            fixed_values (list): Values of the fixed parameters
+            dZ (function or None): Analytic derivatives of Z, see fit_leastsq. Needed for jacobian
+            bound_Z (object or None): Z bound to w, called as bound_Z(params, out) to write Z(w, *params) into out,
+                                      e.g. the model's BoundZ(w). If None Z is called and copied
+        """
+        self.Z = Z
+        self.dZ = dZ
+        self.w = np.array(w, dtype=float)
+        self.N = len(self.w)
+        self.n_params = n_params
+
+        self.fixed_indices = np.array(fixed_indices, dtype=int)
+        self.free_indices = np.setdiff1d(np.arange(n_params), self.fixed_indices)
+        self.params = np.ones(n_params)
+        self.params[self.fixed_indices] = np.array(fixed_values, dtype=float)
+
+        if bound_Z is None:
+            bound_Z = self.call_Z
+        self.bound_Z = bound_Z
+        self.Z_buffer = np.empty(self.N, dtype=complex)
+        self.output = np.empty(2 * self.N)
+        self.jacobian_output = np.empty((2 * self.N, len(self.free_indices)))
+        self.weights = None
+
+    def set_weights(self, weights):
+        """
+        Weights evaluate and jacobian are multiplied by, row by row
+        Args:
+            weights (array or None): shape (2N,), e.g. from Weighting.residual_weights. None for no weights
+        """
+        self.weights = None if weights is None else np.array(weights, dtype=float)
+
+    def call_Z(self, params, out):
+        """
+        Evaluates Z into out, for models without a BoundZ
+        """
+        out[:] = self.Z(self.w, *params)
+
+    def set_params(self, free_params):
+        """
+        Writes free_params into the full parameter vector
+        Returns:
+            params (list): all parameters, as numpy floats so that a 0 parameter gives inf rather than raising
+        """
+        self.params[self.free_indices] = free_params
+        return list(self.params)
+
+    def evaluate_Z(self, free_params):
+        """
+        Complex impedance at the free parameters
+        Returns:
+            Z_values (array): shape (N,), overwritten by the next call
+        """
+        self.bound_Z(self.set_params(free_params), self.Z_buffer)
+        return self.Z_buffer
+
+    def evaluate(self, free_params):
+        """
+        Stacked real and imaginary (-Z'') impedance at the free parameters, the layout of fit_leastsq's ydata
+        Args:
+            free_params (array): values of the parameters which are not fixed, in order
+        Returns:
+            output (array): shape (2N,), multiplied by the weights if set, overwritten by the next call
+        """
+        Z_values = self.evaluate_Z(free_params)
+        np.copyto(self.output[:self.N], Z_values.real)
+        np.negative(Z_values.imag, out=self.output[self.N:])
+        if self.weights is not None:
+            self.output *= self.weights
+        return self.output
+
+    def jacobian(self, free_params):
+        """
+        Derivatives of evaluate with respect to the free parameters
+        Args:
+            free_params (array): values of the parameters which are not fixed, in order
+        Returns:
+            jacobian (array): shape (2N, no. of free params), rows multiplied by the weights if set,
+            overwritten by the next call
+        """
+        dZ_val = self.dZ(self.w, *self.set_params(free_params))[:, self.free_indices]
+        np.copyto(self.jacobian_output[:self.N], dZ_val.real)
+        np.negative(dZ_val.imag, out=self.jacobian_output[self.N:])
+        if self.weights is not None:
+            self.jacobian_output *= self.weights[:, np.newaxis]
+        return self.jacobian_output
+
+def compile_model(Z, w, n_params, fixed_indices=(), fixed_values=(), dZ=None, bound_Z=None):
+    """
+    Binds Z to a frequency array and fixed parameters, using the model's BoundZ class if given
+    Args:
+        Z (function): Complex impedance function Z(w, *params)
+        w (array): Angular frequencies, 1D
+        n_params (int): Number of parameters of Z
+        fixed_indices (list): Indices of the fixed parameters
+        fixed_values (list): Values of the fixed parameters
+        dZ (function or None): Analytic derivatives of Z
+        bound_Z (class or None): the model's BoundZ class (ImpedanceModel.bound_Z), called as bound_Z(w).
+                                 It must compute the same Z. If None Z is called directly
+    Returns:
+        model (CompiledModel)
+    """
+    return CompiledModel(Z, w, n_params, fixed_indices, fixed_values, dZ=dZ,
+                         bound_Z=bound_Z(w) if bound_Z is not None else None)
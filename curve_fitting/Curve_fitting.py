@@ -6,16 +6,196 @@ Timothy Chew
 22/8/24
 """
 
+import os
+import csv
 import numpy as np
-from scipy.optimize import curve_fit
+from scipy.optimize import least_squares
 
 from curve_fitting.Guesser import param_guesser
+from curve_fitting.Multistart import fit_multistart
+from curve_fitting.Compiled_model import compile_model
+from curve_fitting.Instrumentation import count, set_value, timer
+from curve_fitting.Uncertainty import covariance_from_jacobian, standard_errors
+from curve_fitting.Loss import LOSSES, robust_cost, default_f_scale
+from curve_fitting.Weighting import WEIGHTINGS, residual_weights
 
+#parsed Initial_params.csv files, keyed by path and modification time so edited files are read again
+_param_settings = {}
+
+def read_param_settings(init_paramfilename):
+    """
+    Reads the parameter names, values and log flags from an Initial_params.csv file, parsing each file once
+    Args:
+        init_paramfilename (string): Filename of init_params.csv under model folder
+    Returns:
+        param_names (list): Names of the parameters
+        init_values (array): Initial values of the parameters
+        log_mask (array): Boolean array, True for parameters marked as logarithmic
+    """
+    param_names, init_values, slider_mask, log_mask = parse_param_file(init_paramfilename)
+    #copies, so callers can modify them
+    return list(param_names), init_values.copy(), log_mask.copy()
+
+def read_constant_mask(init_paramfilename):
+    """
+    Parameters without a slider in an Initial_params.csv file, e.g. kbt and n_0 of the built-in models.
+    These are physical constants rather than fit parameters: kbt and n_0 only enter the models as their product,
+    so the data cannot separate them, and fit_leastsq holds them at their Initial_params.csv values by default
+    Args:
+        init_paramfilename (string): Filename of init_params.csv under model folder
+    Returns:
+        constant_mask (array): Boolean array, True for parameters whose slider column is False
+    """
+    return ~parse_param_file(init_paramfilename)[2]
+
+def parse_param_file(init_paramfilename):
+    """
+    Parses an Initial_params.csv file, once per file and modification time
+    Returns:
+        (param_names, init_values, slider_mask, log_mask) tuple, shared by every caller so not to be modified
+    """
+    key = (os.path.abspath(init_paramfilename), os.path.getmtime(init_paramfilename))
+    if key not in _param_settings:
+        with open(init_paramfilename, newline="") as file:
+            rows = list(csv.reader(file))[1:]
+
+        param_names = [row[0] for row in rows]
+        init_values = np.array([float(row[1]) for row in rows])
+        slider_mask = np.array([row[2].strip() == "True" for row in rows])
+        log_mask = np.array([row[3].strip() == "True" for row in rows])
+        _param_settings[key] = (param_names, init_values, slider_mask, log_mask)
+    return _param_settings[key]
+
+def fit_free_params(model, ydata, free_guess, log_mask=None, lower=None, upper=np.inf, loss="linear",
+                    f_scale=1.0, max_nfev=None):
+    """
+    Trust region least squares fit of the free parameters of a bound model
+    Fixed parameters are held by the model (see Compiled_model.py), so the optimiser neither perturbs them
+    nor spends Jacobian columns on them. Residual weights set on the model (model.set_weights) are applied to
+    the model output and to ydata, which is weighted once here.
+    Parameters are kept >0 by bounds (linear parameters) or by fitting log10(parameter). Every fit uses the trust
+    region reflective method, which handles the bounds and the robust losses
+    Args:
+        model (CompiledModel): Model bound to the data frequencies and the fixed parameters
+        ydata (array): Stacked real and imaginary impedance data, unweighted
+        free_guess (array): Guess values of the free parameters, in the order of model.free_indices
+        log_mask (array or None): Boolean array over the free parameters, True to optimise log10(parameter).
+                                  If None every parameter is optimised linearly
+        lower, upper (array or float): Bounds of the optimised values, i.e. of log10(parameter) where log_mask is True.
+                                       lower=None bounds linear parameters below by 0 and leaves log10 parameters unbounded
+        loss (string): 'linear' for least squares, or a robust loss from Loss.LOSSES
+        f_scale (float): Weighted residuals larger than f_scale count as outliers under a robust loss
+        max_nfev (int or None): Maximum number of function evaluations, None uses the least_squares default
+                                (100 per free parameter with the trust region reflective method)
+    Returns:
+        free_params (array): Fitted free parameters, or free_guess if the fit did not converge
+        fit_info (dict): 'success', 'nfev', 'njev' (number of iterations) and 'message' from least_squares,
+        'at_bound' (boolean array over the free parameters, True where the fit ended on a bound) and 'covariance' of the optimised values (log10 of the log_mask parameters) from the final Jacobian.
+        Under a robust loss the covariance is the Gauss-Newton approximation of the robust cost, i.e. from the
+        loss-rescaled Jacobian and cost least_squares returns, so only approximate
+    """
+    free_guess = np.array(free_guess, dtype=float)
+    n_free = len(free_guess)
+    if log_mask is None:
+        log_mask = np.zeros(n_free, dtype=bool)
+    if lower is None:
+        lower = np.where(log_mask, -np.inf, 0)
+    lower = np.array(np.broadcast_to(lower, n_free), dtype=float)
+    upper = np.array(np.broadcast_to(upper, n_free), dtype=float)
+    if model.weights is not None:
+        ydata = ydata * model.weights
+
+    def to_params(x):
+        params = x.copy()
+        params[log_mask] = 10 ** x[log_mask]
+        return params
+
+    x0 = free_guess.copy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x0[log_mask] = np.log10(np.maximum(free_guess[log_mask], 10 ** lower[log_mask]))
+    x0 = np.clip(x0, lower, upper)
+
+    #parameters span ~25 orders of magnitude (kbt~4e-21, resistances up to ~1e16), so linear parameters are
+    #optimised relative to their starting values (log10 values are already of order 1) and steps are not
+    #rescaled further. Scaling by the jacobian column norms (x_scale="jac") lets parameters the data barely
+    #sees take huge steps, and the step tolerance is then set by the largest parameter, ending fits early
+    scale = np.where(log_mask | (x0 == 0) | ~np.isfinite(x0), 1, np.abs(x0))
+
+    def residuals(u):
+        count("Z_evaluations")
+        with timer("Z"):
+            return model.evaluate(to_params(u * scale)) - ydata
+
+    def jacobian(u):
+        params = to_params(u * scale)
+        count("dZ_evaluations")
+        with timer("dZ"):
+            #d/dlog10(p) = p * ln(10) * d/dp
+            return model.jacobian(params) * np.where(log_mask, params * np.log(10), scale)
+
+    result = None
+    if np.all(np.isfinite(x0)) and np.all(np.isfinite(residuals(x0 / scale))):
+        result = least_squares(residuals, x0 / scale, jac=jacobian if model.dZ is not None else "2-point",
+                               bounds=(lower / scale, upper / scale), method="trf", x_scale=1.0, loss=loss,
+                               f_scale=f_scale, max_nfev=max_nfev)
+
+    if result is None or not result.success:
+        print("Unable to find optimal params: using guess params")
+        fit_info = {"success": False, "nfev": None, "njev": None, "message": "residuals not finite at the guess",
+                    "covariance": np.full((n_free, n_free), np.nan), "at_bound": np.zeros(n_free, dtype=bool)}
+        if result is not None:
+            fit_info.update({"nfev": result.nfev, "njev": result.njev, "message": result.message})
+        return free_guess, fit_info
+
+    fit_info = {"success": True, "nfev": result.nfev, "njev": result.njev, "message": result.message,
+                "at_bound": result.active_mask != 0}
+    #result.jac is rescaled by a robust loss, pair it with the robust cost rather than the raw residuals
+    covariance = covariance_from_jacobian(result.jac, result.fun, sum_squares=2 * result.cost)
+    fit_info["covariance"] = covariance * np.outer(scale, scale)
+    return to_params(result.x * scale), fit_info
+
+def fit_logspace(model, ydata, free_guess, init_values, log_mask, log_decades=3, lower=None, upper=None,
+                 loss="linear", f_scale=1.0):
+    """
+    fit_free_params with the logarithmic parameters optimised as log10(parameter)
+    Bounds are log_decades either side of the Initial_params.csv value for logarithmic parameters. Other parameters
+    are only bounded below by 0, as in linear fits, since e.g. the no-bias V is far from its Initial_params.csv value
+    Args:
+        model (CompiledModel): Model bound to the data frequencies and the fixed parameters
+        ydata (array): Stacked real and imaginary impedance data
+        free_guess (array): Guess values of the free parameters
+        init_values (array): Initial values of the free parameters from Initial_params.csv
+        log_mask (array): Boolean array over the free parameters, True for parameters to optimise in log space
+        log_decades (float): Number of decades either side of init_values the logarithmic parameters may move
+        lower, upper (array or None): Further bounds of the free parameters in parameter units, combined with the above
+        loss (string): see fit_free_params
+        f_scale (float): see fit_free_params
+    Returns:
+        free_params (array), fit_info (dict): see fit_free_params
+    """
+    init_values = np.abs(init_values)
+    log_init = np.log10(init_values[log_mask])
+
+    lower = np.full(len(init_values), -np.inf) if lower is None else np.asarray(lower, dtype=float)
+    upper = np.full(len(init_values), np.inf) if upper is None else np.asarray(upper, dtype=float)
+
+    #fmax and fmin ignore the nan of log10 of bounds <= 0
+    window_lower = np.fmax(lower, 0)
+    window_upper = upper.copy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        window_lower[log_mask] = np.fmax(log_init - log_decades, np.log10(lower[log_mask]))
+        window_upper[log_mask] = np.fmin(log_init + log_decades, np.log10(upper[log_mask]))
+
+    return fit_free_params(model, ydata, free_guess, log_mask, window_lower, window_upper, loss=loss, f_scale=f_scale)
 
 def fit_leastsq(Z, bias_data, nobias_data, bias_voltage, IV_data=None, run_checker=False, bias=True, 
-                nanoparticles=False, fixed_params_indices = [], fixed_params_values = []):
+                nanoparticles=False, fixed_params_indices = [], fixed_params_values = [], full_output=False,
+                dZ=None, logspace=False, init_paramfilename=None, log_decades=3, p0=None, multistart=0,
+                multistart_decades=1.0, loss="linear", f_scale=None, bounds=None, weighting="unit", variance=None,
+                fit_constants=False, vectorized=None, bound_Z=None):
     """
-    Performs a least square fit to data using scipy curve_fit function
+    Performs a least square fit to data with a trust region solver (scipy least_squares) over the free parameters,
+    the fixed parameters are not seen by the optimiser. Parameters are kept >0 by bounds
     Args:
         Z (function): Complex impedance function to fit to
         bias_data (array): Impedance data taken from the cell under electrical bias
@@ -27,19 +207,95 @@ def fit_leastsq(Z, bias_data, nobias_data, bias_voltage, IV_data=None, run_check
         nanoparticles (boolean): Whether we are using the nanoparticles model
         fixed_params_indices: indices of parameters to fix
         fixed_params_values: values of parameters to fix
+        full_output (boolean): Whether to also return a dictionary describing the fit
+        dZ (function or None): Analytic derivatives of Z with respect to each parameter, same arguments as Z,
+                               returning a complex array of shape (len(w), no. of params).
+                               If None the jacobian is estimated by finite differences
+        logspace (boolean): Whether to optimise the parameters marked 'log' in init_paramfilename as log10(parameter)
+                            within bounds instead of fitting every parameter linearly
+        init_paramfilename (string or None): Filename of init_params.csv under model folder, needed if logspace.
+                                             Parameters without a slider in it (kbt and n_0 of the built-in models)
+                                             are held at their init_params.csv values unless fit_constants
+        log_decades (float): Number of decades either side of the init_params.csv values logspace fits may move,
+                             and either side of the guess multi-start fits may move
+        p0 (list or None): Starting parameters, e.g. the fitted parameters of a neighbouring bias voltage.
+                           If None the starting parameters are guessed from the data with param_guesser
+        multistart (int): Number of starting points to spread around the guess and fit from, see Multistart.fit_multistart.
+                          0 fits once from the guess. Needs init_paramfilename, guessed values which are not finite
+                          or 0 are replaced by the init_params.csv values
+        multistart_decades (float): Number of decades either side of the guess the starting points are spread over
+        loss (string): 'linear' for least squares, or a robust loss which down-weights outlying points,
+                       one of Loss.LOSSES ('soft_l1', 'huber', 'cauchy', 'arctan')
+        f_scale (float or None): Weighted residuals larger than f_scale count as outliers under a robust loss,
+                                 None uses 1% of the typical weighted impedance of the data, see Loss.default_f_scale
+        bounds (tuple or None): (lower, upper) bounds of every parameter in parameter units, arrays or floats,
+                                entries of fixed parameters are ignored. Linear fits are always bounded below by 0,
+                                logspace fits are always bounded by log_decades, see fit_logspace
+        weighting (string): Weights of the residuals, one of Weighting.WEIGHTINGS: 'unit' (unweighted),
+                            'proportional' (relative errors of Z' and Z''), 'modulus' (errors relative to |Z|)
+                            or 'variance' (1/standard deviation of each point, needs variance).
+                            Computed once from the data, see Weighting.residual_weights
+        variance (array or None): Variance of each data point for 'variance' weighting, shape (2N,) in the layout
+                                  of the stacked real and imaginary data, or (N,) shared by both
+        fit_constants (boolean): Whether to also fit the parameters without a slider in init_paramfilename,
+                                 see read_constant_mask. The data cannot separate kbt from n_0
+        vectorized (boolean or None): Whether Z broadcasts over stacked parameter sets (ImpedanceModel.vectorized),
+                                      used to screen multi-start points. None checks the shape of a broadcast pass
+        bound_Z (class or None): the model's BoundZ class (ImpedanceModel.bound_Z), evaluates Z faster during the fit,
+                                 see Compiled_model.py. If None Z is called directly
     
     Returns:
-        fitted_params (tuple): tuple of optimal parameters generated from curve_fit
-        If curve_fit enters a runtime error, fitted_params will be the guessed params and the curve_fit
-        will be ignored
+        fitted_params (tuple): tuple of optimal parameters
+        If the fit does not converge, fitted_params will be the guessed params
+        fit_info (dict, if full_output): 'success' (False if the guess params were returned),
+        'nfev' (number of function evaluations), 'njev' (number of jacobian evaluations, one per iteration,
+        None for multi-start fits), 'message' from the optimiser, 'cost' (sum of squared residuals, whatever the loss
+        and weighting), 'weighted_cost' (sum of squared weighted residuals), 'loss', 'f_scale', 'weighting' and
+        'at_bound' (boolean array, True for parameters which ended on a bound, e.g. 0, the logspace window or the
+        multi-start search window, whose fitted values are probably limited by the bound).
+        Multi-start fits also have 'multistart', the report from fit_multistart.
+        Parameter uncertainties from the Jacobian of the final iteration, no extra model evaluations:
+        'covariance' (array, no. of params x no. of params), 'stderr' (standard errors), 'correlation' (matrix)
+        and 'log_params' (boolean array, True where the covariance and stderr are of log10(parameter), i.e. the
+        parameters fitted in log space). Fixed parameters are nan, parameters the data cannot separate
+        from others (e.g. kbt and n_AB) have infinite standard errors, see Uncertainty.py
     """
 
-    plist_guess = list(param_guesser(bias_data, nobias_data, IV_data, bias_voltage, run_checker=run_checker, bias=bias, nanoparticles=nanoparticles))
+    if multistart and init_paramfilename is None:
+        raise ValueError("multistart needs init_paramfilename, to hold the constants fixed and replace failed guesses")
+    if loss not in LOSSES:
+        raise ValueError(f"Unknown loss '{loss}', expected one of {LOSSES}")
+    if weighting not in WEIGHTINGS:
+        raise ValueError(f"Unknown weighting '{weighting}', expected one of {WEIGHTINGS}")
+
+    if p0 is None and multistart:
+        #the starts cover a wide range anyway, so a failed guess falls back to the init_params.csv values
+        try:
+            plist_guess = list(param_guesser(bias_data, nobias_data, IV_data, bias_voltage, run_checker=run_checker, bias=bias, nanoparticles=nanoparticles))
+        except (IndexError, ValueError) as error:
+            print(f"Unable to guess params ({error}): starting from init_params.csv values")
+            plist_guess = list(read_param_settings(init_paramfilename)[1])
+    elif p0 is None:
+        plist_guess = list(param_guesser(bias_data, nobias_data, IV_data, bias_voltage, run_checker=run_checker, bias=bias, nanoparticles=nanoparticles))
+    else:
+        plist_guess = list(p0)
+
+    #constants are held at their init_params.csv values, with the fixed params
+    fixed_params_indices = list(fixed_params_indices)
+    fixed_params_values = list(fixed_params_values)
+    if init_paramfilename is not None and not fit_constants:
+        init_values = read_param_settings(init_paramfilename)[1]
+        for index in np.flatnonzero(read_constant_mask(init_paramfilename)):
+            if index not in fixed_params_indices:
+                fixed_params_indices.append(int(index))
+                fixed_params_values.append(init_values[index])
 
     #set fixed params
     if len(fixed_params_indices) != 0:
         for i, index in enumerate(fixed_params_indices):
             plist_guess[index] = fixed_params_values[i]
+    #parameters are >0, the guesser can return negative values
+    plist_guess = list(np.abs(np.array(plist_guess, dtype=float)))
 
     if bias:
         xdata = bias_data[:,1]
@@ -52,28 +308,91 @@ def fit_leastsq(Z, bias_data, nobias_data, bias_voltage, IV_data=None, run_check
 
     ydata = np.hstack( [ydata_real, ydata_imag] )
     
-    def imp_func(w, *param_list):
-        #ensure fixed parameters are unchanged
-        param_list = list(param_list)
-        if len(fixed_params_indices) != 0:
-            for i, index in enumerate(fixed_params_indices):
-                param_list[index] = fixed_params_values[i]
-
-        #make sure the parameters STAY >0
-        param_list = tuple(abs(value) for value in param_list)
-
-        Z_val = Z(w, *param_list)
-        return np.hstack([Z_val.real, -Z_val.imag])
-    
-    try:
-        fitted_params, cov = curve_fit(imp_func, xdata, ydata, p0=plist_guess)
-    except RuntimeError:
-        print("Unable to find optimal params: using guess params")
-        fitted_params = plist_guess
+    #Z bound to the frequencies and fixed parameters, see Compiled_model.py
+    n_params = len(plist_guess)
+    model = compile_model(Z, xdata, n_params, fixed_params_indices, np.take(plist_guess, fixed_params_indices), dZ=dZ,
+                          bound_Z=bound_Z)
+    free_indices = model.free_indices
+    weights = residual_weights(ydata, weighting, variance)
+    model.set_weights(weights)
+    weighted_ydata = ydata if weights is None else ydata * weights
+    if f_scale is None:
+        f_scale = default_f_scale(weighted_ydata)
+    if bounds is not None:
+        lower = np.broadcast_to(np.asarray(bounds[0], dtype=float), n_params)[free_indices]
+        upper = np.broadcast_to(np.asarray(bounds[1], dtype=float), n_params)[free_indices]
+    else:
+        lower, upper = None, None
+
+    if multistart:
+        #the single fit and every start need a finite, >0 guess
+        seed_params = np.array(plist_guess, dtype=float)
+        invalid = ~np.isfinite(seed_params) | (seed_params == 0)
+        seed_params[invalid] = np.abs(read_param_settings(init_paramfilename)[1][invalid])
+        plist_guess = list(seed_params)
+
+    free_guess = np.array(plist_guess, dtype=float)[free_indices]
+    if logspace:
+        init_values, log_mask = read_param_settings(init_paramfilename)[1:]
+        free_params, fit_info = fit_logspace(model, ydata, free_guess, init_values[free_indices], log_mask[free_indices],
+                                             log_decades=log_decades, lower=lower, upper=upper, loss=loss, f_scale=f_scale)
+        log_params = np.array(log_mask, dtype=bool)
+    else:
+        free_params, fit_info = fit_free_params(model, ydata, free_guess,
+                                                lower=None if lower is None else np.fmax(lower, 0),
+                                                upper=np.inf if upper is None else upper,
+                                                loss=loss, f_scale=f_scale)
+        log_params = np.zeros(n_params, dtype=bool)
+
+    #fixed parameters are held by the model
+    fitted_params = model.params.copy()
+    fitted_params[free_indices] = free_params
+    covariance = np.full((n_params, n_params), np.nan)
+    covariance[np.ix_(free_indices, free_indices)] = fit_info["covariance"]
+    fit_info["covariance"] = covariance
+    at_bound = np.zeros(n_params, dtype=bool)
+    at_bound[free_indices] = fit_info["at_bound"]
+    fit_info["at_bound"] = at_bound
     
-    #make sure the parameters STAY >0
-    fitted_params = tuple(abs(value) for value in fitted_params)
+    if multistart:
+        #the single fit above is kept if no start does better, so multi-start fits are never worse
+        single_cost = robust_cost(model.evaluate(free_params) - weighted_ydata, loss, f_scale)
+        multistart_params, report = fit_multistart(Z, xdata, ydata, seed_params, free_indices, dZ=dZ,
+                                                   n_starts=multistart, decades=multistart_decades,
+                                                   loss=loss, f_scale=f_scale, weights=weights,
+                                                   bound_decades=log_decades, lower=lower, upper=upper,
+                                                   vectorized=vectorized, bound_Z=bound_Z)
+        report["single_fit_cost"] = single_cost
+        if report["cost"] < single_cost or not np.isfinite(single_cost):
+            fitted_params = multistart_params
+            fit_info = {"success": report["success"], "nfev": report["nfev"], "njev": None,
+                        "message": f"best of {multistart} starts",
+                        "covariance": np.full((n_params, n_params), np.nan)}
+            #the starts are fitted in log space
+            fit_info["covariance"][np.ix_(free_indices, free_indices)] = report["covariance"]
+            fit_info["at_bound"] = np.isin(np.arange(n_params), free_indices[report["at_bound"]])
+            log_params = np.isin(np.arange(n_params), free_indices)
+        fit_info["multistart"] = report
+
+    #the bounds keep the parameters >0
+    fitted_params = tuple(float(value) for value in fitted_params)
+
+    if full_output:
+        free_params = np.take(fitted_params, free_indices)
+        fit_info["weighted_cost"] = float(np.sum((model.evaluate(free_params) - weighted_ydata)**2))
+        Z_values = model.evaluate_Z(free_params)
+        fit_info["cost"] = float(np.sum((np.hstack([Z_values.real, -Z_values.imag]) - ydata)**2))
+        fit_info["loss"] = loss
+        fit_info["f_scale"] = f_scale
+        fit_info["weighting"] = weighting
+        set_value("cost", fit_info["cost"])
+        set_value("nfev", fit_info["nfev"])
+        set_value("iterations", fit_info["njev"])
+        set_value("success", fit_info["success"])
 
+        fit_info["stderr"], fit_info["correlation"] = standard_errors(fit_info["covariance"])
+        fit_info["log_params"] = log_params
+        return fitted_params, fit_info
     return fitted_params
 
 if __name__ == "__main__":
@@ -5,8 +5,48 @@ Timothy Chew
 16/8/2024
 """
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.signal import find_peaks
+
+def peak_mask(x):
+    """
+    Local maxima along the last axis of x, for one spectrum or a stack of spectra
+    Same peaks as scipy.signal.find_peaks without conditions: flat peaks are marked at their
+    middle index (rounded down) and values next to nan are never peaks
+    Args:
+        x (array): shape (..., N)
+    Returns:
+        mask (array): boolean array of the same shape, True at peaks
+    """
+    x = np.asarray(x, dtype=float)
+    N = x.shape[-1]
+    if N < 3:
+        return np.zeros(x.shape, dtype=bool)
+
+    #first and last index of the run of equal values each element belongs to
+    index = np.broadcast_to(np.arange(N), x.shape)
+    starts_run = np.ones(x.shape, dtype=bool)
+    starts_run[..., 1:] = x[..., 1:] != x[..., :-1]
+    ends_run = np.ones(x.shape, dtype=bool)
+    ends_run[..., :-1] = starts_run[..., 1:]
+    run_start = np.maximum.accumulate(np.where(starts_run, index, 0), axis=-1)
+    run_end = np.minimum.accumulate(np.where(ends_run, index, N-1)[..., ::-1], axis=-1)[..., ::-1]
+
+    #a run is a peak if the runs either side are lower
+    left = np.take_along_axis(x, np.maximum(run_start - 1, 0), axis=-1)
+    right = np.take_along_axis(x, np.minimum(run_end + 1, N-1), axis=-1)
+    return ((run_start > 0) & (run_end < N-1) & (left < x) & (right < x)
+            & (index == (run_start + run_end) // 2))
+
+def find_peaks(x):
+    """
+    Indices of the local maxima of x, same result as scipy.signal.find_peaks(x) without conditions
+    Flat peaks give the middle index (rounded down). Written out here (see peak_mask) since importing
+    scipy.signal takes longer than the whole guess
+    Args:
+        x (array): 1D data
+    Returns:
+        peaks (tuple): (indices of the peaks, {}) like scipy.signal.find_peaks
+    """
+    return np.flatnonzero(peak_mask(x)), {}
 
 #Functions that find key points on graph
 def get_Rsh_IV(I, V, scan_range=150):
@@ -157,11 +197,8 @@ def get_Cg(wg, Rsh, Rs, Rion):
     Returns:
         Cg (float): Guess of geometric capacitance
     """
-    if Rsh < Rion:
-        Cg = 1 / (wg * np.sqrt(Rsh * Rs))
-    else:
-        Cg = 1 / (wg * np.sqrt(Rion * Rs))
-
+    #np.where so that arrays of features from Batch_finder work too
+    Cg = 1 / (wg * np.sqrt(np.where(Rsh < Rion, Rsh, Rion) * Rs))
     return Cg
 
 def get_Cg_Bias(wg, Cion, Rninf):
@@ -224,6 +261,8 @@ def get_Cnano(wnano, Rnano):
     return Cnano
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+
     #data = np.loadtxt("test_data\Pixel5ControlLightForwardsweep\\nyquist.txt", skiprows=1)
     data = np.loadtxt("test_data\Pixel1NanoparticlesLightForwardsweep\\nyquist.txt", skiprows=1)
     Zreal = data[:,2]
@@ -6,12 +6,12 @@ Timothy Chew
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 import curve_fitting.Finder as find
+from curve_fitting.Instrumentation import timed
 
-from matplotlib.widgets import Slider
 from graphics.Axes_generator import gen_axes
 
+@timed("Interface")
 def Interface(bias_data, nobias_data=None, IV_data=None, nanoparticle=False, run_checker=True):
     """
     Plots things and checks for things
@@ -83,6 +83,10 @@ def check_tconstants(wg, wion, nyquist_data, wnano=None):
         wion_output (float): Checked Cion time constant
         wnano_output (float): Checked Cnano time constant
     """
+    #imported here so fitting without the checker does not load matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Slider
+
     fig, (ax1, ax2) = plt.subplots(1, 2)
     twin = ax2.twinx()
 
@@ -214,6 +218,9 @@ def check_Rn(Rn0, Rninf, nyquist_data, Rs):
         Rn0_output (float): Checked Rn0 resistance
         Rninf_output (float): Checked Rninf resistance
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.widgets import Slider
+
     #plotting data
     fig, (ax1, ax2) = plt.subplots(1, 2)
 
@@ -0,0 +1,161 @@
+"""
+On-disk cache of fit results
+Results are keyed by the contents of the data files, the model's Impedancefunction.py
+and Initial_params.csv, and the fit options, so changing any of them refits the data.
+One json file is stored per result, the least recently used results are removed once
+the cache holds more than max_entries results. The number of results is counted in memory,
+so the folder is only listed when the count first passes max_entries, not on every save
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+DEFAULT_CACHE_FOLDER = "fit_cache"
+
+#bump when the fitting code changes in a way that changes results, so old results are not reused
+CACHE_VERSION = 5
+
+#file hashes already computed by this process, keyed by (path, size, modification time)
+_file_hashes = {}
+
+#number of results in each cache folder, as counted by this process. Other processes' saves are only seen
+#when evict lists the folder, so parallel workers can overshoot max_entries until one of them evicts
+_entry_counts = {}
+
+#evict removes results down to this fraction of max_entries, so the folder is listed once per
+#max_entries * (1 - EVICT_FRACTION) new results rather than on every save
+EVICT_FRACTION = 0.9
+
+def file_hash(filename):
+    """
+    sha256 hash of a file's contents
+    Args:
+        filename (string or None): name of file
+    Returns:
+        hex digest (string), "None" if filename is None
+    """
+    if filename is None:
+        return "None"
+
+    stat = os.stat(filename)
+    identity = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if identity not in _file_hashes:
+        with open(filename, "rb") as file:
+            _file_hashes[identity] = hashlib.sha256(file.read()).hexdigest()
+    return _file_hashes[identity]
+
+def cache_key(datafiles, imp_model_folder, options):
+    """
+    Key identifying a fit
+    Args:
+        datafiles (list): names of the data files used by the fit, or the data arrays themselves (entries may be None)
+        imp_model_folder (string): name of folder containing the impedance model
+        options (dict): fit options, e.g. bias flag and fixed parameters. Values must be json serialisable
+                        numbers, strings, booleans, lists or None
+    Returns:
+        key (string): hex digest combining the data, model and options
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f"version {CACHE_VERSION}\n".encode())
+    for datafile in datafiles:
+        if isinstance(datafile, np.ndarray):
+            hasher.update(hashlib.sha256(np.ascontiguousarray(datafile).tobytes()).hexdigest().encode())
+        else:
+            hasher.update(file_hash(datafile).encode())
+    for filename in ["Impedancefunction.py", "Initial_params.csv"]:
+        hasher.update(file_hash(os.path.join(imp_model_folder, filename)).encode())
+    hasher.update(json.dumps(options, sort_keys=True, default=float).encode())
+    return hasher.hexdigest()
+
+def load_fit(key, cache_folder=DEFAULT_CACHE_FOLDER):
+    """
+    Loads a cached fit result and marks it as recently used
+    Args:
+        key (string): key from cache_key
+        cache_folder (string): folder containing the cache
+    Returns:
+        fitted_params (tuple) and fit_info (dict), or None if the fit is not cached
+    """
+    filename = os.path.join(cache_folder, key + ".json")
+    try:
+        with open(filename) as file:
+            entry = json.load(file)
+        os.utime(filename)
+    except (OSError, ValueError):
+        return None
+    return tuple(entry["params"]), entry["fit_info"]
+
+def save_fit(key, fitted_params, fit_info, cache_folder=DEFAULT_CACHE_FOLDER, max_entries=10000):
+    """
+    Stores a fit result, removing the least recently used results if the cache is full
+    Args:
+        key (string): key from cache_key
+        fitted_params (tuple): fitted parameters
+        fit_info (dict): fit description from fit_leastsq
+        cache_folder (string): folder containing the cache
+        max_entries (int): maximum number of results kept
+    """
+    os.makedirs(cache_folder, exist_ok=True)
+    entry = {"params": [float(value) for value in fitted_params],
+             "fit_info": {name: to_json(value) for name, value in fit_info.items()}}
+
+    #write then rename, so parallel workers never read half written files
+    filename = os.path.join(cache_folder, key + ".json")
+    temp_filename = f"{filename}.{os.getpid()}.tmp"
+    is_new = not os.path.exists(filename)
+    with open(temp_filename, "w") as file:
+        json.dump(entry, file)
+    os.replace(temp_filename, filename)
+
+    folder = os.path.abspath(cache_folder)
+    if folder not in _entry_counts:
+        _entry_counts[folder] = count_entries(cache_folder)
+    elif is_new:
+        _entry_counts[folder] += 1
+    if _entry_counts[folder] > max_entries:
+        _entry_counts[folder] = evict(cache_folder, int(max_entries * EVICT_FRACTION))
+
+def count_entries(cache_folder):
+    """
+    Number of results in a cache folder
+    """
+    return sum(1 for entry in os.scandir(cache_folder) if entry.name.endswith(".json"))
+
+def evict(cache_folder, max_entries):
+    """
+    Removes the least recently used results until at most max_entries remain
+    Args:
+        cache_folder (string): folder containing the cache
+        max_entries (int): maximum number of results kept
+    Returns:
+        number of results left (int)
+    """
+    entries = [entry for entry in os.scandir(cache_folder) if entry.name.endswith(".json")]
+    if len(entries) <= max_entries:
+        return len(entries)
+
+    entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+    for entry in entries[:len(entries) - max_entries]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass #already removed by another process
+    return max_entries
+
+def to_json(value):
+    """
+    Converts numpy scalars and arrays, also inside dictionaries, to python types so fit_info can be stored as json
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, dict):
+        return {name: to_json(entry) for name, entry in value.items()}
+    return value
@@ -0,0 +1,190 @@
+"""
+Fits several spectra of the same cell at once
+Parameters are either shared by every spectrum (e.g. C_g, C_ion, R_ion, R_s, R_sh across the biases of a pixel)
+or fitted separately for each spectrum, and everything is solved as one least squares problem.
+Each spectrum only depends on the shared parameters and its own parameters, so the jacobian is block sparse.
+The spectra of a pixel are few enough to solve with the dense jacobian, larger problems are solved iteratively
+with the sparse jacobian
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+from scipy.optimize import least_squares
+from scipy.sparse import csr_matrix
+
+#indices of C_g, C_ion, R_ion, R_s and R_sh in the built-in models
+DEFAULT_SHARED_INDICES = [1, 2, 3, 8, 9]
+
+#joint fits with at most this many fitted values use the exact trust region solver on the dense jacobian
+MAX_DENSE_COLUMNS = 300
+
+def parameter_layout(n_params, n_spectra, shared_indices, fixed_params_indices, free_mask=None):
+    """
+    Positions of every spectrum's free parameters in the joint parameter vector
+    The joint vector holds the shared parameters first, then each spectrum's own parameters in turn
+    Args:
+        n_params (int): number of parameters of the model
+        n_spectra (int): number of spectra
+        shared_indices (list): indices of parameters shared by every spectrum
+        fixed_params_indices (list): indices of parameters which are not fitted for any spectrum
+        free_mask (array or None): shape (n_spectra, len(free_indices)), False where a spectrum holds one of
+                                   the free parameters fixed. Only parameters which are not shared can be
+                                   fixed for some spectra. None fits every free parameter of every spectrum
+    Returns:
+        free_indices (array): indices of the parameters fitted for at least one spectrum
+        columns (array): shape (n_spectra, len(free_indices)), position of each fitted parameter in the joint
+                         vector, -1 where the spectrum holds the parameter fixed
+    """
+    free_indices = np.array([i for i in range(n_params) if i not in fixed_params_indices], dtype=int)
+    if free_mask is None:
+        free_mask = np.ones((n_spectra, len(free_indices)), dtype=bool)
+    shared = [i for i in free_indices if i in shared_indices]
+    if not np.all(free_mask[:, np.isin(free_indices, shared)]):
+        raise ValueError("Shared parameters must be fitted for every spectrum or none")
+
+    columns = np.full((n_spectra, len(free_indices)), -1, dtype=int)
+    for position, index in enumerate(free_indices):
+        if index in shared_indices:
+            columns[:, position] = shared.index(index)
+    next_column = len(shared)
+    for k in range(n_spectra):
+        for position, index in enumerate(free_indices):
+            if index not in shared_indices and free_mask[k, position]:
+                columns[k, position] = next_column
+                next_column += 1
+    return free_indices, columns
+
+def fit_global(Z, spectra, p0_list, shared_indices=DEFAULT_SHARED_INDICES, fixed_params_indices=[],
+               fixed_params_values=None, dZ=None, full_output=False, vectorized=False):
+    """
+    Jointly fits K spectra with some parameters shared between all of them
+    Parameters are optimised relative to their starting values and kept >0 with bounds
+    Args:
+        Z (function): Complex impedance function to fit to
+        spectra (list): K impedance data arrays (columns index, frequency, Z', -Z'')
+        p0_list (list): K starting parameter lists, e.g. from param_guesser.
+                        Shared parameters start from the median over the spectra
+        shared_indices (list): indices of parameters shared by every spectrum
+        fixed_params_indices (list): indices of parameters to fix
+        fixed_params_values (list or None): K lists of values of the fixed parameters, one list per spectrum
+                                            (e.g. each spectrum's bias voltage). nan fits the parameter for that
+                                            spectrum from its p0_list value instead, e.g. the bias voltage of a
+                                            no bias spectrum. If None the values in p0_list are kept
+        dZ (function or None): Analytic derivatives of Z, see fit_leastsq.
+                               If None the jacobian is estimated by finite differences, using its sparsity
+                               for problems too large for the dense solver (see MAX_DENSE_COLUMNS)
+        full_output (boolean): Whether to also return a dictionary describing the fit
+        vectorized (boolean): Whether Z and dZ broadcast over parameter arrays (see Param_sweep.py), every spectrum
+                              is then evaluated in one call with the parameters given per frequency
+    Returns:
+        fitted_params_list (list): K tuples of fitted parameters, shared parameters are equal in every tuple
+        fit_info (dict, if full_output): 'success', 'nfev', 'njev', 'message', 'cost' (sum of squared residuals
+        over every spectrum), 'costs' (sum of squared residuals of each spectrum), 'start_params' (K lists of
+        the starting parameters, with the shared medians and fixed values), 'start_costs' (their costs) and
+        'at_bound' (K boolean lists over the parameters, True where the fit ended on a bound, as in fit_leastsq)
+    """
+    K = len(spectra)
+    p0_array = np.abs(np.array(p0_list, dtype=float))
+    n_params = p0_array.shape[1]
+
+    base_params = p0_array.copy()
+    fixed_params_indices = list(fixed_params_indices)
+    free_mask = None
+    if fixed_params_values is not None:
+        fixed_values = np.array(fixed_params_values, dtype=float).reshape(K, -1)
+        base_params[:, fixed_params_indices] = np.where(np.isnan(fixed_values), p0_array[:, fixed_params_indices],
+                                                        fixed_values)
+        #parameters fixed for some spectra only are fitted as the others' own parameters
+        partly_fixed = np.isnan(fixed_values).any(axis=0)
+        free_mask = np.ones((K, n_params), dtype=bool)
+        free_mask[:, fixed_params_indices] = np.isnan(fixed_values)
+        fixed_params_indices = [i for i, partly in zip(fixed_params_indices, partly_fixed) if not partly]
+    base_params[:, shared_indices] = np.median(p0_array[:, shared_indices], axis=0)
+
+    free_indices = np.array([i for i in range(n_params) if i not in fixed_params_indices], dtype=int)
+    free_indices, columns = parameter_layout(n_params, K, shared_indices, fixed_params_indices,
+                                             None if free_mask is None else free_mask[:, free_indices])
+    fitted = columns >= 0
+    n_columns = columns.max() + 1
+
+    #optimise parameters relative to their starting values, so kbt~4e-21 and R_sh~1e4 are both of order 1
+    scale = np.ones(n_columns)
+    scale[columns[fitted]] = base_params[:, free_indices][fitted]
+    scale[scale == 0] = 1
+
+    #residuals are every spectrum's Z' then every spectrum's -Z''
+    w_list = [data[:,1] for data in spectra]
+    w_all = np.concatenate(w_list)
+    point_spectrum = np.repeat(np.arange(K), [len(w) for w in w_list])
+    row_spectrum = np.tile(point_spectrum, 2)
+    ydata = np.concatenate([np.concatenate([data[:,2] for data in spectra]), np.concatenate([data[:,3] for data in spectra])])
+
+    def all_params(x):
+        params = base_params.copy()
+        params[:, free_indices] = np.where(fitted, x[columns] * scale[columns], base_params[:, free_indices])
+        return params
+
+    def evaluate(function, x):
+        params = all_params(x)
+        if vectorized:
+            return function(w_all, *params[point_spectrum].T)
+        return np.concatenate([function(w, *params[k]) for k, w in enumerate(w_list)])
+
+    def residuals(x):
+        Z_val = evaluate(Z, x)
+        return np.concatenate([Z_val.real, -Z_val.imag]) - ydata
+
+    #rows of spectrum k depend on the shared columns and spectrum k's own columns
+    jac_entries = fitted[row_spectrum].ravel()
+    jac_rows = np.repeat(np.arange(len(ydata)), len(free_indices))[jac_entries]
+    jac_cols = columns[row_spectrum].ravel()[jac_entries]
+
+    #the exact trust region solver needs the dense jacobian, which is small for the spectra of a pixel.
+    #Larger problems use lsmr on the sparse jacobian, it needs tight tolerances as the problem is badly conditioned
+    dense = n_columns <= MAX_DENSE_COLUMNS
+    solver_options = {"tr_solver": "exact"} if dense else {"tr_solver": "lsmr",
+                                                           "tr_options": {"atol": 1e-14, "btol": 1e-14, "maxiter": 10000}}
+
+    def jacobian(x):
+        dZ_val = evaluate(dZ, x)[:, free_indices] * scale[columns[point_spectrum]]
+        values = np.concatenate([dZ_val.real, -dZ_val.imag]).ravel()[jac_entries]
+        if dense:
+            J = np.zeros((len(ydata), n_columns))
+            J[jac_rows, jac_cols] = values
+            return J
+        return csr_matrix((values, (jac_rows, jac_cols)), shape=(len(ydata), n_columns))
+
+    #the relative parameters are of order 1 and steps are not rescaled further, as in Curve_fitting.fit_free_params.
+    #Scaling by the jacobian (x_scale="jac") lets parameters the data barely sees take steps of several decades
+    x0 = np.ones(n_columns)
+    with np.errstate(all="ignore"):
+        if dZ is not None:
+            result = least_squares(residuals, x0, jac=jacobian, bounds=(0, np.inf), method="trf", x_scale=1.0,
+                                   **solver_options)
+        elif dense:
+            result = least_squares(residuals, x0, jac="2-point", bounds=(0, np.inf), method="trf", x_scale=1.0,
+                                   **solver_options)
+        else:
+            sparsity = csr_matrix((np.ones(len(jac_rows)), (jac_rows, jac_cols)), shape=(len(ydata), n_columns))
+            result = least_squares(residuals, x0, jac="2-point", jac_sparsity=sparsity, bounds=(0, np.inf),
+                                   method="trf", x_scale=1.0, **solver_options)
+
+    fitted_params = all_params(result.x)
+    fitted_params_list = [tuple(params) for params in fitted_params]
+
+    if full_output:
+        costs = np.bincount(row_spectrum, result.fun**2, minlength=K)
+        with np.errstate(all="ignore"):
+            start_costs = np.bincount(row_spectrum, residuals(x0)**2, minlength=K)
+        #a shared parameter on a bound is on it for every spectrum
+        at_bound = np.zeros((K, n_params), dtype=bool)
+        at_bound[:, free_indices] = fitted & (result.active_mask[columns] != 0)
+        fit_info = {"success": result.success, "nfev": result.nfev, "njev": result.njev, "message": result.message,
+                    "cost": float(np.sum(costs)), "costs": [float(cost) for cost in costs],
+                    "start_params": [list(params) for params in all_params(x0)],
+                    "start_costs": [float(cost) for cost in start_costs],
+                    "at_bound": at_bound.tolist()}
+        return fitted_params_list, fit_info
+    return fitted_params_list
@@ -6,14 +6,16 @@ Timothy Chew
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 import cmath
 import scipy.constants as spc
-import scipy.special as sps
 
 import curve_fitting.Finder as find
 from curve_fitting.FinderInterface import Interface
+from curve_fitting.Batch_finder import find_features
+from curve_fitting.Lambert_w import lambertw
+from curve_fitting.Instrumentation import timed
 
+@timed("param_guesser")
 def param_guesser(bias_data, nobias_data, IV_data, bias_voltage, kbt=4.1302114835e-21,
                    Js=2.31e-16, bias=True, nanoparticles=False, run_checker=True):
     """
@@ -37,6 +39,30 @@ def param_guesser(bias_data, nobias_data, IV_data, bias_voltage, kbt=4.130211483
     Rion, Rsh, Rs, Rn0, Rninf, wg_bias, wg_nobias, wion_bias, wion_nobias, wnano = Interface(
         bias_data, nobias_data, IV_data, run_checker=run_checker, nanoparticle=nanoparticles)
 
+    Rnano = None
+    if wnano is not None:
+        Rnano = find.get_Rnano(bias_data[:,1], bias_data[:,2], wnano, Rninf, Rs)
+
+    return guess_from_features(Rion, Rsh, Rs, Rn0, Rninf, wg_bias, wg_nobias, wion_bias, wion_nobias, wnano, Rnano,
+                               bias_voltage, kbt, Js, bias, nanoparticles)
+
+def guess_from_features(Rion, Rsh, Rs, Rn0, Rninf, wg_bias, wg_nobias, wion_bias, wion_nobias, wnano, Rnano,
+                        bias_voltage, kbt=4.1302114835e-21, Js=2.31e-16, bias=True, nanoparticles=False):
+    """
+    Calculates parameter guess values from Finder features
+    Works on single values or on arrays of features from Batch_finder.find_features
+    Args:
+        Rion, Rsh, Rs, Rn0, Rninf, wg_bias, wg_nobias, wion_bias, wion_nobias, wnano: features from FinderInterface.Interface
+        Rnano (float or None): Resistance of nanoparticle branch from Finder.get_Rnano, None if wnano is None
+        bias_voltage (float): Voltage under which bias_data was taken
+        kbt (float): Boltzmann constant times temperature
+        Js (float): Saturation current of material
+        bias (boolean): Whether we are intrested in the bias or nonbias fit parameters
+        nanoparticles (boolean): Whether to include the nanoparticle parameters
+    Returns:
+        param_list_bias (tuple, if bias): List of parameters for bias data set
+        param_list_nobias (tuple, if no bias): List of parameters for no bias data set
+    """
     #solving for variable values
     Cion_bias = find.get_Cion(wion_bias, Rion)
     Cion_nobias = find.get_Cion(wion_nobias, Rion)
@@ -49,13 +75,12 @@ def param_guesser(bias_data, nobias_data, IV_data, bias_voltage, kbt=4.130211483
     CA_ratio = CA/Cion_bias
 
     n = (spc.elementary_charge/kbt * (1 - Cion_bias/CA) * bias_voltage /
-          sps.lambertw(1/Js/Rninf * (1 - Cion_bias/CA) * bias_voltage ).real)
+          lambertw(1/Js/Rninf * (1 - Cion_bias/CA) * bias_voltage ).real)
     
     if wnano is not None:
-        Rnano = find.get_Rnano(bias_data[:,1], bias_data[:,2], wnano, Rninf, Rs)
         Cnano = find.get_Cnano(wnano, Rnano)
         n = (spc.elementary_charge/kbt * (1 - Cion_bias/CA) * bias_voltage /
-          sps.lambertw(1/Js/(Rninf - Rnano) * (1 - Cion_bias/CA) * bias_voltage ).real) 
+          lambertw(1/Js/(Rninf - Rnano) * (1 - Cion_bias/CA) * bias_voltage ).real) 
 
     if nanoparticles:
         param_list_bias = (CA_ratio, Cg_bias, Cion_bias, Rion, kbt, n, Js, bias_voltage, Rs, Rsh, Rnano, Cnano)
@@ -69,6 +94,41 @@ def param_guesser(bias_data, nobias_data, IV_data, bias_voltage, kbt=4.130211483
     else:
         return param_list_nobias
 
+@timed("param_guesser_batch")
+def param_guesser_batch(bias_stack, nobias_stack, IV_stack, bias_voltages, kbt=4.1302114835e-21,
+                        Js=2.31e-16, bias=True, nanoparticles=False):
+    """
+    Calculates parameter guess values for a whole stack of spectra at once, e.g. to seed thousands of fits
+    Gives the same guesses as param_guesser with run_checker=False
+    Args:
+        bias_stack (array): shape (S, N, columns), impedance data taken under bias, see Batch_finder.stack_spectra
+        nobias_stack (array): shape (S, M, columns), or (M, columns) if every spectrum shares one 0V reference
+        IV_stack (array or None): shape (S, K, columns) or (K, columns), Current-Voltage data
+        bias_voltages (array or float): Voltage under which each spectrum was taken
+        kbt (float): Boltzmann constant times temperature
+        Js (float): Saturation current of material
+        bias (boolean): Whether we are intrested in the bias or nonbias fit parameters
+        nanoparticles (boolean): Whether to check for a nanoparticle time constant
+    Returns:
+        guesses (array): shape (S, number of parameters), rows of spectra whose features could not be found are nan
+    """
+    features = find_features(bias_stack, nobias_stack, IV_stack, nanoparticle=nanoparticles)
+
+    Rnano = None
+    if nanoparticles:
+        #Finder.get_Rnano using the index of wnano
+        Zreal_nano = np.take_along_axis(bias_stack[:,:,2], features["wnano_index"][:, np.newaxis], axis=1)[:,0]
+        Rnano = 2 * (features["Rninf"] + features["Rs"] - Zreal_nano)
+
+    bias_voltages = np.broadcast_to(np.asarray(bias_voltages, dtype=float), (len(bias_stack),))
+    params = guess_from_features(features["Rion"], features["Rsh"], features["Rs"], features["Rn0"], features["Rninf"],
+                                 features["wg_bias"], features["wg_nobias"], features["wion_bias"],
+                                 features["wion_nobias"], features["wnano"], Rnano, bias_voltages, kbt, Js, bias,
+                                 nanoparticles)
+    guesses = np.column_stack(np.broadcast_arrays(*params))
+    guesses[~features["found"]] = np.nan
+    return guesses
+
     
 
 if __name__ == "__main__":
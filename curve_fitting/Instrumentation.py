@@ -0,0 +1,208 @@
+"""
+Opt-in counters and timers for profiling fits
+Code is instrumented with count, set_value, timer and timed, which do nothing unless instrumentation
+is enabled and a record is open, so the hooks can stay in place when profiling is off.
+A record is opened around each fit with record(), giving a per-fit dictionary of counts, times and
+values, and the records of a batch are combined with aggregate()
+
+    with profiling(), record() as profile:
+        fit_leastsq(...)
+    print_report(profile)
+
+Timothy Chew
+18/10/26
+"""
+
+import time
+import contextlib
+import functools
+
+import numpy as np
+
+#whether record() opens records, see enable
+_enabled = False
+
+#record being filled, None when instrumentation is off or no record is open
+_active = None
+
+#returned by timer when there is no record, reused so a disabled timer makes no objects
+_null_timer = contextlib.nullcontext()
+
+def enable(enabled=True):
+    """
+    Turns instrumentation on or off for this process
+    Args:
+        enabled (boolean): Whether record() should open records
+    """
+    global _enabled
+    _enabled = enabled
+
+@contextlib.contextmanager
+def profiling(enabled=True):
+    """
+    Turns instrumentation on inside the with block and restores the previous state after it, also if the block raises,
+    so profiling one call does not leave instrumentation on for the rest of the process
+    Args:
+        enabled (boolean): Whether to turn instrumentation on, False leaves it as it is
+    """
+    global _enabled
+    previous = _enabled
+    _enabled = _enabled or enabled
+    try:
+        yield
+    finally:
+        _enabled = previous
+
+def is_enabled():
+    """
+    Whether instrumentation is on in this process
+    """
+    return _enabled
+
+def new_record():
+    """
+    Empty record
+    Returns:
+        record (dict): 'counts' (name -> count), 'times' (name -> [calls, seconds]) and 'values' (name -> last value)
+    """
+    return {"counts": {}, "times": {}, "values": {}}
+
+@contextlib.contextmanager
+def record():
+    """
+    Collects everything counted and timed inside the with block into a new record
+    Records can be nested, the inner record is filled until its block ends
+    Yields:
+        record (dict or None): record from new_record, filled in place. None if instrumentation is off
+    """
+    global _active
+    if not _enabled:
+        yield None
+        return
+
+    previous = _active
+    _active = new_record()
+    start = time.perf_counter()
+    try:
+        yield _active
+    finally:
+        _active["values"]["total_s"] = time.perf_counter() - start
+        _active = previous
+
+def count(name, n=1):
+    """
+    Adds n to a counter of the open record
+    """
+    if _active is not None:
+        counts = _active["counts"]
+        counts[name] = counts.get(name, 0) + n
+
+def set_value(name, value):
+    """
+    Stores a value, e.g. the final cost, in the open record
+    """
+    if _active is not None:
+        _active["values"][name] = value
+
+class Timer:
+    """
+    Context manager adding the time spent in its block to a timer of the open record
+    """
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        entry = self.times.setdefault(self.name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        return False
+
+def timer(name):
+    """
+    Times a with block
+    Args:
+        name (string): name of the timer
+    Returns:
+        context manager, a shared do-nothing one if no record is open
+    """
+    if _active is None:
+        return _null_timer
+    return Timer(_active["times"], name)
+
+def timed(name):
+    """
+    Decorator timing every call of a function, see timer
+    Args:
+        name (string): name of the timer
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return function(*args, **kwargs)
+            with Timer(_active["times"], name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def aggregate(records):
+    """
+    Combines per-fit records, e.g. from a batch run
+    Args:
+        records (list): records from record(), None entries are skipped
+    Returns:
+        report (dict): 'fits' (number of records), 'counts' (summed counts), 'times' (name -> dict of 'calls',
+        'total_s' and 'mean_s' per call) and 'values' (name -> dict of 'min', 'median', 'max' of the finite values
+        over the fits). Timers can be nested, e.g. lambertw inside Z, so times overlap rather than adding up
+    """
+    records = [entry for entry in records if entry is not None]
+    report = {"fits": len(records), "counts": {}, "times": {}, "values": {}}
+
+    for entry in records:
+        for name, value in entry["counts"].items():
+            report["counts"][name] = report["counts"].get(name, 0) + value
+        for name, (calls, seconds) in entry["times"].items():
+            total = report["times"].setdefault(name, {"calls": 0, "total_s": 0.0})
+            total["calls"] += calls
+            total["total_s"] += seconds
+    for total in report["times"].values():
+        total["mean_s"] = total["total_s"] / total["calls"]
+
+    names = {name for entry in records for name in entry["values"]}
+    for name in sorted(names):
+        values = np.array([entry["values"][name] for entry in records if entry["values"].get(name) is not None],
+                          dtype=float)
+        values = values[np.isfinite(values)]
+        if len(values) != 0:
+            report["values"][name] = {"min": float(np.min(values)), "median": float(np.median(values)),
+                                      "max": float(np.max(values))}
+    return report
+
+def print_report(report):
+    """
+    Prints a record from record() or a report from aggregate()
+    """
+    if report is None:
+        print("Instrumentation is off, nothing recorded")
+        return
+    if "fits" in report:
+        print(f"Profile of {report['fits']} fits")
+    for name, value in sorted(report["counts"].items()):
+        print(f"{name:<30} {value:>12}")
+    for name, value in sorted(report["times"].items()):
+        if isinstance(value, dict):
+            calls, seconds = value["calls"], value["total_s"]
+        else:
+            calls, seconds = value
+        print(f"{name:<30} {seconds*1e3:9.2f} ms in {calls} calls")
+    for name, value in sorted(report["values"].items()):
+        if isinstance(value, dict):
+            print(f"{name:<30} min {value['min']:.4g}  median {value['median']:.4g}  max {value['max']:.4g}")
+        else:
+            print(f"{name:<30} {value}")
@@ -0,0 +1,60 @@
+"""
+Robust loss functions of the least squares fits
+Uses the losses of scipy.optimize.least_squares: with a robust loss, residuals much larger than f_scale
+(e.g. the high frequency points where -Z'' turns negative) count less than their square, so a few outlying
+points do not pull the whole fit
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+#loss names accepted by fit_leastsq, the names used by scipy.optimize.least_squares
+LOSSES = ("linear", "soft_l1", "huber", "cauchy", "arctan")
+
+def rho(z, loss):
+    """
+    Loss function of squared residuals z, as defined by scipy.optimize.least_squares
+    """
+    if loss == "linear":
+        return z
+    if loss == "soft_l1":
+        return 2 * (np.sqrt(1 + z) - 1)
+    if loss == "huber":
+        return np.where(z <= 1, z, 2 * np.sqrt(z) - 1)
+    if loss == "cauchy":
+        return np.log1p(z)
+    if loss == "arctan":
+        return np.arctan(z)
+    raise ValueError(f"Unknown loss '{loss}', expected one of {LOSSES}")
+
+def robust_cost(residuals, loss="linear", f_scale=1.0, axis=None):
+    """
+    Cost of residuals under a loss, the sum of squared residuals for the linear loss
+    Args:
+        residuals (array): residuals
+        loss (string): one of LOSSES
+        f_scale (float): residuals larger than f_scale are treated as outliers by the robust losses
+        axis (int or None): axis to sum over, None sums every residual
+    Returns:
+        cost (float, or array if axis is given): f_scale^2 * sum(rho((residuals/f_scale)^2)),
+        twice scipy.optimize.least_squares' cost
+    """
+    residuals = np.asarray(residuals, dtype=float)
+    if loss == "linear":
+        cost = np.sum(residuals**2, axis=axis)
+    else:
+        cost = f_scale**2 * np.sum(rho((residuals / f_scale)**2, loss), axis=axis)
+    return float(cost) if axis is None else cost
+
+def default_f_scale(ydata):
+    """
+    Residual size above which robust losses treat points as outliers, 1% of the typical impedance
+    Args:
+        ydata (array): Stacked real and imaginary impedance data
+    Returns:
+        f_scale (float)
+    """
+    f_scale = 0.01 * np.median(np.abs(ydata))
+    return float(f_scale) if np.isfinite(f_scale) and f_scale > 0 else 1.0
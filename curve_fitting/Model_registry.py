@@ -0,0 +1,179 @@
+"""
+Registry of impedance models
+A model is a folder containing Impedancefunction.py and Initial_params.csv (see README.md). Each folder is loaded once
+per process: the module is executed and Initial_params.csv parsed on the first get_model call, and later calls return
+the same ImpedanceModel, so batch runs over many spectra pay the load cost once. A folder is loaded again when either
+file changes (modification time or size), so a model edited while the GUI is open is picked up by the next fit.
+Models declare what they support with a CAPABILITIES dict in Impedancefunction.py:
+
+    CAPABILITIES = {"guesser": "nanoparticles", "jacobian": True, "vectorized": True}
+
+guesser: param_guesser mode estimating starting parameters from the data, "single_transistor" or "nanoparticles",
+         None if the model has no guesser (it can then only be plotted with manual parameters)
+jacobian: whether dZ gives analytic derivatives, default whether dZ exists
+vectorized: whether Z broadcasts over stacked parameter sets (see Param_sweep.py), checked once if not declared
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+import importlib.util
+
+import numpy as np
+
+from curve_fitting.Curve_fitting import read_param_settings
+from curve_fitting.Param_sweep import supports_broadcasting
+
+#folder of the built-in models, next to the curve_fitting folder
+BUILTIN_MODELS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "builtin_models")
+
+#param_guesser modes, see Guesser.param_guesser
+GUESSERS = ("single_transistor", "nanoparticles")
+
+#models loaded by this process, absolute folder path -> (file signature, ImpedanceModel)
+_models = {}
+
+#files of a model folder, the model is reloaded when one of them changes
+MODEL_FILES = ("Impedancefunction.py", "Initial_params.csv")
+
+#built-in model name -> folder, found on first use
+_builtin_folders = None
+
+class ImpedanceModel:
+    """
+    Impedance model loaded from a model folder
+    Attributes:
+        name (string): folder name, e.g. nanoparticles_model
+        folder (string): absolute path of the folder
+        module (module): the executed Impedancefunction.py
+        Z (function): Complex impedance function Z(w, *params)
+        dZ (function or None): Analytic derivatives of Z, None if the model has no jacobian
+        bound_Z (class or None): the module's BoundZ, Z bound to a frequency array, see Compiled_model.py
+        init_paramfilename (string): path of Initial_params.csv
+        param_names (list), init_values (array), log_mask (array): contents of Initial_params.csv, see read_param_settings
+        guesser (string or None): param_guesser mode, see CAPABILITIES above
+        vectorized (boolean): whether Z broadcasts over stacked parameter sets
+    """
+    def __init__(self, folder, module):
+        """
+        Args:
+            folder (string): absolute path of the model folder
+            module (module): the executed Impedancefunction.py of the folder
+        """
+        self.folder = folder
+        self.name = os.path.basename(folder)
+        self.module = module
+        self.Z = getattr(module, "Z", None)
+        self.bound_Z = getattr(module, "BoundZ", None)
+        capabilities = getattr(module, "CAPABILITIES", {})
+
+        self.init_paramfilename = os.path.join(folder, "Initial_params.csv")
+        self.param_names, self.init_values, self.log_mask = read_param_settings(self.init_paramfilename)
+
+        self.guesser = capabilities.get("guesser")
+        if self.guesser not in GUESSERS + (None,):
+            raise ValueError(f"Unknown guesser '{self.guesser}' in {self.name}, expected one of {GUESSERS}")
+        dZ = getattr(module, "dZ", None)
+        self.dZ = dZ if capabilities.get("jacobian", dZ is not None) else None
+        if "vectorized" in capabilities:
+            self.vectorized = bool(capabilities["vectorized"])
+        else:
+            with np.errstate(all="ignore"):
+                self.vectorized = supports_broadcasting(self.Z, np.logspace(0, 6, 8), np.abs(self.init_values))
+
+    @property
+    def supported(self):
+        """
+        Whether the model can be fitted, i.e. its starting parameters can be guessed from the data
+        """
+        return self.guesser is not None and self.Z is not None
+
+    @property
+    def nano(self):
+        """
+        Whether param_guesser should guess the nanoparticle parameters
+        """
+        return self.guesser == "nanoparticles"
+
+def builtin_models():
+    """
+    Built-in model folders, found once per process
+    Returns:
+        folders (dict): model name -> absolute folder path, for every folder of builtin_models with an Impedancefunction.py
+    """
+    global _builtin_folders
+    if _builtin_folders is None:
+        _builtin_folders = {}
+        for name in sorted(os.listdir(BUILTIN_MODELS_FOLDER)):
+            folder = os.path.join(BUILTIN_MODELS_FOLDER, name)
+            if os.path.isfile(os.path.join(folder, "Impedancefunction.py")):
+                _builtin_folders[name] = folder
+    return _builtin_folders
+
+def resolve_folder(imp_model_folder):
+    """
+    Absolute path of a model folder
+    Accepts / or \\ separated paths, and built-in model names on their own (e.g. nanoparticles_model)
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model
+    Returns:
+        folder (string): absolute path, not checked to exist unless it is a built-in model
+    """
+    folder = os.path.normpath(imp_model_folder)
+    if not os.path.isdir(folder):
+        folder = os.path.normpath(imp_model_folder.replace("\\", "/"))
+    if not os.path.isdir(folder):
+        name = os.path.basename(folder)
+        folder = builtin_models().get(name, folder)
+    return os.path.abspath(folder)
+
+def load_module(folder):
+    """
+    Executes a model folder's Impedancefunction.py
+    Args:
+        folder (string): path of the model folder
+    Returns:
+        module, or None if there is no Impedancefunction.py
+    """
+    spec = importlib.util.spec_from_file_location("Impedancefunction", os.path.join(folder, "Impedancefunction.py"))
+    if spec is None or not os.path.isfile(spec.origin):
+        return None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def file_signature(folder):
+    """
+    Modification time and size of the files of a model folder
+    Args:
+        folder (string): path of the model folder
+    Returns:
+        signature (tuple): (mtime in ns, size) of each of MODEL_FILES, None for missing files
+    """
+    signature = []
+    for filename in MODEL_FILES:
+        try:
+            stat = os.stat(os.path.join(folder, filename))
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+def get_model(imp_model_folder):
+    """
+    Loads a model folder, once per process unless its files change
+    Args:
+        imp_model_folder (string): name of folder containing the impedance model, or a built-in model name
+    Returns:
+        model (ImpedanceModel), or None if the folder has no Impedancefunction.py
+    """
+    folder = resolve_folder(imp_model_folder)
+    signature = file_signature(folder)
+    if folder not in _models or _models[folder][0] != signature:
+        module = load_module(folder)
+        if module is None:
+            print(f"Cannot load module from folder: {imp_model_folder}")
+            return None
+        _models[folder] = (signature, ImpedanceModel(folder, module))
+    return _models[folder][1]
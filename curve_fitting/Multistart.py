@@ -0,0 +1,218 @@
+"""
+Multi-start fitting for spectra where a single fit from the guessed parameters fails or stops in a poor minimum
+Starts are spread around the guess with a scrambled Sobol sequence in log10(parameter) space, screened in one
+broadcast evaluation of the model (see Param_sweep.evaluate_Z_grid), and the best are refined with short least
+squares runs, halving the survivors after every round so that compute goes to the promising starts.
+The survivors of the last round are run to convergence and the best fit is returned with a report of the search
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+from scipy.optimize import least_squares
+
+from curve_fitting.Param_sweep import evaluate_Z_grid
+from curve_fitting.Compiled_model import compile_model
+from curve_fitting.Instrumentation import count, timer
+from curve_fitting.Uncertainty import covariance_from_jacobian
+from curve_fitting.Loss import robust_cost
+
+def sobol_starts(seed_params, free_indices, n_starts=64, decades=1.0, seed=0):
+    """
+    Starting parameter sets spread around seed_params
+    Args:
+        seed_params (array): parameters to spread the starts around, must be >0
+        free_indices (array): indices of the parameters to vary
+        n_starts (int): number of starting sets, the first is seed_params itself
+        decades (float): starts vary each free parameter by up to this many decades either side of the seed
+        seed (int): seed of the scrambled Sobol sequence, so the same starts are used every run
+    Returns:
+        starts (array): shape (n_starts, no. of params)
+    """
+    #scipy.stats takes ~0.4s to import, only load it when multi-start fitting is used
+    from scipy.stats import qmc
+
+    seed_params = np.asarray(seed_params, dtype=float)
+    starts = np.tile(seed_params, (n_starts, 1))
+    if n_starts > 1 and len(free_indices) != 0:
+        sampler = qmc.Sobol(d=len(free_indices), scramble=True, seed=seed)
+        u = sampler.random_base2(int(np.ceil(np.log2(n_starts - 1))))[:n_starts - 1]
+        offsets = decades * (2*u - 1)
+        starts[1:, free_indices] = seed_params[free_indices] * 10**offsets
+    return starts
+
+def screen_costs(Z, w, ydata, param_sets, loss="linear", f_scale=1.0, weights=None, vectorized=None):
+    """
+    Cost of every parameter set, evaluated in broadcast passes
+    Args:
+        Z (function): Complex impedance function
+        w (array): Angular frequency data
+        ydata (array): Stacked real and imaginary (-Z'') impedance data
+        param_sets (array): shape (M, no. of params)
+        loss (string): loss of the costs, see Loss.robust_cost
+        f_scale (float): see Loss.robust_cost
+        weights (array or None): weights of the residuals, see Weighting.residual_weights
+        vectorized (boolean or None): whether Z broadcasts over parameter sets, see Param_sweep.evaluate_Z_grid
+    Returns:
+        costs (array): shape (M,), inf for parameter sets giving non-finite impedance
+    """
+    count("Z_evaluations", len(param_sets))
+    with np.errstate(all="ignore"), timer("Z"):
+        Z_values = evaluate_Z_grid(Z, w, param_sets, vectorized=vectorized)
+        residuals = np.hstack([Z_values.real, -Z_values.imag]) - ydata
+        if weights is not None:
+            residuals *= weights
+        costs = robust_cost(residuals, loss, f_scale, axis=1)
+    costs[~np.isfinite(costs)] = np.inf
+    return costs
+
+def fit_multistart(Z, w, ydata, seed_params, free_indices, dZ=None, n_starts=64, decades=1.0, n_keep=8,
+                   round_nfev=(5, 20), max_nfev=None, seed=0, loss="linear", f_scale=1.0, weights=None,
+                   bound_decades=3.0, lower=None, upper=None, vectorized=None, bound_Z=None):
+    """
+    Fits from many starting points around seed_params and returns the best fit
+    Free parameters are optimised as log10(parameter) within bound_decades of the seed, so they stay >0 and finite.
+    Parameters the data cannot determine (e.g. kbt and n_AB, which only enter as their product) would otherwise
+    drift until 10**x overflows, they should be left out of free_indices
+    Args:
+        Z (function): Complex impedance function to fit to
+        w (array): Angular frequency data
+        ydata (array): Stacked real and imaginary (-Z'') impedance data
+        seed_params (array): starting parameters, e.g. from param_guesser, must be finite and >0
+        free_indices (array): indices of the parameters to fit, the others stay at their seed_params values
+        dZ (function or None): Analytic derivatives of Z, see fit_leastsq. If None finite differences are used
+        n_starts (int): number of starting points screened
+        decades (float): starts vary each free parameter by up to this many decades either side of the seed
+        n_keep (int): number of best screened starts which are refined
+        round_nfev (tuple): iteration budget of each pruning round, the best half of the starts survive each round
+        max_nfev (int or None): iteration budget of each final run to convergence, None uses 100 per free parameter
+        seed (int): seed of the Sobol sequence
+        loss (string): loss of every fit, see fit_leastsq
+        f_scale (float): weighted residuals larger than f_scale count as outliers under a robust loss
+        weights (array or None): weights of the residuals, see Weighting.residual_weights
+        bound_decades (float): the fits stay within this many decades either side of the seed, at least decades
+        lower, upper (array or None): further bounds of the free parameters in parameter units, in the order of
+                                      free_indices. Bounds <=0 are ignored
+        vectorized (boolean or None): whether Z broadcasts over parameter sets, see Param_sweep.evaluate_Z_grid
+        bound_Z (class or None): the model's BoundZ class used for the refining fits, see Compiled_model.py
+        The compute budget is at most n_starts broadcast evaluations, n_keep*round_nfev[0] + n_keep/2*round_nfev[1] + ...
+        iterations in the pruning rounds and max_nfev iterations for each of the final survivors
+    Returns:
+        fitted_params (array): best parameters found
+        report (dict): 'success' (whether the best final run converged), 'cost' (sum of squared weighted residuals
+        of the best fit, or its cost under a robust loss, see Loss.robust_cost),
+        'nfev' (model evaluations, counting each screened start as one), 'seed_cost', 'screened_best_cost',
+        'rounds' (survivors and best cost after each round), 'final_costs' (costs of the final runs) and
+        'agreement' (number of final runs within 1% of the best cost, >1 suggests the minimum is found repeatably)
+        'covariance' (covariance of log10 of the free parameters from the best fit's final Jacobian,
+        see Uncertainty.covariance_from_jacobian) and 'at_bound' (boolean array over free_indices,
+        True where the best fit ended on a bound of the search window)
+    """
+    seed_params = np.asarray(seed_params, dtype=float)
+    free_indices = np.sort(np.asarray(free_indices, dtype=int))
+    ln10 = np.log(10)
+    if max_nfev is None:
+        max_nfev = 100 * len(free_indices)
+
+    fixed_indices = np.setdiff1d(np.arange(len(seed_params)), free_indices)
+    model = compile_model(Z, w, len(seed_params), fixed_indices, seed_params[fixed_indices], dZ=dZ, bound_Z=bound_Z)
+    model.set_weights(weights)
+    weighted_ydata = ydata if weights is None else ydata * weights
+
+    def to_params(x):
+        params = seed_params.copy()
+        params[free_indices] = 10**x
+        return params
+
+    def residuals(x):
+        count("Z_evaluations")
+        with timer("Z"):
+            return model.evaluate(10**x) - weighted_ydata
+
+    def jacobian(x):
+        free_params = 10**x
+        count("dZ_evaluations")
+        with timer("dZ"):
+            return model.jacobian(free_params) * (free_params * ln10)
+
+    def refine(x0, nfev):
+        #log10 values are of order 1, so steps are not rescaled (see Curve_fitting.fit_free_params).
+        #Analytic derivatives can overflow far from the data, finite differences are tried before dropping the start
+        result = None
+        for jac in ([jacobian, "2-point"] if dZ is not None else ["2-point"]):
+            try:
+                with np.errstate(all="ignore"):
+                    result = least_squares(residuals, x0, jac=jac, bounds=(x_lower, x_upper), method="trf",
+                                           x_scale=1.0, max_nfev=nfev, loss=loss, f_scale=f_scale)
+                break
+            except ValueError:
+                continue
+        if result is None:
+            #residuals not finite at x0
+            return x0, np.inf, 1, False, None
+        finite = np.isfinite(result.cost) and np.all(np.isfinite(to_params(result.x)))
+        cost = 2 * result.cost if finite else np.inf
+        return result.x, cost, result.nfev, result.status > 0 and finite, result
+
+    #search window in log10(parameter)
+    log_seed = np.log10(seed_params[free_indices])
+    bound_decades = max(bound_decades, decades)
+    x_lower = log_seed - bound_decades
+    x_upper = log_seed + bound_decades
+    with np.errstate(divide="ignore", invalid="ignore"):
+        #lower bounds <= 0 are no bound in log space
+        log_lower = np.log10(np.fmax(np.broadcast_to(0.0 if lower is None else lower, len(free_indices)), 0))
+        log_upper = np.log10(np.broadcast_to(np.inf if upper is None else upper, len(free_indices)))
+    x_lower, x_upper = np.fmax(x_lower, log_lower), np.fmin(x_upper, log_upper)
+    #a seed outside the bounds is searched for within the bounds only
+    outside = x_lower >= x_upper
+    x_lower[outside], x_upper[outside] = log_lower[outside], log_upper[outside]
+
+    #screen every start in one broadcast evaluation
+    starts = sobol_starts(seed_params, free_indices, n_starts, decades, seed)
+    starts[:, free_indices] = np.clip(starts[:, free_indices], 10**x_lower, 10**x_upper)
+    costs = screen_costs(Z, w, ydata, starts, loss, f_scale, weights, vectorized)
+    order = np.argsort(costs, kind="stable")[:n_keep]
+    order = order[np.isfinite(costs[order])]
+    if len(order) == 0:
+        order = np.array([0]) #nothing finite, try the seed anyway
+    candidates = [np.clip(np.log10(starts[i, free_indices]), x_lower, x_upper) for i in order]
+    nfev = n_starts
+
+    report = {"seed_cost": float(costs[0]), "screened_best_cost": float(costs[order[0]]), "rounds": []}
+
+    #successive halving: short runs, keep the best half
+    for round_budget in round_nfev:
+        if len(candidates) <= 1:
+            break
+        results = [refine(x0, round_budget) for x0 in candidates]
+        nfev += sum(result[2] for result in results)
+        round_costs = np.array([result[1] for result in results])
+        survivors = np.argsort(round_costs, kind="stable")[:max(1, len(candidates) // 2)]
+        candidates = [results[i][0] for i in survivors]
+        report["rounds"].append({"max_nfev": round_budget, "survivors": len(candidates),
+                                 "best_cost": float(round_costs[survivors[0]])})
+
+    #run the survivors to convergence
+    results = [refine(x0, max_nfev) for x0 in candidates]
+    nfev += sum(result[2] for result in results)
+    final_costs = np.array([result[1] for result in results])
+    best = int(np.argmin(final_costs))
+    if not np.isfinite(final_costs[best]):
+        print("Unable to find optimal params from any start: using guess params")
+
+    report["final_costs"] = [float(cost) for cost in final_costs]
+    report["agreement"] = int(np.sum(final_costs <= final_costs[best] * 1.01))
+    report["cost"] = float(final_costs[best])
+    report["nfev"] = int(nfev)
+    report["success"] = bool(results[best][3] and np.isfinite(final_costs[best]))
+    if not np.isfinite(final_costs[best]):
+        report["covariance"] = np.full((len(free_indices), len(free_indices)), np.nan)
+        report["at_bound"] = np.zeros(len(free_indices), dtype=bool)
+        return seed_params.copy(), report
+    #result.jac is rescaled by a robust loss, pair it with the robust cost as in fit_free_params
+    report["covariance"] = covariance_from_jacobian(results[best][4].jac, results[best][4].fun,
+                                                    sum_squares=2 * results[best][4].cost)
+    report["at_bound"] = results[best][4].active_mask != 0
+    return to_params(results[best][0]), report
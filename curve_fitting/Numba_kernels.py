@@ -0,0 +1,162 @@
+"""
+Helpers shared by the compiled (numba) impedance kernels of the built-in models
+Each model writes its kernel as a function of complex division (cdiv) and lambertw, built here, and keeps it in a
+KernelBackend which compiles it on first use. check_backends compares the compiled kernel and the model's BoundZ
+against its numpy Z, so the three copies of the formula are tested against each other.
+Without numba the models use their numpy versions
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def build_cdiv():
+    """
+    Compiles complex division for kernels
+    Returns:
+        cdiv (function): complex a/b using the same algorithm as numpy, numba's own division raises when b is 0
+    """
+    @numba.njit(error_model="numpy")
+    def cdiv(a, b):
+        num = a + 0j
+        if abs(b.real) >= abs(b.imag):
+            if b.real == 0:
+                return complex(num.real / 0.0, num.imag / 0.0)
+            ratio = b.imag / b.real
+            denom = b.real + b.imag * ratio
+            return complex((num.real + num.imag * ratio) / denom, (num.imag - num.real * ratio) / denom)
+        ratio = b.real / b.imag
+        denom = b.real * ratio + b.imag
+        return complex((num.real * ratio + num.imag) / denom, (num.imag * ratio - num.real) / denom)
+    return cdiv
+
+def build_lambertw(cdiv):
+    """
+    Compiles the principal branch of the lambert W function for kernels, solved using the same method as scipy
+    Args:
+        cdiv (function): complex division from build_cdiv
+    Returns:
+        lambertw (function): W(z) of a complex scalar, nan if the Halley iterations do not converge
+    """
+    @numba.njit(error_model="numpy")
+    def lambertw(z):
+        #initial guess as in scipy.special.lambertw then Halley iterations
+        if z == 0:
+            return 0j
+        if abs(z + np.exp(-1)) < 0.3:
+            p = np.sqrt(2 * (np.e * z + 1))
+            w = -1 + p - p**2/3 + 11/72 * p**3
+        elif -1.0 < z.real < 1.5 and abs(z.imag) < 1.0 and -2.5 * abs(z.imag) - 0.2 < z.real:
+            w = z * cdiv(z * (z * 12.85106382978723404255 + 12.34042553191489361902) + 1,
+                         z * (z * 32.53191489361702127660 + 14.34042553191489361702) + 1)
+        else:
+            w = np.log(z) - np.log(np.log(z))
+
+        for i in range(100):
+            ew = np.exp(w)
+            wew = w * ew
+            wewz = wew - z
+            wn = w - cdiv(wewz, wew + ew - cdiv((w + 2) * wewz, 2*w + 2))
+            if abs(wn - w) <= 1e-8 * abs(wn):
+                return wn
+            w = wn
+        return complex(np.nan, np.nan)
+    return lambertw
+
+class KernelBackend:
+    """
+    A model's compiled kernel, compiled on the first call to get_kernel
+    Attributes:
+        backend (string): "numba" to use the compiled kernel, set to "numpy" to force the numpy version.
+                          Becomes "numpy" if numba is not installed or the kernel cannot be compiled
+    """
+    def __init__(self, build_kernel):
+        """
+        Args:
+            build_kernel (function): compiles and returns the model's vectorized kernel, raises if it can't.
+                                     Only called if numba is installed
+        """
+        self.build_kernel = build_kernel
+        self.backend = "numba" if numba is not None else "numpy"
+        self._kernel = None
+
+    def compile(self):
+        """
+        Compiles a new kernel
+        Returns:
+            The kernel, or None if numba is not installed or it can't be compiled
+        """
+        if numba is None:
+            return None
+        try:
+            return self.build_kernel()
+        except Exception as error:
+            print(f"Unable to compile impedance kernel, using numpy: {error}")
+            return None
+
+    def get_kernel(self):
+        """
+        Compiled kernel, compiled on the first call
+        Returns:
+            The kernel, or None if the numpy version is used
+        """
+        if self.backend == "numba" and self._kernel is None:
+            self._kernel = self.compile()
+            if self._kernel is None:
+                self.backend = "numpy"
+        return self._kernel if self.backend == "numba" else None
+
+def check_backends(Z_numpy, kernel_backend, BoundZ, init_params, rtol=1e-12, n_samples=1000):
+    """
+    Checks a model's compiled kernel and BoundZ against its Z_numpy over random parameter sets
+    within a decade of init_params
+    Args:
+        Z_numpy (function): numpy impedance function, the reference
+        kernel_backend (KernelBackend): the model's compiled kernel
+        BoundZ (class): the model's Z bound to frequencies, see Compiled_model.py. Checked with the numpy backend
+        init_params (array): parameters the random sets are spread around
+        rtol (float): Maximum allowed relative error
+        n_samples (int): Number of random parameter sets
+    Returns:
+        passed (boolean): True if every checked backend agrees with Z_numpy within rtol
+        errors (dict): largest relative error of each checked backend, 'numba' and 'BoundZ'.
+                       'numba' is None if numba is not installed or the kernel can't be compiled, it is then not checked
+    """
+    init_params = np.asarray(init_params, dtype=float)
+    rng = np.random.default_rng(0)
+    param_sets = init_params * 10 ** rng.uniform(-1, 1, size=(n_samples, len(init_params)))
+    w = np.logspace(-2, 6, 50)
+
+    with np.errstate(all="ignore"):
+        Z_ref = Z_numpy(w[np.newaxis, :], *param_sets.T[:, :, np.newaxis])
+    finite = np.isfinite(Z_ref)
+
+    def max_error(Z_values):
+        return float(np.max(np.abs(Z_values[finite] - Z_ref[finite]) / np.abs(Z_ref[finite])))
+
+    errors = {"numba": None}
+    kernel = kernel_backend.compile()
+    if kernel is not None:
+        errors["numba"] = max_error(kernel(w[np.newaxis, :], *param_sets.T[:, :, np.newaxis]))
+
+    #BoundZ uses the kernel if there is one, check its numpy code
+    backend = kernel_backend.backend
+    kernel_backend.backend = "numpy"
+    try:
+        bound_Z = BoundZ(w)
+        Z_bound = np.empty_like(Z_ref)
+        with np.errstate(all="ignore"):
+            for i, params in enumerate(param_sets):
+                bound_Z(params, Z_bound[i])
+    finally:
+        kernel_backend.backend = backend
+    errors["BoundZ"] = max_error(Z_bound)
+
+    passed = all(error <= rtol for error in errors.values() if error is not None)
+    return passed, errors
@@ -0,0 +1,104 @@
+"""
+Evaluates impedance functions for many parameter sets at once
+Used for parameter sweeps and sensitivity studies
+
+Impedance functions follow the broadcasting contract if Z(w, *params) with w of shape (1, N)
+and every parameter of shape (M, 1) returns a complex array of shape (M, N).
+The built-in models follow this contract, models which don't are evaluated one parameter set at a time
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+def evaluate_Z_grid(Z, w, param_sets, chunk_size=None, vectorized=None):
+    """
+    Evaluates Z for every parameter set over a frequency array in broadcast numpy passes
+    Args:
+        Z (function): Complex impedance function Z(w, *params)
+        w (array): Angular frequencies, shape (N,)
+        param_sets (array): Parameter sets, shape (M, no. of params), one row per parameter set
+        chunk_size (int or None): Number of parameter sets per numpy pass, limits the size of temporary arrays.
+                                  If None, chunks hold roughly one million impedance values
+        vectorized (boolean or None): Whether Z follows the broadcasting contract, e.g. ImpedanceModel.vectorized
+                                      (see Model_registry.py). False evaluates one parameter set at a time,
+                                      None tries a broadcast pass and falls back to a loop if it raises
+                                      or gives the wrong shape
+    Returns:
+        Z_values (array): Complex impedance, shape (M, N), row i is Z(w, *param_sets[i])
+    """
+    w = np.asarray(w, dtype=float)
+    param_sets = np.atleast_2d(np.asarray(param_sets, dtype=float))
+    M = param_sets.shape[0]
+    N = w.shape[0]
+
+    if chunk_size is None:
+        chunk_size = max(1, 2**20 // max(N, 1))
+
+    Z_values = np.empty((M, N), dtype=complex)
+    w_row = w[np.newaxis, :]
+
+    for start in range(0, M, chunk_size):
+        chunk = param_sets[start:start+chunk_size]
+        #each parameter becomes a column so it broadcasts against the frequency row
+        Z_chunk = None
+        if vectorized is not False:
+            try:
+                Z_chunk = Z(w_row, *chunk.T[:, :, np.newaxis])
+            except Exception:
+                #e.g. models using cmath or math, which only take scalars
+                if vectorized:
+                    raise
+
+        if np.shape(Z_chunk) != (chunk.shape[0], N):
+            #model does not follow the broadcasting contract, the first chunk shows it for the rest
+            vectorized = False
+            Z_chunk = np.array([Z(w, *params) for params in chunk])
+
+        Z_values[start:start+chunk_size] = Z_chunk
+
+    return Z_values
+
+def supports_broadcasting(Z, w, params):
+    """
+    Checks whether an impedance function follows the broadcasting contract
+    by comparing a two row broadcast evaluation with separate evaluations
+    Args:
+        Z (function): Complex impedance function Z(w, *params)
+        w (array): Angular frequencies, shape (N,)
+        params (list): A valid parameter set
+    Returns:
+        True if Z broadcasts parameter columns against a frequency row
+    """
+    w = np.asarray(w, dtype=float)
+    param_sets = np.array([params, params], dtype=float)
+    param_sets[1] *= 1.01
+
+    try:
+        Z_broadcast = Z(w[np.newaxis, :], *param_sets.T[:, :, np.newaxis])
+    except Exception:
+        return False
+
+    if np.shape(Z_broadcast) != (2, len(w)):
+        return False
+    Z_loop = np.array([Z(w, *row) for row in param_sets])
+    return bool(np.allclose(Z_broadcast, Z_loop, rtol=1e-12, atol=0, equal_nan=True))
+
+
+if __name__ == "__main__":
+    import time
+    from curve_fitting.Model_registry import get_model
+    module = get_model("nanoparticles_model").module
+
+    init_params = np.array([4.2, 1.14e-7, 0.00543, 8925, 4.1302114835e-21, 1, 2.31e-16, 1.023, 13.4, 1e4, 2.3, 3.3e-5])
+    w = np.logspace(0, 6, 36)
+
+    #10^5 parameter sets, log-uniform within a decade of the initial values
+    rng = np.random.default_rng(0)
+    param_sets = init_params * 10 ** rng.uniform(-1, 1, size=(100000, len(init_params)))
+
+    start = time.perf_counter()
+    Z_values = evaluate_Z_grid(module.Z, w, param_sets)
+    print(f"{len(param_sets)} parameter sets in {time.perf_counter() - start:.2f}s, broadcasting: "
+          f"{supports_broadcasting(module.Z, w, init_params)}")
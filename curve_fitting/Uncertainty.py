@@ -0,0 +1,110 @@
+"""
+Parameter uncertainties from the Jacobian of a finished fit
+The covariance is s^2 (J^T J)^-1, with s^2 the residual variance, so no further model evaluations are needed.
+J^T J is scaled to a unit diagonal before inverting since the parameters span ~25 orders of magnitude,
+and directions which the data do not constrain (e.g. kbt and n_AB only appear as their product) are
+dropped, the parameters involved get an infinite standard error rather than a meaningless finite one
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+def covariance_from_normal(normal, sum_squares, n_data, rcond=None):
+    """
+    Covariance of the fitted parameters from J^T J
+    Args:
+        normal (array): J^T J, shape (P, P)
+        sum_squares (float): sum of squared residuals at the fitted parameters
+        n_data (int): number of residuals
+        rcond (float or None): eigenvalues of the scaled J^T J below rcond * largest are treated as 0,
+                               None uses machine precision * n_data
+    Returns:
+        covariance (array): shape (P, P). Parameters which do not change the residuals (e.g. fixed parameters)
+        have nan rows and columns, parameters which cannot be separated from others have infinite variance
+        and nan covariances
+    """
+    normal = np.asarray(normal, dtype=float)
+    P = len(normal)
+    covariance = np.full((P, P), np.nan)
+    if not np.all(np.isfinite(normal)):
+        return covariance
+
+    scale = np.sqrt(np.diag(normal))
+    active = scale > 0
+    if not active.any():
+        return covariance
+    scale = scale[active]
+    scaled = normal[np.ix_(active, active)] / np.outer(scale, scale)
+
+    eigvals, eigvecs = np.linalg.eigh(scaled)
+    if rcond is None:
+        rcond = np.finfo(float).eps * max(n_data, P)
+    keep = eigvals > rcond * eigvals.max()
+    inverse = (eigvecs[:, keep] / eigvals[keep]) @ eigvecs[:, keep].T
+
+    dof = n_data - np.sum(keep)
+    variance = sum_squares / dof if dof > 0 else np.inf
+    active_covariance = inverse / np.outer(scale, scale) * variance
+
+    #parameters with a component along an unconstrained direction
+    unconstrained = np.zeros(len(scale), dtype=bool)
+    if not keep.all():
+        unconstrained = np.max(np.abs(eigvecs[:, ~keep]), axis=1) > 1e-6
+    active_covariance[unconstrained, :] = np.nan
+    active_covariance[:, unconstrained] = np.nan
+    active_covariance[unconstrained, unconstrained] = np.inf
+
+    covariance[np.ix_(active, active)] = active_covariance
+    return covariance
+
+def covariance_from_jacobian(jacobian, residuals, rcond=None, sum_squares=None):
+    """
+    Covariance of the fitted parameters from the Jacobian of the residuals, see covariance_from_normal
+    Args:
+        jacobian (array): shape (no. of residuals, P), e.g. scipy.optimize.least_squares result.jac
+        residuals (array): residuals at the fitted parameters, e.g. result.fun
+        sum_squares (float or None): sum of squares the variance is estimated from, None uses the residuals.
+                                     Under a robust loss least_squares' result.jac is rescaled by the loss,
+                                     pass 2*result.cost (the robust cost) so both come from the rescaled problem
+    Returns:
+        covariance (array): shape (P, P)
+    """
+    jacobian = np.asarray(jacobian, dtype=float)
+    residuals = np.asarray(residuals, dtype=float)
+    with np.errstate(all="ignore"):
+        normal = jacobian.T @ jacobian
+    if sum_squares is None:
+        sum_squares = float(np.sum(residuals**2))
+    return covariance_from_normal(normal, sum_squares, len(residuals), rcond)
+
+def linear_stderr(params, stderr, log_params):
+    """
+    Standard errors in the units of the parameters, converting those of log10(parameter)
+    to first order, d(parameter) = parameter * ln(10) * d(log10(parameter))
+    Args:
+        params (array): fitted parameters
+        stderr (array): standard errors, of log10(parameter) where log_params is True
+        log_params (array): boolean array from fit_leastsq's fit_info
+    Returns:
+        stderr (array)
+    """
+    params = np.asarray(params, dtype=float)
+    return np.where(log_params, np.abs(params) * np.log(10), 1) * np.asarray(stderr, dtype=float)
+
+def standard_errors(covariance):
+    """
+    Standard errors and correlation matrix from a covariance matrix
+    Args:
+        covariance (array): shape (P, P)
+    Returns:
+        stderr (array): shape (P,)
+        correlation (array): shape (P, P), nan where a standard error is 0, infinite or nan
+    """
+    covariance = np.asarray(covariance, dtype=float)
+    stderr = np.sqrt(np.diag(covariance))
+    with np.errstate(all="ignore"):
+        correlation = covariance / np.outer(stderr, stderr)
+    correlation[~np.isfinite(correlation)] = np.nan
+    return stderr, correlation
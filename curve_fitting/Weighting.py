@@ -0,0 +1,54 @@
+"""
+Weights of the impedance residuals
+Unweighted residuals are dominated by the high impedance, low frequency points, so fits spend their iterations on
+the ionic arc and neglect the geometric and nanoparticle arcs. Weighting each residual by the inverse of its
+expected error makes every decade of frequency count.
+Weights are computed once per spectrum from the data and applied by the bound model (see Compiled_model.py)
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+#weighting schemes accepted by fit_leastsq
+WEIGHTINGS = ("unit", "proportional", "modulus", "variance")
+
+#proportional weights use at least this fraction of |Z|, so points where Z' or Z'' cross 0 do not get huge weights
+MIN_RELATIVE_ERROR = 1e-2
+
+def residual_weights(ydata, weighting="unit", variance=None):
+    """
+    Weights of the stacked real and imaginary residuals
+    Args:
+        ydata (array): Stacked real and imaginary (-Z'') impedance data, shape (2N,)
+        weighting (string): 'unit' (unweighted), 'proportional' (1/|Z'| and 1/|Z''|, the errors of each
+                            component proportional to its size), 'modulus' (1/|Z| for both components)
+                            or 'variance' (1/standard deviation, from variance)
+        variance (array or None): Variance of every data point, shape (2N,), or (N,) if the real and imaginary
+                                  parts share one. Needed for 'variance' weighting
+    Returns:
+        weights (array or None): shape (2N,), None for unit weighting
+    """
+    ydata = np.asarray(ydata, dtype=float)
+    N = len(ydata) // 2
+
+    if weighting == "unit":
+        return None
+
+    if weighting == "variance":
+        if variance is None:
+            raise ValueError("variance weighting needs the variance of the data")
+        variance = np.asarray(variance, dtype=float)
+        if len(variance) == N:
+            variance = np.hstack([variance, variance])
+        with np.errstate(divide="ignore"):
+            #points with infinite variance get weight 0
+            return 1 / np.sqrt(variance)
+
+    modulus = np.tile(np.hypot(ydata[:N], ydata[N:]), 2)
+    if weighting == "modulus":
+        return 1 / modulus
+    if weighting == "proportional":
+        return 1 / np.maximum(np.abs(ydata), MIN_RELATIVE_ERROR * modulus)
+    raise ValueError(f"Unknown weighting '{weighting}', expected one of {WEIGHTINGS}")
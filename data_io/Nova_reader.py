@@ -0,0 +1,165 @@
+"""
+Streaming readers for Nova text exports (OCP.txt, CVafter.txt, ...)
+Files are read line by line and reading stops as soon as the requested rows are found,
+so the OCP value of a file is read without loading its whole time series
+
+Nova headers start with a byte order mark, are tab separated and annotate units in brackets,
+e.g. "WE(1).Potential (V)". Columns are looked up by their name without the unit
+
+Timothy Chew
+18/10/26
+"""
+
+import re
+from collections import deque
+
+import numpy as np
+
+OCP_COLUMN = "OCP value"
+POTENTIAL_COLUMN = "WE(1).Potential"
+DRIFT_COLUMN = "dWE(1).Potential/dt"
+TIME_COLUMN = "Time"
+
+def parse_header(line):
+    """
+    Splits a Nova header line into column names and units
+    Args:
+        line (string): first line of the file, without the byte order mark
+    Returns:
+        names (list): column names, e.g. "WE(1).Potential"
+        units (list): column units, e.g. "V", None for unitless columns
+    """
+    names = []
+    units = []
+    for column in line.rstrip("\r\n").split("\t"):
+        match = re.fullmatch(r"\s*(.*?)\s*\(([^()]*)\)\s*", column)
+        if match is None:
+            names.append(column.strip())
+            units.append(None)
+        else:
+            names.append(match.group(1))
+            units.append(match.group(2))
+    return names, units
+
+def column_index(names, name):
+    """
+    Position of a column, raises ValueError naming the file's columns if it is missing
+    """
+    if name not in names:
+        raise ValueError(f"No '{name}' column, columns are: {names}")
+    return names.index(name)
+
+def read_rows(filename, columns=None, max_rows=None):
+    """
+    Reads numeric rows of a Nova export, stopping after max_rows
+    Missing or empty fields (e.g. the OCP value column after the first row) are read as nan
+    Args:
+        filename (string): name of file
+        columns (list or None): names of the columns to read, None reads every column
+        max_rows (int or None): number of rows to read, None reads the whole file
+    Returns:
+        names (list): names of the columns read
+        data (array): shape (rows, len(names))
+    """
+    with open(filename, encoding="utf-8-sig") as file:
+        names, units = parse_header(file.readline())
+        indices = list(range(len(names))) if columns is None else [column_index(names, name) for name in columns]
+
+        rows = []
+        for line in file:
+            if max_rows is not None and len(rows) >= max_rows:
+                break
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) == 1 and fields[0].strip() == "":
+                continue
+            rows.append([float(fields[i]) if i < len(fields) and fields[i].strip() != "" else np.nan for i in indices])
+
+    return [names[i] for i in indices], np.array(rows, dtype=float).reshape(-1, len(indices))
+
+def read_ocp_value(OCPfile):
+    """
+    Reads the OCP value of an OCP file, which Nova writes in the first data row only
+    Args:
+        OCPfile (string): name of file containing OCP data
+    Returns:
+        OCP value (float)
+    """
+    names, data = read_rows(OCPfile, columns=[OCP_COLUMN], max_rows=1)
+    if len(data) == 0:
+        raise ValueError(f"No data rows in {OCPfile}")
+    return float(data[0,0])
+
+def ocp_summary(OCPfile, settle_rows=50):
+    """
+    Summarises an OCP measurement in one pass over the file, keeping only the last settle_rows rows in memory
+    Args:
+        OCPfile (string): name of file containing OCP data
+        settle_rows (int): number of rows at the end of the measurement averaged for the settled values
+    Returns:
+        summary (dict): 'OCP_value' (value Nova reports in the first row), 'settled_OCP' (mean potential over the
+        last settle_rows rows), 'drift' (mean dV/dt over the last settle_rows rows, V/s), 'rows' and
+        'duration' (time between the first and last rows, s)
+    """
+    with open(OCPfile, encoding="utf-8-sig") as file:
+        names, units = parse_header(file.readline())
+        i_ocp = column_index(names, OCP_COLUMN)
+        i_potential = column_index(names, POTENTIAL_COLUMN)
+        i_drift = column_index(names, DRIFT_COLUMN)
+        i_time = column_index(names, TIME_COLUMN)
+
+        OCP_value = None
+        first_time = None
+        last_time = None
+        rows = 0
+        potentials = deque(maxlen=settle_rows)
+        drifts = deque(maxlen=settle_rows)
+        for line in file:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) <= max(i_potential, i_drift, i_time):
+                continue
+
+            if OCP_value is None and i_ocp < len(fields) and fields[i_ocp].strip() != "":
+                OCP_value = float(fields[i_ocp])
+            last_time = float(fields[i_time])
+            if first_time is None:
+                first_time = last_time
+            potentials.append(float(fields[i_potential]))
+            drifts.append(float(fields[i_drift]))
+            rows += 1
+
+    if rows == 0:
+        raise ValueError(f"No data rows in {OCPfile}")
+    return {"OCP_value": OCP_value, "settled_OCP": float(np.mean(potentials)), "drift": float(np.mean(drifts)),
+            "rows": rows, "duration": last_time - first_time}
+
+def ocp_summary_from_rows(names, data, settle_rows=50):
+    """
+    The summary of ocp_summary from rows already read with read_rows, so a file which is read whole is read once
+    Args:
+        names (list): column names from read_rows
+        data (array): rows from read_rows, every column
+        settle_rows (int): number of rows at the end of the measurement averaged for the settled values
+    Returns:
+        summary (dict): see ocp_summary
+    """
+    i_ocp = column_index(names, OCP_COLUMN)
+    i_potential = column_index(names, POTENTIAL_COLUMN)
+    i_drift = column_index(names, DRIFT_COLUMN)
+    i_time = column_index(names, TIME_COLUMN)
+
+    #rows missing a field are skipped, as in ocp_summary
+    data = data[np.all(np.isfinite(data[:, [i_potential, i_drift, i_time]]), axis=1)]
+    if len(data) == 0:
+        raise ValueError("No data rows")
+    ocp_values = data[np.isfinite(data[:, i_ocp]), i_ocp]
+    return {"OCP_value": float(ocp_values[0]) if len(ocp_values) != 0 else None,
+            "settled_OCP": float(np.mean(data[-settle_rows:, i_potential])),
+            "drift": float(np.mean(data[-settle_rows:, i_drift])),
+            "rows": len(data), "duration": float(data[-1, i_time] - data[0, i_time])}
+
+
+if __name__ == "__main__":
+    OCPfile = "test_data/008Pixel7/008OCP169mV/OCP.txt"
+    print(read_ocp_value(OCPfile))
+    print(ocp_summary(OCPfile))
+    print(read_rows("test_data/008Pixel7/008OCP169mV/CVafter.txt", columns=["WE(1).Potential", "WE(1).Current"], max_rows=3))
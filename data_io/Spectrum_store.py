@@ -0,0 +1,204 @@
+"""
+Binary store of Nova exports
+Converts a tree of measurement folders (nyquist.txt, CVafter.txt, CVbefore.txt, OCP.txt) into
+one .npy array per file type plus an index.json describing which rows belong to which folder.
+The arrays are opened memory-mapped, so spectra are read as views without parsing text or copying.
+A store written by another version of this module is rebuilt from its source folder when it is opened
+
+Ingest a tree from the repository folder:
+    python -m data_io.Spectrum_store test_data test_data_store
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+
+from data_io.Nova_reader import OCP_COLUMN, read_rows, ocp_summary_from_rows
+
+#bump when the layout of the store changes, older stores are then rebuilt when opened
+STORE_VERSION = 2
+
+#file type -> Nova export filename
+FILE_TYPES = {"nyquist": "nyquist.txt", "CVafter": "CVafter.txt", "CVbefore": "CVbefore.txt", "OCP": "OCP.txt"}
+
+def read_nova_file(filename, file_type):
+    """
+    Reads one Nova export
+    Args:
+        filename (string): name of file
+        file_type (string): key of FILE_TYPES
+    Returns:
+        data (array): numeric columns of the file, OCP files without the 'OCP value' column
+        summary (dict or None): ocp_summary of the file if file_type is 'OCP'
+    """
+    if file_type == "OCP":
+        #the file is read once, the summary is computed from its rows
+        names, data = read_rows(filename)
+        keep = [i for i, name in enumerate(names) if name != OCP_COLUMN]
+        return data[:, keep], ocp_summary_from_rows(names, data)
+    return np.loadtxt(filename, skiprows=1, encoding="utf-8-sig"), None
+
+def ingest(root, store_folder):
+    """
+    Converts every measurement folder under root into a binary store
+    Folders are included if they contain a nyquist.txt file, files which cannot be read are left out
+    Args:
+        root (string): top level folder, e.g. test_data
+        store_folder (string): folder to write the store to
+    Returns:
+        Number of folders stored
+    """
+    entries = []
+    arrays = {file_type: [] for file_type in FILE_TYPES}
+    rows_stored = {file_type: 0 for file_type in FILE_TYPES}
+    columns = {}
+
+    for folder, subfolders, filenames in os.walk(root):
+        subfolders.sort()
+        if "nyquist.txt" not in filenames:
+            continue
+
+        entry = {"pixel": os.path.basename(os.path.dirname(folder)), "folder": folder,
+                 "OCP_value": None, "settled_OCP": None, "drift": None, "rows": {}}
+        for file_type, filename in FILE_TYPES.items():
+            if filename not in filenames:
+                continue
+            try:
+                data, summary = read_nova_file(os.path.join(folder, filename), file_type)
+            except (ValueError, IndexError, OSError) as error:
+                print(f"Unable to read {os.path.join(folder, filename)}: {error}")
+                continue
+
+            data = np.atleast_2d(data)
+            if columns.setdefault(file_type, data.shape[1]) != data.shape[1]:
+                print(f"Skipping {os.path.join(folder, filename)}: {data.shape[1]} columns, expected {columns[file_type]}")
+                continue
+
+            if summary is not None:
+                entry["OCP_value"] = summary["OCP_value"]
+                entry["settled_OCP"] = summary["settled_OCP"]
+                entry["drift"] = summary["drift"]
+            entry["rows"][file_type] = [rows_stored[file_type], rows_stored[file_type] + len(data)]
+            arrays[file_type].append(data)
+            rows_stored[file_type] += len(data)
+        entries.append(entry)
+
+    os.makedirs(store_folder, exist_ok=True)
+    for file_type, data_list in arrays.items():
+        if len(data_list) != 0:
+            np.save(os.path.join(store_folder, file_type + ".npy"), np.vstack(data_list))
+
+    with open(os.path.join(store_folder, "index.json"), "w") as file:
+        json.dump({"version": STORE_VERSION, "root": os.path.abspath(root), "columns": columns, "entries": entries},
+                  file, indent=1)
+    return len(entries)
+
+def is_store(folder):
+    """
+    Whether folder contains a spectrum store
+    """
+    return os.path.isfile(os.path.join(folder, "index.json"))
+
+class SpectrumStore:
+    """
+    Read access to a store written by ingest
+    Arrays are memory-mapped, get returns views into them
+    """
+    def __init__(self, store_folder):
+        """
+        Opens a store, rebuilding it from its source folder if it was written with another STORE_VERSION
+        Args:
+            store_folder (string): folder containing the store
+        """
+        self.store_folder = store_folder
+        index = self.read_index()
+        if index.get("version") != STORE_VERSION:
+            root = self.source_folder(index)
+            print(f"Rebuilding {store_folder} from {root}: store version {index.get('version')}, expected {STORE_VERSION}")
+            if root is None or not os.path.isdir(root):
+                raise ValueError(f"Cannot rebuild {store_folder}, its source folder {root} is missing")
+            ingest(root, store_folder)
+            index = self.read_index()
+        self.entries = index["entries"]
+
+        self.arrays = {}
+        for file_type in index["columns"]:
+            self.arrays[file_type] = np.load(os.path.join(store_folder, file_type + ".npy"), mmap_mode="r")
+
+    def read_index(self):
+        """
+        Contents of the store's index.json
+        """
+        with open(os.path.join(self.store_folder, "index.json")) as file:
+            return json.load(file)
+
+    @staticmethod
+    def source_folder(index):
+        """
+        Folder a store was ingested from
+        Version 1 stores do not record it, the deepest folder containing all their measurement folders is used
+        Args:
+            index (dict): contents of index.json
+        Returns:
+            root (string or None): None if the store has no entries to find it from
+        """
+        if "root" in index:
+            return index["root"]
+        folders = [entry["folder"] for entry in index.get("entries", [])]
+        return os.path.commonpath(folders) if len(folders) != 0 else None
+
+    def get(self, entry_index, file_type):
+        """
+        Data of one file
+        Args:
+            entry_index (int): position of the folder in entries
+            file_type (string): key of FILE_TYPES
+        Returns:
+            data (array or None): read-only view of the file's rows, None if the folder did not contain the file
+        """
+        rows = self.entries[entry_index]["rows"].get(file_type)
+        if rows is None:
+            return None
+        return self.arrays[file_type][rows[0]:rows[1]]
+
+    def pixels(self):
+        """
+        Entries grouped by pixel
+        Returns:
+            pixels (dict): pixel name -> list of entry indices in order of increasing OCP value
+        """
+        pixels = {}
+        for i, entry in enumerate(self.entries):
+            pixels.setdefault(entry["pixel"], []).append(i)
+        for indices in pixels.values():
+            indices.sort(key=lambda i: np.inf if self.entries[i]["OCP_value"] is None else self.entries[i]["OCP_value"])
+        return pixels
+
+    def find(self, pixel, bias_voltage):
+        """
+        Entry of a pixel measured closest to a bias voltage
+        Args:
+            pixel (string): pixel name
+            bias_voltage (float): bias voltage in V
+        Returns:
+            entry index (int), None if the pixel has no entries with an OCP value
+        """
+        indices = [i for i in self.pixels().get(pixel, []) if self.entries[i]["OCP_value"] is not None]
+        if len(indices) == 0:
+            return None
+        return min(indices, key=lambda i: abs(self.entries[i]["OCP_value"] - bias_voltage))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a tree of Nova exports into a binary spectrum store")
+    parser.add_argument("root", help="folder to search for measurement folders, e.g. test_data")
+    parser.add_argument("store", help="folder to write the store to")
+    args = parser.parse_args()
+
+    n_entries = ingest(args.root, args.store)
+    print(f"Stored {n_entries} folders in {args.store}")
@@ -0,0 +1,113 @@
+"""
+Non-interactive rendering of fitted spectra to image files
+Draws the Nyquist and bode/phase panels of a fit on the Agg backend without pyplot, so no
+windows are opened and no GUI toolkit is needed. One figure is created per process and its
+lines are updated for every spectrum instead of building a new figure each time
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from graphics.Frequency_grid import adaptive_frequencies, frequency_window
+
+#renderer of this process, reused by every call of get_renderer
+_renderer = None
+
+class FigureRenderer:
+    """
+    One reusable figure with Nyquist and bode/phase panels
+    """
+    def __init__(self, figsize=(11, 4.5), dpi=100):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        FigureCanvasAgg(self.figure)
+        self.ax1, self.ax2 = self.figure.subplots(1, 2)
+        self.twin = self.ax2.twinx()
+
+        self.data_nyquist, = self.ax1.plot([], [], "o", label="Impedance")
+        self.model_nyquist, = self.ax1.plot([], [], label="model impedance")
+        self.data_modulus, = self.ax2.plot([], [], "o", label="|Z|", color="midnightblue")
+        self.model_modulus, = self.ax2.plot([], [], label="model |Z|", color="blue")
+        self.data_phase, = self.twin.plot([], [], "o", label="Argz", color="maroon")
+        self.model_phase, = self.twin.plot([], [], label="model arg(Z)", color="red")
+
+        self.ax1.set_title("Impedance spectra")
+        self.ax1.set_ylabel("-Z''")
+        self.ax1.set_xlabel("Z")
+        self.ax2.set_xscale("log")
+        self.ax2.set_yscale("log")
+        self.ax2.set_title("Resonance and bode plot")
+        self.ax2.set_ylabel("|Z|")
+        self.ax2.set_xlabel("w")
+        self.twin.set_ylabel("Phase")
+
+        #fixed legend positions, "best" is searched again on every draw
+        self.ax1.legend(loc="upper right", fontsize="small")
+        self.ax2.legend(loc="upper right", fontsize="small")
+        self.twin.legend(loc="lower left", fontsize="small")
+        #fixed margins, the layout is the same for every spectrum so it is not recomputed
+        self.figure.subplots_adjust(left=0.07, right=0.93, bottom=0.12, top=0.84, wspace=0.3)
+
+    def render(self, filename, data, w=None, Z_values=None, title=""):
+        """
+        Draws one spectrum and its model curve and saves the figure
+        Args:
+            filename (string): image file to write, the format follows the extension (png, svg, pdf, ...)
+            data (array): Impedance data, columns index, frequency, Z', -Z''
+            w (array or None): frequencies of the model curve, None draws the data only
+            Z_values (array or None): model impedance at w
+            title (string): figure title
+        """
+        Z_data = data[:,2] - 1j*data[:,3]
+        w_data = data[:,1]
+        self.data_nyquist.set_data(Z_data.real, -Z_data.imag)
+        self.data_modulus.set_data(w_data, np.abs(Z_data))
+        self.data_phase.set_data(w_data, np.angle(Z_data))
+
+        has_model = Z_values is not None
+        for line in [self.model_nyquist, self.model_modulus, self.model_phase]:
+            line.set_visible(has_model)
+        if has_model:
+            self.model_nyquist.set_data(Z_values.real, -Z_values.imag)
+            self.model_modulus.set_data(w, np.abs(Z_values))
+            self.model_phase.set_data(w, np.angle(Z_values))
+
+        for ax in [self.ax1, self.ax2, self.twin]:
+            ax.relim(visible_only=True)
+            ax.autoscale_view()
+        self.ax2.set_xlim(*frequency_window(data))
+
+        self.figure.suptitle(title)
+        if filename.lower().endswith(".png"):
+            #light compression, the default level spends more time compressing than drawing
+            self.figure.savefig(filename, pil_kwargs={"compress_level": 1})
+        else:
+            self.figure.savefig(filename)
+
+def get_renderer():
+    """
+    Renderer of this process, created on first use
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = FigureRenderer()
+    return _renderer
+
+def render_fit(filename, Z, data, params=None, title=""):
+    """
+    Renders a spectrum and the model evaluated at its fitted parameters
+    Args:
+        filename (string): image file to write
+        Z (function): Impedance function
+        data (array): Impedance data
+        params (tuple or None): fitted parameters, None draws the data only (e.g. failed fits)
+        title (string): figure title
+    """
+    w = None
+    Z_values = None
+    if params is not None:
+        w, Z_values = adaptive_frequencies(Z, params, *frequency_window(data))
+    get_renderer().render(filename, data, w, Z_values, title)
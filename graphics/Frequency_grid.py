@@ -0,0 +1,121 @@
+"""
+Adaptive frequency grids for plotting model curves
+Starts from a coarse log spaced grid and bisects only the intervals where the curve bends,
+i.e. where the midpoint of an interval is far from the straight line between its ends on the
+Nyquist and bode plots. Smooth stretches keep the coarse spacing, arcs around the time constants
+(w_g, w_ion, w_nano) get refined, so far fewer evaluations are needed than a dense uniform grid
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+#frequency window used when there is no data to clip to
+DEFAULT_WINDOW = (1e-2, 1e6)
+
+def frequency_window(data=None, padding=0.1):
+    """
+    Frequency range to evaluate the model over
+    Args:
+        data (array or None): Impedance data, columns index, frequency, Z', -Z''
+        padding (float): fraction added either side of the data's range, matching the plot's axis padding
+    Returns:
+        (w_min, w_max), DEFAULT_WINDOW if data is None
+    """
+    if data is None:
+        return DEFAULT_WINDOW
+    w_data = data[:,1][np.isfinite(data[:,1]) & (data[:,1] > 0)]
+    if len(w_data) == 0:
+        return DEFAULT_WINDOW
+    return w_data.min() * (1-padding), w_data.max() * (1+padding)
+
+def curve_coordinates(Z_values):
+    """
+    Coordinates in which the curve is checked for straightness:
+    Z' and -Z'' (Nyquist), log|Z| and phase (bode)
+    """
+    return np.vstack([Z_values.real, -Z_values.imag, np.log(np.abs(Z_values)), np.angle(Z_values)])
+
+def interval_errors(coords_left, coords_mid, coords_right, scale):
+    """
+    Distance of each interval's midpoint from the chord between its ends, relative to the extent of the curve
+    Args:
+        coords_left, coords_mid, coords_right (array): shape (4, intervals), from curve_coordinates
+        scale (array): shape (4,), extent of the curve in each coordinate
+    Returns:
+        errors (array): largest relative deviation over the coordinates, one per interval
+    """
+    deviation = np.abs(coords_mid - 0.5*(coords_left + coords_right)) / scale[:, np.newaxis]
+    deviation[~np.isfinite(deviation)] = np.inf #refine around poles and nan
+    return deviation.max(axis=0)
+
+def adaptive_frequencies(Z, params, w_min=DEFAULT_WINDOW[0], w_max=DEFAULT_WINDOW[1], tolerance=2e-3,
+                         n_initial=33, max_points=500):
+    """
+    Samples the model on a log frequency grid refined where the curve bends
+    Every interval's midpoint is evaluated once, when the interval is made. Intervals within tolerance keep
+    their midpoint for later rounds, only the halves of bisected intervals are evaluated in the next round
+    Args:
+        Z (function): Impedance function, Z(w, *params)
+        params (list): model parameters
+        w_min, w_max (float): frequency window
+        tolerance (float): largest allowed deviation of an interval's midpoint from its chord,
+                           as a fraction of the curve's extent
+        n_initial (int): number of points of the starting log spaced grid
+        max_points (int): refinement stops once the grid has this many points
+    Returns:
+        w (array): increasing frequencies
+        Z_values (array): model impedance at w
+    """
+    log_w = np.linspace(np.log10(w_min), np.log10(w_max), n_initial)
+    Z_values = Z(10**log_w, *params)
+    #midpoint of every interval, bisecting an interval makes its midpoint a sample
+    log_mid = 0.5 * (log_w[:-1] + log_w[1:])
+    Z_mid = Z(10**log_mid, *params)
+
+    while len(log_w) < max_points:
+        coords = curve_coordinates(Z_values)
+        finite = np.all(np.isfinite(coords), axis=0)
+        if not finite.any():
+            break
+        scale = np.ptp(coords[:, finite], axis=1)
+        scale[scale == 0] = 1
+        scale[3] = max(scale[3], 0.1) #phase is bounded, don't chase ripples in a flat phase
+
+        #the scale grows with the samples, errors are recomputed from the stored midpoints without evaluating Z
+        errors = interval_errors(coords[:, :-1], curve_coordinates(Z_mid), coords[:, 1:], scale)
+
+        #an interval is bisected if it is not straight, or its neighbour is not (catches features between samples)
+        refine = errors > tolerance
+        refine[:-1] |= errors[1:] > tolerance
+        refine[1:] |= errors[:-1] > tolerance
+
+        if not refine.any():
+            break
+        refine[np.argsort(-errors)[max_points - len(log_w):]] = False #largest errors first when near the cap
+
+        #only the new halves of the bisected intervals are evaluated
+        log_halves = np.concatenate([0.5 * (log_w[:-1][refine] + log_mid[refine]),
+                                     0.5 * (log_mid[refine] + log_w[1:][refine])])
+        Z_halves = Z(10**log_halves, *params)
+
+        log_w = np.concatenate([log_w, log_mid[refine]])
+        Z_values = np.concatenate([Z_values, Z_mid[refine]])
+        order = np.argsort(log_w)
+        log_w, Z_values = log_w[order], Z_values[order]
+
+        log_mid = np.concatenate([log_mid[~refine], log_halves])
+        Z_mid = np.concatenate([Z_mid[~refine], Z_halves])
+        order = np.argsort(log_mid)
+        log_mid, Z_mid = log_mid[order], Z_mid[order]
+
+    return 10**log_w, Z_values
+
+if __name__ == "__main__":
+    from curve_fitting.Model_registry import get_model
+    module = get_model("nanoparticles_model").module
+    params = [4.2, 1.14e-7, 0.00543, 8925, 4.1302114835e-21, 1, 2.31e-16, 1.023, 13.4, 1e4, 2.3, 3.3e-5]
+
+    w, Z_values = adaptive_frequencies(module.Z, params)
+    print(f"{len(w)} points")
@@ -11,11 +11,77 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider, Button, CheckButtons
 from graphics.Axes_generator import gen_axes
+from graphics.Frequency_grid import adaptive_frequencies, frequency_window
+
+#redraws per second while dragging sliders
+FRAME_RATE = 60
 
 #get phase of complex number
 def arg(z):
     return np.arctan2(z.imag, z.real)
 
+def padded_limits(values, padding=0.1, inverted=False, log=False):
+    """
+    Axis limits enclosing values with padding, computed with numpy rather than python min/max
+    Args:
+        values (array): plotted values
+        padding (float): fraction of the extreme values added either side
+        inverted (boolean): Whether to shrink rather than grow the extremes, used for the (negative) phase axis
+        log (boolean): Whether the axis is logarithmic, non-positive values are then ignored
+    Returns:
+        (lower, upper) limits, None if there are no plottable values
+    """
+    values = np.asarray(values)
+    plottable = np.isfinite(values) & (values > 0) if log else np.isfinite(values)
+    if not plottable.any():
+        return None
+    low = values[plottable].min()
+    high = values[plottable].max()
+    if inverted:
+        return low * (1+padding), high * (1-padding)
+    return low * (1-padding), high * (1+padding)
+
+def limits_stale(current, target, log=False):
+    """
+    Whether axis limits need to change, i.e. the target limits leave the current view
+    or fill less than half of it
+    Args:
+        current (tuple): current axis limits
+        target (tuple or None): limits enclosing the plotted values
+        log (boolean): Whether the axis is logarithmic
+    Returns:
+        True if the axis should be set to target
+    """
+    if target is None or target[0] == target[1]:
+        return False
+    low, high = sorted(current)
+    target_low, target_high = sorted(target)
+    if log:
+        if low <= 0:
+            return True
+        low, high, target_low, target_high = np.log10([low, high, target_low, target_high])
+    return target_low < low or target_high > high or (target_high - target_low) < 0.5 * (high - low)
+
+def widen_limits(target, slack=0.25, log=False):
+    """
+    Widens limits by a fraction of their span either side, so that small changes while dragging
+    a slider do not change the limits again on the next frame
+    Args:
+        target (tuple): limits enclosing the plotted values
+        slack (float): fraction of the span added either side
+        log (boolean): Whether the axis is logarithmic, the span is then measured in decades
+    Returns:
+        (lower, upper) limits, in the same order as target
+    """
+    low, high = target
+    if log:
+        low, high = np.log10([low, high])
+    margin = slack * (high - low)
+    low, high = low - margin, high + margin
+    if log:
+        return 10**low, 10**high
+    return low, high
+
 def plotter(Z, initparams_filename, data, guess_params=None):
     """
     Plots impedance function and data with interactive sliders and buttons
@@ -40,11 +106,12 @@ def plotter(Z, initparams_filename, data, guess_params=None):
     else:
         init_values = guess_params
     
-    w = np.logspace(-2,6,500)
+    #model curves are sampled adaptively over the data's frequency window, refined where they bend
+    w_window = frequency_window(data)
     fig, (ax1, ax2) = plt.subplots(1, 2)
     twin = ax2.twinx()
 
-    Z_model_values = Z(w, *init_values)
+    w, Z_model_values = adaptive_frequencies(Z, init_values, *w_window)
 
     line1, = ax1.plot(Z_model_values.real, 
                     -1*Z_model_values.imag, 
@@ -60,6 +127,126 @@ def plotter(Z, initparams_filename, data, guess_params=None):
     lines_by_labels = {l.get_label(): l for l in [line2, line2a,line2b,line2c]}
     line_colors = [l.get_color() for l in lines_by_labels.values()]
 
+    #update using sliders
+    #slider events only mark the plot as out of date, a timer redraws it at most FRAME_RATE times a second.
+    #While limits are unchanged only the model lines and moved sliders are redrawn over a saved background (blitting)
+    canvas = fig.canvas
+    blit = canvas.supports_blit
+    model_lines = [line1, line2, line3, line2a, line2b, line2c]
+    redraw_state = {"pending": False, "full_redraw": False, "background": None, "w": w, "Z_values": Z_model_values}
+    if blit:
+        for line in model_lines:
+            line.set_animated(True)
+
+    def current_params():
+        param_list_updated = []
+        if logscale:
+            for i in range(len(init_params)):
+                if init_params[i,3]:
+                    param_list_updated.append(10 ** log_sliders[i].val)
+                elif isinstance(sliders[i], float):
+                    param_list_updated.append(sliders[i])
+                else:
+                    param_list_updated.append(sliders[i].val)
+        else:
+            for slider in sliders:
+                if isinstance(slider, float):
+                    param_list_updated.append(slider)
+                else:
+                    param_list_updated.append(slider.val)
+        return param_list_updated
+
+    def set_model_lines(w, Z_values_updated):
+        #hidden traces are skipped, display_plots fills them in when they are shown.
+        #the frequency grid changes with the parameters, so x data is set as well
+        line1.set_data(Z_values_updated.real, -1*Z_values_updated.imag)
+        if line2.get_visible():
+            line2.set_data(w, abs(Z_values_updated))
+        if line3.get_visible():
+            line3.set_data(w, arg(Z_values_updated))
+        if line2a.get_visible():
+            line2a.set_data(w, Z_values_updated.real)
+        if line2b.get_visible():
+            line2b.set_data(w, -1*Z_values_updated.imag)
+        if line2c.get_visible():
+            line2c.set_data(w, -1/Z_values_updated.imag * 1/w)
+
+    def update_limits(force=False):
+        #returns True if any limits changed
+        changed = False
+        visible_ax2 = [line.get_ydata() for line in [line2, line2a, line2b, line2c] if line.get_visible()]
+        targets = [
+            (ax1.get_xlim, ax1.set_xlim, padded_limits(line1.get_xdata()), False),
+            (ax1.get_ylim, ax1.set_ylim, padded_limits(line1.get_ydata()), False),
+            (twin.get_ylim, twin.set_ylim, padded_limits(line3.get_ydata(), inverted=True), False),
+        ]
+        if len(visible_ax2) != 0:
+            targets.append((ax2.get_ylim, ax2.set_ylim, padded_limits(np.concatenate(visible_ax2), log=True), True))
+
+        for get_lim, set_lim, target, log in targets:
+            if target is None:
+                continue
+            if force:
+                set_lim(*target)
+                changed = True
+            elif limits_stale(get_lim(), target, log):
+                set_lim(*widen_limits(target, log=log))
+                changed = True
+        return changed
+
+    def draw_animated():
+        for line in model_lines:
+            if line.get_visible():
+                fig.draw_artist(line)
+        for slider in sliders + log_sliders:
+            if not isinstance(slider, float) and slider.ax.get_animated():
+                fig.draw_artist(slider.ax)
+
+    def on_draw(event):
+        #full redraws (limits, checkboxes, resizing) refresh the saved background
+        if blit:
+            redraw_state["background"] = canvas.copy_from_bbox(fig.bbox)
+            draw_animated()
+
+    def redraw():
+        w, Z_values_updated = adaptive_frequencies(Z, current_params(), *w_window)
+        redraw_state["w"] = w
+        redraw_state["Z_values"] = Z_values_updated
+        set_model_lines(w, Z_values_updated)
+
+        full_redraw = redraw_state["full_redraw"]
+        redraw_state["full_redraw"] = False
+        if update_limits() or full_redraw or not blit or redraw_state["background"] is None:
+            canvas.draw_idle()
+            return
+
+        canvas.restore_region(redraw_state["background"])
+        draw_animated()
+        canvas.blit(fig.bbox)
+
+    def update(slider):
+        redraw_state["pending"] = True
+        if blit and not slider.ax.get_animated():
+            #first move of this slider: take it out of the background so only it is redrawn from now on
+            slider.ax.set_animated(True)
+            redraw_state["full_redraw"] = True
+
+    def on_frame():
+        if redraw_state["pending"]:
+            redraw_state["pending"] = False
+            redraw()
+
+    def make_slider(**kwargs):
+        #sliders are redrawn by redraw, not on every change
+        slider = Slider(**kwargs)
+        slider.drawon = False
+        slider.on_changed(lambda val: update(slider))
+        return slider
+
+    canvas.mpl_connect("draw_event", on_draw)
+    frame_timer = canvas.new_timer(interval=1000 // FRAME_RATE)
+    frame_timer.add_callback(on_frame)
+
     #adjust position of figure
     fig.subplots_adjust(bottom=0.25)
 
@@ -80,7 +267,7 @@ def plotter(Z, initparams_filename, data, guess_params=None):
         if init_params[j,2]:
             slider_axes.append(fig.add_axes(axes_pos[i]))
             valinit = init_values[j]
-            sliders.append(Slider(ax=slider_axes[j], label=init_params[j,0], valmin=valinit/10, valmax=valinit*10, valinit=valinit))
+            sliders.append(make_slider(ax=slider_axes[j], label=init_params[j,0], valmin=valinit/10, valmax=valinit*10, valinit=valinit))
             i += 1 
         else:
             #append value if not placing a slider
@@ -90,7 +277,7 @@ def plotter(Z, initparams_filename, data, guess_params=None):
         #check if we want a log slider for this value
         if init_params[j,3]:
             log_slider_axes.append(fig.add_axes(ax_storage))
-            log_sliders.append(Slider(ax=log_slider_axes[j], label=init_params[j,0], valmin=-16, valmax=7, valinit=init_values[j], dragging=False))
+            log_sliders.append(make_slider(ax=log_slider_axes[j], label=init_params[j,0], valmin=-16, valmax=7, valinit=init_values[j], dragging=False))
         else:
             log_slider_axes.append("None")
             log_sliders.append(init_values[j])
@@ -111,79 +298,28 @@ def plotter(Z, initparams_filename, data, guess_params=None):
                     log_val = 10 ** (log_sliders[j].val)
                     log_slider_axes[j].clear()
                     slider_axes[j].clear()
-                    sliders[j] = Slider(ax=slider_axes[j], label=init_params[j,0], valmin=log_val/10, valmax=log_val*10, valinit=log_val)
-                    log_sliders[j] = Slider(ax=log_slider_axes[j], label="log"+init_params[j,0], 
+                    sliders[j] = make_slider(ax=slider_axes[j], label=init_params[j,0], valmin=log_val/10, valmax=log_val*10, valinit=log_val)
+                    log_sliders[j] = make_slider(ax=log_slider_axes[j], label="log"+init_params[j,0], 
                                             valmin=round(np.log10(log_val))-2, valmax=round(np.log10(log_val))+2, valinit=np.log10(log_val))
-                    sliders[j].on_changed(update)
-                    log_sliders[j].on_changed(update)
             else:
                 if init_params[j,3]:
                     lin_val = sliders[j].val
                     log_slider_axes[j].clear()
                     slider_axes[j].clear()
-                    sliders[j] = Slider(ax=log_slider_axes[j], label=init_params[j,0], valmin=lin_val/10, valmax=lin_val*10, valinit=lin_val)
-                    log_sliders[j] = Slider(ax=slider_axes[j], label="log"+init_params[j,0], 
+                    sliders[j] = make_slider(ax=log_slider_axes[j], label=init_params[j,0], valmin=lin_val/10, valmax=lin_val*10, valinit=lin_val)
+                    log_sliders[j] = make_slider(ax=slider_axes[j], label="log"+init_params[j,0], 
                                             valmin=round(np.log10(lin_val))-2, valmax=round(np.log10(lin_val))+2, valinit=np.log10(lin_val))
-                    sliders[j].on_changed(update)
-                    log_sliders[j].on_changed(update)
         
         #flipper
         if logscale:
             logscale = False
         else:
             logscale = True
+        canvas.draw_idle()
         
     togglelog_button.on_clicked(toggle_logscale)
 
 
-    #update using sliders
-
-    def update(val):
-        param_list_updated = []
-        if logscale:
-            for i in range(len(init_params)):
-                if init_params[i,3]:
-                    param_list_updated.append(10 ** log_sliders[i].val)
-                elif isinstance(sliders[i], float):
-                    param_list_updated.append(sliders[i])
-                else:
-                    param_list_updated.append(sliders[i].val)
-        else:
-            for slider in sliders:
-                if isinstance(slider, float):
-                    param_list_updated.append(slider)
-                else:
-                    param_list_updated.append(slider.val)
-
-        padding = 0.1
-        #adjust limits
-        ax1.set_xlim(min(line1.get_xdata()) * (1-padding), max(line1.get_xdata()) * (1+padding))
-        ax1.set_ylim(min(line1.get_ydata()) * (1-padding), max(line1.get_ydata()) * (1+padding))
-        ax2.set_xlim(min(line2.get_xdata()) * (1-padding), max(line2.get_xdata()) * (1+padding))
-        ax2.set_ylim(min(line2.get_ydata()) * (1-padding), max(line2.get_ydata()) * (1+padding))
-        twin.set_xlim(min(line3.get_xdata()) * (1-padding), max(line3.get_xdata()) * (1+padding))
-        twin.set_ylim(min(line3.get_ydata()) * (1+padding), max(line3.get_ydata()) * (1-padding))
-
-        Z_values_updated = Z(w, *param_list_updated)
-        line1.set_xdata(Z_values_updated.real)
-        line1.set_ydata(-1*Z_values_updated.imag)
-        line2.set_ydata(abs(Z_values_updated))
-        line3.set_ydata(arg(Z_values_updated))
-
-        line2a.set_ydata(Z_values_updated.real)
-        line2b.set_ydata(-1*Z_values_updated.imag)
-        line2c.set_ydata(-1/Z_values_updated.imag * 1/w)
-
-    #call on sliders when moved
-    for slider in sliders:
-        if not isinstance(slider, float):
-            slider.on_changed(update)
-
-    for log_slider in log_sliders:
-        if not isinstance(log_slider, float):
-            log_slider.on_changed(update)
-
-
 
     #buttons
     #resets sliders
@@ -197,6 +333,7 @@ def plotter(Z, initparams_filename, data, guess_params=None):
         for log_slider in log_sliders:
             if not isinstance(log_slider, float):
                 log_slider.reset()
+        canvas.draw_idle()
     reset_button.on_clicked(reset)
 
     #plot data
@@ -228,6 +365,7 @@ def plotter(Z, initparams_filename, data, guess_params=None):
     def display_plots(label):
         ln = lines_by_labels[label]
         ln.set_visible(not ln.get_visible())
+        set_model_lines(redraw_state["w"], redraw_state["Z_values"])
         ln.figure.canvas.draw_idle()
 
         if data is not None:
@@ -250,9 +388,7 @@ def plotter(Z, initparams_filename, data, guess_params=None):
         ax2.legend(visible_lines, visible_labels, loc="upper right")
 
         #change limits
-        padding = 0.1
-        ax2.set_xlim(min(ln.get_xdata()) * (1-padding), max(ln.get_xdata()) * (1+padding))
-        ax2.set_ylim(min(ln.get_ydata()) * (1-padding), max(ln.get_ydata()) * (1+padding))
+        update_limits(force=True)
 
     plots_check.on_clicked(display_plots)
 
@@ -271,19 +407,17 @@ def plotter(Z, initparams_filename, data, guess_params=None):
 
     twin.set_ylabel("Phase")
 
-    padding = 0.1
-    ax1.set_xlim(min(line1.get_xdata()) * (1-padding), max(line1.get_xdata()) * (1+padding))
-    ax1.set_ylim(min(line1.get_ydata()) * (1-padding), max(line1.get_ydata()) * (1+padding))
-    ax2.set_xlim(min(line2.get_xdata()) * (1-padding), max(line2.get_xdata()) * (1+padding))
-    ax2.set_ylim(min(line2.get_ydata()) * (1-padding), max(line2.get_ydata()) * (1+padding))
-    twin.set_xlim(min(line3.get_xdata()) * (1-padding), max(line3.get_xdata()) * (1+padding))
-    twin.set_ylim(min(line3.get_ydata()) * (1+padding), max(line3.get_ydata()) * (1-padding))
+    ax2.set_xlim(*w_window)
+    twin.set_xlim(*w_window)
+    update_limits(force=True)
 
     ax1.legend()
     ax2.legend([line2, dline], ["model |Z|", "|Z|"], loc="upper right")
     twin.legend(loc="upper left")
 
+    frame_timer.start()
     plt.show()
+    frame_timer.stop()
 
     #get slider values
     plist_output = []
@@ -6,8 +6,7 @@ Timothy Chew
 23/8/24
 """
 
-import pandas as pd
-from tabulate import tabulate
+import csv
 
 def output_params(init_paramfilename, plist):
     """
@@ -18,8 +17,12 @@ def output_params(init_paramfilename, plist):
     Returns:
         tabulate object containing parameter names and values
     """
+    #imported here, only needed once the fit is done
+    from tabulate import tabulate
+
     output_array = []
-    param_names = pd.read_csv(init_paramfilename, delimiter=",").values[:,0]
+    with open(init_paramfilename, newline="") as file:
+        param_names = [row[0] for row in list(csv.reader(file))[1:]]
 
     for i, param_name in enumerate(param_names):
         output_array.append([param_name, plist[i]])
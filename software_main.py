@@ -7,14 +7,16 @@ Timothy Chew
 """
 
 import numpy as np
-import pandas as pd
-import importlib.util
 
-from graphics.Plotter import plotter
 from curve_fitting.Curve_fitting import fit_leastsq
+from curve_fitting.Fit_cache import cache_key, load_fit, save_fit
+from curve_fitting.Model_registry import get_model
+from curve_fitting.Instrumentation import profiling, record, timer, print_report
+from data_io.Nova_reader import read_ocp_value
 from graphics.output_plist import output_params
 
-def imp_fitting(imp_model_folder, datafile, nobias_datafile, IVfile, OCPfile, bias, run_checker):
+def imp_fitting(imp_model_folder, datafile, nobias_datafile, IVfile, OCPfile, bias, run_checker, use_cache=True,
+                profile=False):
     """
     Performs fitting operations
     Combines functionality of plotter, Curve_fitting, and output_plist modules
@@ -26,58 +28,82 @@ def imp_fitting(imp_model_folder, datafile, nobias_datafile, IVfile, OCPfile, bi
         OCP file (string or None): name of file containing OCP data
         bias (boolean): Whether to investigate the bias or no bias data file
         run_checker (boolean): Whether to run the checker FinderInterface
+        use_cache (boolean): Whether to reuse the result of an identical previous fit from the fit cache.
+                             Fits using the checker are never cached
+        profile (boolean): Whether to print a profile of the file loading and fit, see curve_fitting/Instrumentation.py
     Returns:
         Tabulate object containing parameter names and values
     """
-    #importing function
-    spec = importlib.util.spec_from_file_location("Impedancefunction.py", imp_model_folder+"/Impedancefunction.py")
-    if spec is None:
-        print(f"Cannot load module from folder: {imp_model_folder}")
+    #the plotter needs matplotlib, imported here so importing this module stays light for headless fitting
+    from graphics.Plotter import plotter
+
+    #loading the model, once per process, see curve_fitting/Model_registry.py
+    model = get_model(imp_model_folder)
+    if model is None:
         return None
-    module = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(module)
-    Z = getattr(module, "Z", None)
+    Z = model.Z
+    dZ = model.dZ
 
-    #checking if we preloaded fitting support
-    if imp_model_folder == "builtin_models\\nanoparticles_model" or imp_model_folder == "builtin_models\single_transistor_model":
-        supported = True
-    else:
-        supported = False
+    #fitting support is declared by the model's CAPABILITIES
+    supported = model.supported
+    init_paramfilename = model.init_paramfilename
+    nano = model.nano
 
-    #importing associated initial parameters
-    init_paramfilename = imp_model_folder+"\Initial_params.csv"
-    nano = False
-    if imp_model_folder == "builtin_models\\nanoparticles_model":
-        nano = True
+    #loading data. Instrumentation is only on for this block, also if the fit raises
+    with profiling(profile), record() as fit_record:
+        with timer("file_io"):
+            data = np.loadtxt(datafile, skiprows=1)
 
-    #loading data
-    data = np.loadtxt(datafile, skiprows=1)
+            nobias_data=None
+            IVdata=None
+            biasvoltage=None
 
-    nobias_data=None
-    IVdata=None
-    biasvoltage=None
+            if nobias_datafile is not None:
+                nobias_data = np.loadtxt(nobias_datafile, skiprows=1)
 
-    if nobias_datafile is not None:
-        nobias_data = np.loadtxt(nobias_datafile, skiprows=1)
-    
-    if IVfile is not None:
-        IVdata = np.loadtxt(IVfile, skiprows=1)
-    
-    if OCPfile is not None:
-        biasvoltage = pd.read_csv(OCPfile, sep="\t", header=0).values[0,5]
-    else:
-        biasvoltage = float(input("Please enter bias voltage value (V): "))
+            if IVfile is not None:
+                IVdata = np.loadtxt(IVfile, skiprows=1)
+
+            if OCPfile is not None:
+                biasvoltage = read_ocp_value(OCPfile)
+        if OCPfile is None:
+            biasvoltage = float(input("Please enter bias voltage value (V): "))
+
+        #running fit
+        if supported:
+            if bias:
+                fit_data = data
+                fixed_params_indices = [7]
+                fixed_params_values = [biasvoltage]
+            else:
+                fit_data = nobias_data
+                fixed_params_indices = []
+                fixed_params_values = []
+
+            use_cache = use_cache and not run_checker
+            plist_fitted = None
+            if use_cache:
+                #the guesser uses the bias voltage (from OCPfile or typed in) in every mode, not only bias fits
+                key = cache_key([datafile, nobias_datafile, IVfile], model.folder,
+                                {"bias": bias, "bias_voltage": biasvoltage, "fixed_params_indices": fixed_params_indices,
+                                 "fixed_params_values": fixed_params_values, "dZ": dZ is not None})
+                cached = load_fit(key)
+                if cached is not None:
+                    plist_fitted = cached[0]
+
+            if plist_fitted is None:
+                plist_fitted, fit_info = fit_leastsq(Z, data, nobias_data, biasvoltage, IVdata, bias=bias, nanoparticles=nano,
+                                                     run_checker=run_checker, fixed_params_indices=fixed_params_indices,
+                                                     fixed_params_values=fixed_params_values, full_output=True, dZ=dZ,
+                                                     init_paramfilename=init_paramfilename, bound_Z=model.bound_Z)
+                if use_cache:
+                    save_fit(key, plist_fitted, fit_info)
+
+    if profile:
+        print_report(fit_record)
 
-    #running fit
     if supported:
-        if bias:
-            plist_fitted = fit_leastsq(Z, data, nobias_data, biasvoltage, IVdata, bias=bias, nanoparticles=nano,
-                                    run_checker=run_checker, fixed_params_indices=[7], fixed_params_values=[biasvoltage])
-            plist_output = plotter(Z, init_paramfilename, data, plist_fitted)
-        else:
-            plist_fitted = fit_leastsq(Z, data, nobias_data, biasvoltage, IVdata, bias=bias, nanoparticles=nano,
-                                    run_checker=run_checker)
-            plist_output = plotter(Z, init_paramfilename, nobias_data, plist_fitted)
+        plist_output = plotter(Z, init_paramfilename, fit_data, plist_fitted)
     
     #use manually inputted parameters if model is not supported
     else:
@@ -0,0 +1,14 @@
+"""
+pytest configuration, run from the repository folder with python -m pytest
+Tests import the repository's modules the same way the scripts do, from the repository folder
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+import sys
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPOSITORY_FOLDER not in sys.path:
+    sys.path.insert(0, REPOSITORY_FOLDER)
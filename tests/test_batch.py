@@ -0,0 +1,199 @@
+"""
+Tests of batch fitting on the bundled test data: the results table, the warm start fallback of bias sweeps
+and parallel fitting giving the same rows as serial fitting
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import batch_main
+from batch_main import (batch_fitting, find_datasets, reference_datasets, fit_dataset, fit_sweep, fit_failed,
+                        fit_datasets_parallel, failed_row)
+from curve_fitting.Global_fitting import fit_global, DEFAULT_SHARED_INDICES
+from curve_fitting.Instrumentation import is_enabled
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.join(REPOSITORY_FOLDER, "test_data", "008Pixel7")
+MODEL = "nanoparticles_model"
+
+@pytest.fixture(scope="module")
+def datasets():
+    datasets = find_datasets(ROOT)
+    return datasets, reference_datasets(datasets)
+
+def test_batch_fitting_writes_results(tmp_path, datasets):
+    outfile = str(tmp_path / "results.csv")
+    results = batch_fitting(MODEL, ROOT, outfile=outfile, cache_folder=None)
+
+    table = pd.read_csv(outfile)
+    assert len(table) == len(datasets[0]) == len(results)
+    assert set(table["status"]) <= {"ok", "bound", "guess", "error"}
+    fitted = table[table["status"].isin(["ok", "bound"])]
+    assert len(fitted) >= len(table) - 2
+    param_names = batch_main.get_model(MODEL).param_names
+    assert np.all(np.isfinite(fitted[param_names].to_numpy()))
+    #kbt and n_0 are held at their Initial_params.csv values
+    assert np.allclose(fitted[param_names[4]], 4.1302114835e-21)
+
+    uncertainty = np.load(os.path.join(tmp_path, "results_uncertainty.npz"))
+    assert uncertainty["params"].shape == (len(table), len(param_names))
+
+def test_fit_failed():
+    row = {"status": "ok", "cost": 1.0, "params": [1.0, 2.0]}
+    assert not fit_failed(row)
+    assert not fit_failed({**row, "status": "bound"})
+    assert fit_failed({**row, "status": "guess"})
+    assert fit_failed({**row, "cost": np.inf})
+    assert fit_failed({**row, "params": [1.0, np.inf]})
+
+def test_sweep_falls_back_to_guess(monkeypatch, datasets):
+    datasets, references = datasets
+    pixel_datasets = [dataset for dataset in datasets if dataset["pixel"] == datasets[0]["pixel"]]
+    reference = references[datasets[0]["pixel"]]
+
+    #every warm started fit ends with non-finite parameters, as runaway fits did
+    def warm_fits_diverge(imp_model_folder, dataset, nobias_dataset, *args, p0=None, **kwargs):
+        row = fit_dataset(imp_model_folder, dataset, nobias_dataset, *args, p0=p0, **kwargs)
+        if p0 is not None and row["params"] is not None:
+            row["params"] = tuple(np.full(len(row["params"]), np.inf))
+        return row
+    monkeypatch.setattr(batch_main, "fit_dataset", warm_fits_diverge)
+
+    rows = fit_sweep(MODEL, pixel_datasets, reference)
+    assert len(rows) == len(pixel_datasets)
+    for row in rows:
+        if row["status"] != "error":
+            assert row["start"] == "guess"
+            assert np.all(np.isfinite(row["params"]))
+    #the first dataset has no warm start
+    assert rows[0]["status"] in ("ok", "bound")
+
+def test_parallel_matches_serial(datasets):
+    datasets, references = datasets
+    serial = [fit_dataset(MODEL, dataset, references[dataset["pixel"]]) for dataset in datasets]
+    parallel = fit_datasets_parallel(MODEL, datasets, references, workers=2)
+
+    assert [row["folder"] for row in parallel] == [row["folder"] for row in serial]
+    for parallel_row, serial_row in zip(parallel, serial):
+        assert parallel_row["status"] == serial_row["status"]
+        if serial_row["params"] is not None:
+            np.testing.assert_allclose(parallel_row["params"], serial_row["params"], rtol=1e-12)
+
+#dataset folder whose worker process dies, see crashing_fit
+crashing_folder = None
+
+def crashing_fit(imp_model_folder, dataset, nobias_dataset, *args):
+    #stands in for fit_dataset, workers are forked so they see the patched function
+    if dataset["folder"] == crashing_folder:
+        os._exit(1)
+    return {**failed_row(dataset, nobias_dataset), "status": "ok"}
+
+def test_parallel_survives_a_dying_worker(monkeypatch, datasets):
+    datasets, references = datasets
+    monkeypatch.setattr(batch_main, "fit_dataset", crashing_fit)
+    monkeypatch.setitem(globals(), "crashing_folder", datasets[1]["folder"])
+
+    rows = fit_datasets_parallel(MODEL, datasets, references, workers=2)
+    assert [row["folder"] for row in rows] == [dataset["folder"] for dataset in datasets]
+    statuses = {row["folder"]: row["status"] for row in rows}
+    assert statuses.pop(datasets[1]["folder"]) == "error"
+    assert set(statuses.values()) == {"ok"}
+
+def test_profiling_is_turned_off_after_batch(monkeypatch, tmp_path):
+    outfile = str(tmp_path / "results.csv")
+    batch_fitting(MODEL, ROOT, outfile=outfile, cache_folder=None, profile=True)
+    assert os.path.exists(str(tmp_path / "results_profile.json"))
+    assert not is_enabled()
+
+    def fail(root):
+        raise RuntimeError("unreadable folder")
+    monkeypatch.setattr(batch_main, "find_datasets", fail)
+    with pytest.raises(RuntimeError):
+        batch_fitting(MODEL, ROOT, outfile=outfile, cache_folder=None, profile=True)
+    assert not is_enabled()
+
+def test_joint_rejects_unsupported_options(tmp_path):
+    outfile = str(tmp_path / "results.csv")
+    assert batch_fitting(MODEL, ROOT, outfile=outfile, joint=True, multistart=4, cache_folder=None) is None
+    assert batch_fitting(MODEL, ROOT, outfile=outfile, joint=True, weighting="modulus", cache_folder=None) is None
+    assert not os.path.exists(outfile)
+
+def test_joint_failure_reports_start_and_is_cached(monkeypatch, tmp_path, datasets):
+    datasets, references = datasets
+    pixel = datasets[0]["pixel"]
+    #a few datasets keep the joint fit short
+    pixel_datasets = [dataset for dataset in datasets if dataset["pixel"] == pixel][:3]
+
+    fit_global = batch_main.fit_global
+    def unconverged_fit(*args, **kwargs):
+        fitted_params_list, fit_info = fit_global(*args, **kwargs)
+        return fitted_params_list, {**fit_info, "success": False}
+    monkeypatch.setattr(batch_main, "fit_global", unconverged_fit)
+
+    cache_folder = str(tmp_path / "cache")
+    rows = batch_main.fit_pixel_global(MODEL, pixel_datasets, references[pixel], cache_folder=cache_folder)
+    fitted = [row for row in rows if row["params"] is not None]
+    assert len(fitted) > 0
+    for row in fitted:
+        assert row["status"] == "guess"
+        if row["bias"]:
+            assert row["params"][7] == row["bias_voltage"]
+
+    #unconverged starting points are reported the same way from the cache
+    cached_rows = batch_main.fit_pixel_global(MODEL, pixel_datasets, references[pixel], cache_folder=cache_folder)
+    for row, cached_row in zip(rows, cached_rows):
+        assert cached_row["cached"] == (row["params"] is not None)
+        assert cached_row["status"] == row["status"]
+        if row["params"] is not None:
+            np.testing.assert_allclose(cached_row["params"], row["params"], rtol=1e-12)
+            assert cached_row["cost"] == pytest.approx(row["cost"], rel=1e-12)
+
+@pytest.mark.parametrize("vectorized", [True, False])
+def test_fit_global_recovers_shared_params(vectorized):
+    #two synthetic spectra at different biases, with C_A_ratio differing between them
+    model = batch_main.get_model("single_transistor_model")
+    true_params = np.abs(model.init_values)
+    w = np.logspace(-1, 6, 40)
+    spectra, p0_list, fixed_params_values = [], [], []
+    for biasvoltage, ratio in [(0.3, 3.0), (0.9, 5.0)]:
+        params = true_params.copy()
+        params[7], params[0] = biasvoltage, ratio
+        Z_values = model.Z(w, *params)
+        spectra.append(np.column_stack([np.arange(len(w)), w, Z_values.real, -Z_values.imag]))
+        p0 = params.copy()
+        p0[DEFAULT_SHARED_INDICES] *= 1.3
+        p0[[0, 6]] *= 1.2
+        p0_list.append(p0)
+        fixed_params_values.append([params[4], params[5], biasvoltage])
+
+    fitted_params_list, fit_info = fit_global(model.Z, spectra, p0_list, fixed_params_indices=[4, 5, 7],
+                                              fixed_params_values=fixed_params_values, dZ=model.dZ,
+                                              full_output=True, vectorized=vectorized)
+    assert fit_info["success"]
+    assert fit_info["cost"] < 1e-12 * sum(fit_info["start_costs"])
+    for params in fitted_params_list:
+        np.testing.assert_allclose(np.array(params)[DEFAULT_SHARED_INDICES], true_params[DEFAULT_SHARED_INDICES],
+                                   rtol=1e-3)
+    assert fitted_params_list[1][0] == pytest.approx(5.0, rel=1e-3)
+
+def test_joint_rows_report_bounds_and_fit_reference_voltage(datasets):
+    datasets, references = datasets
+    pixel = datasets[0]["pixel"]
+    pixel_datasets = [dataset for dataset in datasets if dataset["pixel"] == pixel]
+    rows = batch_main.fit_pixel_global(MODEL, pixel_datasets, references[pixel])
+
+    assert {row["status"] for row in rows} <= {"ok", "bound"}
+    assert any(row["status"] == "bound" for row in rows)
+    for row in rows:
+        assert (row["status"] == "bound") == (row["at_bound"] != "")
+        if row["bias"]:
+            assert row["params"][7] == row["bias_voltage"]
+        else:
+            #the 0V reference's bias voltage is fitted, as in fit_dataset
+            assert row["params"][7] != row["bias_voltage"]
@@ -0,0 +1,62 @@
+"""
+Tests of the peak finders against scipy.signal.find_peaks, and of the batch guesser against the single spectrum
+Finder/Guesser path on the bundled test data
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+
+import numpy as np
+import pytest
+import scipy.signal as ss
+
+from batch_main import find_datasets, reference_datasets, load_dataset
+from curve_fitting.Finder import find_peaks, peak_mask
+from curve_fitting.Guesser import param_guesser, param_guesser_batch
+from curve_fitting.Batch_finder import stack_spectra
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PIXELS = ["008Pixel7", "008Pixel8", "013Pixel8"]
+
+def test_find_peaks_matches_scipy():
+    #small integer values give plateaus, flat peaks and edge runs, with some nan
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        x = rng.integers(0, 4, rng.integers(0, 15)).astype(float)
+        if len(x) and rng.random() < 0.2:
+            x[rng.integers(len(x))] = np.nan
+        np.testing.assert_array_equal(find_peaks(x)[0], ss.find_peaks(x)[0])
+
+def test_peak_mask_stack():
+    rng = np.random.default_rng(1)
+    x = rng.integers(0, 4, (20, 12)).astype(float)
+    mask = peak_mask(x)
+    for row, row_mask in zip(x, mask):
+        np.testing.assert_array_equal(np.flatnonzero(row_mask), ss.find_peaks(row)[0])
+
+@pytest.mark.parametrize("pixel", PIXELS)
+@pytest.mark.parametrize("nanoparticles", [False, True])
+@pytest.mark.parametrize("bias", [True, False])
+def test_batch_guesses_match_single(pixel, nanoparticles, bias):
+    datasets = find_datasets(os.path.join(REPOSITORY_FOLDER, "test_data", pixel))
+    nobias_data = load_dataset(reference_datasets(datasets)[pixel])[0]
+    loaded = [load_dataset(dataset) for dataset in datasets]
+
+    #every folder has its own IV sweep, all of the same length, so they stack like the spectra
+    guesses = param_guesser_batch(stack_spectra([data for data, _, _ in loaded]), nobias_data,
+                                  stack_spectra([IVdata for _, IVdata, _ in loaded]),
+                                  [biasvoltage for _, _, biasvoltage in loaded], bias=bias, nanoparticles=nanoparticles)
+    failed = 0
+    for (data, IVdata, biasvoltage), guess in zip(loaded, guesses):
+        try:
+            expected = param_guesser(data, nobias_data, IVdata, biasvoltage, run_checker=False, bias=bias,
+                                     nanoparticles=nanoparticles)
+        except IndexError:
+            #the single path has no feature to index, e.g. 008OCP867mV, the batch path marks the spectrum with nan
+            assert np.all(np.isnan(guess))
+            failed += 1
+            continue
+        np.testing.assert_allclose(guess, np.asarray(expected, dtype=float), rtol=1e-10)
+    assert failed < len(loaded)
@@ -0,0 +1,69 @@
+"""
+Tests of the fit cache keys: identical fits share a key, any change of the data, model or options changes it
+
+Timothy Chew
+18/10/26
+"""
+
+import os
+import shutil
+
+import numpy as np
+
+from curve_fitting.Fit_cache import cache_key, load_fit, save_fit
+from curve_fitting.Model_registry import BUILTIN_MODELS_FOLDER
+
+OPTIONS = {"bias": True, "fixed_params_indices": [7], "fixed_params_values": [1.023], "dZ": True}
+
+def copy_model(tmp_path):
+    model_folder = tmp_path / "model"
+    shutil.copytree(os.path.join(BUILTIN_MODELS_FOLDER, "single_transistor_model"), model_folder)
+    return str(model_folder)
+
+def test_key_is_stable(tmp_path):
+    model_folder = copy_model(tmp_path)
+    data = np.arange(12.0).reshape(3, 4)
+    assert cache_key([data, None], model_folder, OPTIONS) == cache_key([data.copy(), None], model_folder, dict(OPTIONS))
+
+def test_key_changes_with_data_options_and_model(tmp_path):
+    model_folder = copy_model(tmp_path)
+    datafile = tmp_path / "data.txt"
+    datafile.write_text("index w re im\n0 1 2 3\n")
+    key = cache_key([str(datafile)], model_folder, OPTIONS)
+
+    assert cache_key([str(datafile)], model_folder, {**OPTIONS, "bias": False}) != key
+    assert cache_key([str(datafile)], model_folder, {**OPTIONS, "fixed_params_values": [1.024]}) != key
+    assert cache_key([str(datafile), None], model_folder, OPTIONS) != key
+
+    datafile.write_text("index w re im\n0 1 2 4\n")
+    data_key = cache_key([str(datafile)], model_folder, OPTIONS)
+    assert data_key != key
+
+    for filename in ["Impedancefunction.py", "Initial_params.csv"]:
+        with open(os.path.join(model_folder, filename), "a") as file:
+            file.write("\n")
+        model_key = cache_key([str(datafile)], model_folder, OPTIONS)
+        assert model_key != data_key
+        data_key = model_key
+
+def test_save_and_load(tmp_path):
+    fit_info = {"success": True, "cost": 1.5, "covariance": np.eye(2), "log_params": np.array([True, False])}
+    save_fit("key", (1.0, 2.0), fit_info, str(tmp_path))
+    fitted_params, loaded_info = load_fit("key", str(tmp_path))
+    assert list(fitted_params) == [1.0, 2.0]
+    assert loaded_info["cost"] == 1.5
+    np.testing.assert_array_equal(loaded_info["covariance"], np.eye(2))
+    assert load_fit("missing", str(tmp_path)) is None
+
+def test_eviction_lists_folder_rarely(tmp_path, monkeypatch):
+    cache_folder = str(tmp_path)
+    scans = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, "scandir", lambda path: scans.append(path) or scandir(path))
+    for i in range(100):
+        save_fit(f"key{i}", (float(i),), {}, cache_folder, max_entries=50)
+        assert len([name for name in os.listdir(cache_folder) if name.endswith(".json")]) <= 50
+    #one count when the folder is first used, then the folder is listed once the cache passes 50 results,
+    #which eviction brings back down to 45, i.e. once per 6 saves rather than on every save
+    assert len(scans) == 1 + 9
+    assert load_fit("key99", cache_folder) is not None
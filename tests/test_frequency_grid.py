@@ -0,0 +1,26 @@
+"""
+Tests of the adaptive frequency grid used to plot model curves
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+from curve_fitting.Model_registry import get_model
+from graphics.Frequency_grid import adaptive_frequencies
+
+def test_each_frequency_evaluated_once():
+    model = get_model("nanoparticles_model")
+    evaluated = []
+    def Z(w, *params):
+        evaluated.append(np.atleast_1d(w))
+        return model.Z(w, *params)
+
+    w, Z_values = adaptive_frequencies(Z, np.abs(model.init_values), 1e-1, 1e6)
+    evaluated = np.concatenate(evaluated)
+    assert len(np.unique(evaluated)) == len(evaluated)
+    assert np.all(np.diff(w) > 0) and np.isclose(w[0], 1e-1) and np.isclose(w[-1], 1e6)
+    #refined beyond the starting grid, and the curve is the model's
+    assert len(w) > 33
+    np.testing.assert_allclose(Z_values, model.Z(w, *np.abs(model.init_values)), rtol=1e-12)
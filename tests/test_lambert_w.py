@@ -0,0 +1,42 @@
+"""
+Tests of the vectorized Lambert W against scipy.special.lambertw
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+import pytest
+import scipy.special as sps
+
+from curve_fitting import Lambert_w
+from curve_fitting.Lambert_w import lambertw
+
+@pytest.mark.parametrize("size", [1, 36, 5000])
+def test_matches_scipy(size):
+    #the nanoparticle model's arguments: Re(z) >= 0 over many decades of |z|
+    rng = np.random.default_rng(0)
+    z = 10 ** rng.uniform(-12, 12, size) * np.exp(1j * rng.uniform(-np.pi/2, np.pi/2, size))
+    np.testing.assert_allclose(lambertw(z), sps.lambertw(z), rtol=1e-13)
+
+def test_left_half_plane_and_special_values():
+    z = np.concatenate([-np.exp(-1) + np.logspace(-12, 0, 1000), [0, np.inf, np.nan], -3 + 2j * np.arange(1000)])
+    np.testing.assert_allclose(lambertw(z), sps.lambertw(z), rtol=1e-12, equal_nan=True)
+
+def test_halley_matches_scipy():
+    z = np.logspace(-10, 10, 200) * (1 + 0.5j)
+    np.testing.assert_allclose(Lambert_w.halley(z), sps.lambertw(z), rtol=1e-13)
+
+def test_scalar():
+    assert np.isclose(lambertw(1.0), sps.lambertw(1.0), rtol=1e-14)
+
+def test_unconverged_marked_and_solved_by_scipy(monkeypatch):
+    #one iteration from the initial guess leaves most elements unconverged, they must be nan rather than inaccurate
+    z = np.logspace(-10, 10, 2000) * (1 + 0.5j)
+    w = Lambert_w.halley(z, max_iter=1)
+    unconverged = np.isnan(w)
+    assert unconverged.any()
+    np.testing.assert_allclose(w[~unconverged], sps.lambertw(z[~unconverged]), rtol=1e-7)
+    halley = Lambert_w.halley
+    monkeypatch.setattr(Lambert_w, "halley", lambda z: halley(z, max_iter=1))
+    np.testing.assert_allclose(lambertw(z), sps.lambertw(z), rtol=1e-13)
@@ -0,0 +1,61 @@
+"""
+Tests of the built-in impedance models: the numpy, compiled and bound versions of Z agree,
+and dZ agrees with finite differences of Z
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+import pytest
+
+from curve_fitting.Model_registry import get_model
+from curve_fitting.Compiled_model import compile_model
+
+MODELS = ["single_transistor_model", "nanoparticles_model"]
+
+#built-in initial parameters, V (index 7) is fixed in bias fits
+INIT_PARAMS = np.array([4.2, 1.14e-7, 0.00543, 8925, 4.1302114835e-21, 1, 2.31e-16, 1.023, 13.4, 1e4, 2.3, 3.3e-5])
+
+def model_params(model):
+    return INIT_PARAMS[:len(model.param_names)]
+
+@pytest.mark.parametrize("model_name", MODELS)
+def test_check_backends(model_name):
+    passed, errors = get_model(model_name).module.check_backends(n_samples=200)
+    assert passed, errors
+    assert errors["BoundZ"] <= 1e-12
+
+@pytest.mark.parametrize("model_name", MODELS)
+def test_compiled_model_matches_Z(model_name):
+    model = get_model(model_name)
+    params = model_params(model)
+    w = np.logspace(-2, 6, 40)
+    compiled = compile_model(model.Z, w, len(params), [7], [params[7]], dZ=model.dZ, bound_Z=model.bound_Z)
+    assert compiled.bound_Z.__class__.__name__ == "BoundZ"
+
+    Z_values = compiled.evaluate_Z(np.take(params, compiled.free_indices))
+    np.testing.assert_allclose(Z_values, model.module.Z_numpy(w, *params), rtol=1e-12)
+
+@pytest.mark.parametrize("model_name", MODELS)
+@pytest.mark.parametrize("seed", [None, 1, 2])
+def test_dZ_matches_finite_differences(model_name, seed):
+    model = get_model(model_name)
+    params = model_params(model)
+    if seed is not None:
+        params = params * 10 ** np.random.default_rng(seed).uniform(-0.5, 0.5, len(params))
+    w = np.logspace(-2, 6, 60)
+
+    jacobian = model.dZ(w, *params)
+    assert jacobian.shape == (len(w), len(params))
+    scale = np.max(np.abs(model.Z(w, *params)))
+    for k in range(len(params)):
+        h = params[k] * 1e-5
+        upper, lower = params.copy(), params.copy()
+        upper[k] += h
+        lower[k] -= h
+        finite_difference = (model.Z(w, *upper) - model.Z(w, *lower)) / (2 * h)
+        #compared as the change of Z for a relative change of the parameter, columns the data barely
+        #sees are then compared on the scale of Z rather than of their own rounding error
+        error = np.max(np.abs(jacobian[:, k] - finite_difference)) * params[k] / scale
+        assert error < 1e-6, (model.param_names[k], error)
@@ -0,0 +1,29 @@
+"""
+Tests of multi-start fitting: from a seed in the basin of a poor local minimum the search finds the better one
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+
+from curve_fitting.Multistart import fit_multistart
+
+def phase_Z(w, p):
+    return np.exp(-1j * w * p)
+
+def test_finds_better_of_two_minima():
+    #cost 4 - 2cos(d) - 2cos(2d) with d = p - 10: global minimum 0 at p = 10, local minimum 4 at p = 10 + pi,
+    #the bounds exclude the other periods
+    w = np.array([1.0, 2.0])
+    Z_data = phase_Z(w, 10.0)
+    ydata = np.hstack([Z_data.real, -Z_data.imag])
+    seed = [10 + np.pi]
+
+    single, single_report = fit_multistart(phase_Z, w, ydata, seed, [0], n_starts=1, lower=[5], upper=[16])
+    assert np.isclose(single[0], 10 + np.pi) and np.isclose(single_report["cost"], 4)
+
+    fitted, report = fit_multistart(phase_Z, w, ydata, seed, [0], n_starts=16, decades=0.3, lower=[5], upper=[16])
+    assert report["success"]
+    assert np.isclose(fitted[0], 10.0, rtol=1e-8)
+    assert report["cost"] < 1e-12 < report["seed_cost"]
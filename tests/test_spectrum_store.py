@@ -0,0 +1,75 @@
+"""
+Tests of the binary spectrum store: OCP summaries from a single read of each file and rebuilding stores
+written with another STORE_VERSION
+
+Timothy Chew
+18/10/26
+"""
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from data_io import Spectrum_store
+from data_io.Spectrum_store import ingest, SpectrumStore, STORE_VERSION
+from data_io.Nova_reader import ocp_summary
+
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ROOT = os.path.join(REPOSITORY_FOLDER, "test_data", "008Pixel7")
+
+@pytest.fixture
+def store_folder(tmp_path):
+    folder = str(tmp_path / "store")
+    ingest(ROOT, folder)
+    return folder
+
+def test_ocp_summaries_match_reader(store_folder):
+    store = SpectrumStore(store_folder)
+    assert len(store.entries) > 0
+    for entry in store.entries:
+        expected = ocp_summary(os.path.join(entry["folder"], "OCP.txt"))
+        #entries keep the summary's values except its row count, "rows" holds their row ranges instead
+        for key in ["OCP_value", "settled_OCP", "drift"]:
+            value = expected[key]
+            assert np.isclose(entry[key], value, rtol=1e-12, atol=0), (entry["folder"], key)
+
+def test_ocp_file_read_once(store_folder, monkeypatch):
+    calls = []
+    read_rows = Spectrum_store.read_rows
+    monkeypatch.setattr(Spectrum_store, "read_rows", lambda filename: calls.append(filename) or read_rows(filename))
+    ingest(ROOT, store_folder)
+    ocp_files = [filename for filename in calls if filename.endswith("OCP.txt")]
+    assert len(ocp_files) == len(set(ocp_files)) > 0
+
+@pytest.mark.parametrize("keep_root", [True, False])
+def test_old_version_rebuilt_on_open(store_folder, keep_root):
+    index_file = os.path.join(store_folder, "index.json")
+    with open(index_file) as file:
+        index = json.load(file)
+    expected = json.loads(json.dumps(index["entries"]))
+    #an older layout: wrong version, missing summary fields, version 1 stores did not record their root
+    index["version"] = STORE_VERSION - 1
+    for entry in index["entries"]:
+        del entry["settled_OCP"]
+    if not keep_root:
+        del index["root"]
+    with open(index_file, "w") as file:
+        json.dump(index, file)
+
+    store = SpectrumStore(store_folder)
+    assert store.entries == expected
+    with open(index_file) as file:
+        assert json.load(file)["version"] == STORE_VERSION
+
+def test_missing_source_folder_raises(store_folder):
+    index_file = os.path.join(store_folder, "index.json")
+    with open(index_file) as file:
+        index = json.load(file)
+    index["version"] = STORE_VERSION - 1
+    index["root"] = os.path.join(store_folder, "missing")
+    with open(index_file, "w") as file:
+        json.dump(index, file)
+    with pytest.raises(ValueError):
+        SpectrumStore(store_folder)
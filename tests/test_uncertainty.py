@@ -0,0 +1,44 @@
+"""
+Tests of the parameter uncertainties: on a model linear in its parameters the standard errors from the
+final Jacobian are those of ordinary least squares
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+import pytest
+
+from curve_fitting.Compiled_model import compile_model
+from curve_fitting.Curve_fitting import fit_free_params
+from curve_fitting.Uncertainty import standard_errors
+
+def linear_Z(w, a, b):
+    return (a + b*w) - 1j*(a + 2*b*w)
+
+@pytest.mark.parametrize("log_mask", [None, [False, True]])
+def test_stderr_matches_linear_regression(log_mask):
+    rng = np.random.default_rng(0)
+    w = np.linspace(0.1, 2, 30)
+    Z_data = linear_Z(w, 2.0, 0.5)
+    ydata = np.hstack([Z_data.real, -Z_data.imag]) + rng.normal(0, 0.05, 2 * len(w))
+
+    #closed form: ydata = X @ (a, b) + noise, covariance s^2 (X^T X)^-1 with s^2 = RSS / (n - 2)
+    X = np.vstack([np.column_stack([np.ones_like(w), w]), np.column_stack([np.ones_like(w), 2*w])])
+    expected, rss = np.linalg.lstsq(X, ydata, rcond=None)[:2]
+    expected_covariance = rss[0] / (len(ydata) - 2) * np.linalg.inv(X.T @ X)
+
+    model = compile_model(linear_Z, w, 2)
+    fitted, fit_info = fit_free_params(model, ydata, [1.0, 1.0],
+                                       log_mask=None if log_mask is None else np.array(log_mask))
+    assert fit_info["success"]
+    np.testing.assert_allclose(fitted, expected, rtol=1e-6)
+
+    stderr, correlation = standard_errors(fit_info["covariance"])
+    expected_stderr = np.sqrt(np.diag(expected_covariance))
+    if log_mask is not None:
+        #standard error of log10(b), to first order stderr(b) / (b ln 10)
+        expected_stderr[1] /= expected[1] * np.log(10)
+    np.testing.assert_allclose(stderr, expected_stderr, rtol=1e-5)
+    expected_correlation = expected_covariance[0, 1] / np.sqrt(expected_covariance[0, 0] * expected_covariance[1, 1])
+    assert np.isclose(correlation[0, 1], expected_correlation, rtol=1e-5)
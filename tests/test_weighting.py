@@ -0,0 +1,80 @@
+"""
+Tests of residual weighting and robust losses: the weights the bound model applies to its residuals and the
+soft_l1 loss down-weighting an outlying point
+
+Timothy Chew
+18/10/26
+"""
+
+import numpy as np
+import pytest
+from scipy.optimize import least_squares
+
+from curve_fitting.Compiled_model import compile_model
+from curve_fitting.Curve_fitting import fit_free_params
+from curve_fitting.Weighting import residual_weights, MIN_RELATIVE_ERROR
+from curve_fitting.Loss import robust_cost
+
+def rc_Z(w, R, C):
+    return R / (1 + 1j*w*R*C)
+
+def weighted_residuals(weighting, ydata, w, params):
+    model = compile_model(rc_Z, w, 2)
+    weights = residual_weights(ydata, weighting)
+    model.set_weights(weights)
+    return model.evaluate(params) - ydata * (1 if weights is None else weights)
+
+@pytest.fixture
+def spectrum():
+    w = np.logspace(-2, 2, 20)
+    Z_data = rc_Z(w, 2.0, 1.0)
+    ydata = np.hstack([Z_data.real, -Z_data.imag])
+    #a point where -Z'' crosses 0, proportional weights must fall back to MIN_RELATIVE_ERROR * |Z|
+    ydata[-1] = 0.0
+    return w, ydata
+
+def test_weighted_residuals(spectrum):
+    w, ydata = spectrum
+    params = np.array([2.2, 0.8])
+    Z_values = rc_Z(w, *params)
+    residuals = np.hstack([Z_values.real, -Z_values.imag]) - ydata
+    N = len(w)
+    modulus = np.tile(np.hypot(ydata[:N], ydata[N:]), 2)
+
+    np.testing.assert_allclose(weighted_residuals("unit", ydata, w, params), residuals, rtol=1e-14)
+    np.testing.assert_allclose(weighted_residuals("modulus", ydata, w, params), residuals / modulus, rtol=1e-14)
+    #each component relative to its own size, at least MIN_RELATIVE_ERROR of |Z| where it is small or 0
+    errors = np.maximum(np.abs(ydata), MIN_RELATIVE_ERROR * modulus)
+    assert errors[-1] == MIN_RELATIVE_ERROR * modulus[-1] and np.sum(errors == np.abs(ydata)) > N
+    np.testing.assert_allclose(weighted_residuals("proportional", ydata, w, params), residuals / errors, rtol=1e-14)
+
+def test_variance_weighting():
+    ydata = np.array([1.0, 2.0, 3.0, 4.0])
+    np.testing.assert_allclose(residual_weights(ydata, "variance", [4.0, 0.25]), [0.5, 2, 0.5, 2])
+    np.testing.assert_array_equal(residual_weights(ydata, "variance", [1, np.inf, 1, 1]), [1, 0, 1, 1])
+    with pytest.raises(ValueError):
+        residual_weights(ydata, "variance")
+
+def test_soft_l1_cost_matches_least_squares():
+    residuals = np.random.default_rng(0).normal(0, 3, 40)
+    #one evaluation at x = 0 gives least_squares' cost of the residuals themselves
+    result = least_squares(lambda x: residuals + x, [0.0], loss="soft_l1", f_scale=0.5, max_nfev=1)
+    start_cost = 0.5**2 * np.sum(np.sqrt(1 + (residuals / 0.5)**2) - 1)
+    assert np.isclose(robust_cost(residuals, "soft_l1", 0.5), 2 * start_cost, rtol=1e-14)
+    assert robust_cost(result.fun, "soft_l1", 0.5) == pytest.approx(2 * result.cost, rel=1e-12)
+    #large residuals count linearly rather than squared
+    assert robust_cost(residuals, "soft_l1", 0.5) < robust_cost(residuals)
+
+def test_soft_l1_resists_outlier():
+    w = np.logspace(-2, 2, 20)
+    Z_data = rc_Z(w, 2.0, 1.0)
+    ydata = np.hstack([Z_data.real, -Z_data.imag])
+    ydata[5] += 5.0
+    model = compile_model(rc_Z, w, 2)
+
+    linear, _ = fit_free_params(model, ydata, [1.5, 1.5])
+    robust, fit_info = fit_free_params(model, ydata, [1.5, 1.5], loss="soft_l1", f_scale=0.01)
+    assert fit_info["success"]
+    #the outlier pulls the least squares fit, the robust fit stays on the other points
+    assert np.max(np.abs(linear / [2.0, 1.0] - 1)) > 0.05
+    np.testing.assert_allclose(robust, [2.0, 1.0], rtol=1e-3)